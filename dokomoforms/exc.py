@@ -95,3 +95,11 @@ class InvalidTypeForOperation(DokomoError):
 
     For instance, you can't find the maximum of a text answer.
     """
+
+
+class SchemaVersionError(DokomoError):
+
+    """The database schema is not at the version the code expects.
+
+    See dokomoforms.models.migrations.
+    """
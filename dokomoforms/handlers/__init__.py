@@ -6,7 +6,8 @@ from dokomoforms.handlers.auth import (
 from dokomoforms.handlers.user.admin import (
     AdminHomepageHandler,
     ViewSurveyHandler, ViewSurveyDataHandler,
-    ViewSubmissionHandler, ViewUserAdminHandler
+    ViewSubmissionHandler, ViewUserAdminHandler,
+    ProfileListHandler, ProfileHandler, SlowQueriesHandler
 )
 from dokomoforms.handlers.user.enumerate import (
     EnumerateHomepageHandler, Enumerate, EnumerateTitle
@@ -19,16 +20,24 @@ from dokomoforms.handlers.debug import (
 from dokomoforms.handlers.demo import (
     DemoUserCreationHandler, DemoLogoutHandler
 )
+from dokomoforms.handlers.static import (
+    PrecompressedStaticFileHandler, OfflineManifest, OfflineManifestHandler
+)
+from dokomoforms.handlers.metrics import MetricsHandler
 
 __all__ = (
     'Index', 'NotFound',
     'Login', 'Logout', 'GenerateToken',
     'AdminHomepageHandler', 'CheckLoginStatus',
     'ViewSurveyHandler', 'ViewSurveyDataHandler', 'ViewUserAdminHandler',
-    'ViewSubmissionHandler',
+    'ViewSubmissionHandler', 'ProfileListHandler', 'ProfileHandler',
+    'SlowQueriesHandler',
     'EnumerateHomepageHandler', 'Enumerate', 'EnumerateTitle',
     'DebugUserCreationHandler', 'DebugLoginHandler', 'DebugLogoutHandler',
     'DebugPersonaHandler', 'DebugRevisitHandler', 'DebugToggleRevisitHandler',
     'DebugToggleRevisitSlowModeHandler',
-    'DemoUserCreationHandler', 'DemoLogoutHandler'
+    'DemoUserCreationHandler', 'DemoLogoutHandler',
+    'PrecompressedStaticFileHandler', 'OfflineManifest',
+    'OfflineManifestHandler',
+    'MetricsHandler',
 )
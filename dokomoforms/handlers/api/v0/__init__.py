@@ -11,6 +11,12 @@ from dokomoforms.handlers.api.v0.submissions import (
 from dokomoforms.handlers.api.v0.nodes import NodeResource
 from dokomoforms.handlers.api.v0.users import UserResource
 from dokomoforms.handlers.api.v0.photos import PhotoResource
+from dokomoforms.handlers.api.v0.ingest import IngestQueue, ReceiptResource
+from dokomoforms.handlers.api.v0.exports import ExportJobs, ExportResource
+from dokomoforms.handlers.api.v0.facilities import (
+    FacilityIndex, FacilityProxyHandler, NearestFacilitiesHandler,
+    FacilitiesWithinHandler
+)
 
 
 __all__ = (
@@ -23,4 +29,8 @@ __all__ = (
     'UserResource',
     'NodeResource',
     'PhotoResource',
+    'IngestQueue', 'ReceiptResource',
+    'ExportJobs', 'ExportResource',
+    'FacilityIndex', 'FacilityProxyHandler', 'NearestFacilitiesHandler',
+    'FacilitiesWithinHandler',
 )
@@ -2,6 +2,8 @@
 from abc import ABCMeta, abstractmethod
 from collections import OrderedDict
 import datetime
+from email.utils import parsedate_to_datetime
+from hashlib import sha1
 import logging
 from time import localtime
 
@@ -20,13 +22,50 @@ import tornado.web
 from dokomoforms.exc import SurveyAccessForbidden
 from dokomoforms.handlers.api.v0.serializer import ModelJSONSerializer
 from dokomoforms.handlers.api.v0.util import filename_safe
-from dokomoforms.handlers.util import BaseHandler, BaseAPIHandler
+from dokomoforms.handlers.util import (
+    BaseHandler, BaseAPIHandler, accepted_encodings, gzip_compress
+)
 from dokomoforms.models import Administrator, Email, Survey, Submission
 from dokomoforms.models.survey import (
     administrator_filter, _administrator_table
 )
-from dokomoforms.models.util import column_search, get_fields_subset, get_model
+from dokomoforms.models.util import (
+    column_search, estimate_count, get_fields_subset, get_model,
+    fields_projection, projected_asdict
+)
 from dokomoforms.exc import DokomoError
+from dokomoforms.options import options
+
+
+class _NotModified:
+
+    """Returned by a view method when the client's copy is up to date."""
+
+
+NOT_MODIFIED = _NotModified()
+
+
+class _Streamed:
+
+    """Returned by a view method that has already written the response."""
+
+
+STREAMED = _Streamed()
+
+
+class _CachedResponse:
+
+    """A serialized response body, kept as is and (if large enough) gzipped.
+
+    Stored in Application.response_cache under the ETag of the model it
+    represents, so a changed model gets a new entry.
+    """
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.gzipped = None
+        if len(body) >= options.compression_threshold:
+            self.gzipped = gzip_compress(body)
 
 
 class BaseResource(TornadoResource, metaclass=ABCMeta):
@@ -60,6 +99,23 @@ class BaseResource(TornadoResource, metaclass=ABCMeta):
     def objects_key(self):
         """The key for list responses."""
 
+    # The views whose GET requests can read from the replica database, if
+    # there is one, and so can lag behind the primary by the replication
+    # delay (the client's own writes aside). Leave out views whose data is
+    # written by anyone but the client (e.g., by worker threads) or that
+    # must not miss a change (e.g., change feeds with a cursor).
+    replica_views = frozenset()
+
+    # The column that changes whenever the model changes. Set this to None
+    # for models that cannot be used with conditional GET requests.
+    version_column_name = 'last_update_time'
+
+    # The ETag of the model in a detail response, set by _not_modified
+    _etag = None
+
+    # The values of the ?count= parameter for list responses
+    count_modes = ('exact', 'estimate', 'none')
+
     @property
     def session(self):
         """The handler's session."""
@@ -105,6 +161,7 @@ class BaseResource(TornadoResource, metaclass=ABCMeta):
         modifiers = set(self.request.arguments)
         modifiers.discard('format')
         modifiers.discard('dialect')
+        modifiers.discard('count')
         return bool(modifiers)
 
     def _set_filename(self, filename, extension):
@@ -147,11 +204,57 @@ class BaseResource(TornadoResource, metaclass=ABCMeta):
 
         return arg
 
+    def serialize_detail(self, data):
+        """Skip serialization entirely for a 304 NOT MODIFIED response.
+
+        A cached response is already serialized, and a streamed one is
+        already written.
+        """
+        if data is NOT_MODIFIED or data is STREAMED:
+            return data
+        if isinstance(data, _CachedResponse):
+            return data
+        return super().serialize_detail(data)
+
+    def _cached_response(self):
+        """The cached serialized response for the current ETag, or None."""
+        if self._etag is None:
+            return None
+        return self.application.response_cache.get(self._etag)
+
+    def _finish_cached(self, cached):
+        """Finish with a cached body, gzipped if the client accepts it."""
+        handler = self.ref_rh
+        compress = (
+            options.compress_response and
+            cached.gzipped is not None and
+            'gzip' in accepted_encodings(self.request)
+        )
+        if compress:
+            handler.set_header('Content-Encoding', 'gzip')
+            handler.finish(cached.gzipped)
+            return
+        handler.finish(cached.body)
+
     def build_response(self, data, status=200):
         """Finish the Tornado response.
 
-        This takes into account non-JSON content-types.
+        This takes into account non-JSON content-types. Detail responses
+        with an ETag get cached in both plain and compressed form.
         """
+        if data is NOT_MODIFIED:
+            self.ref_rh.set_status(304)
+            self.ref_rh.finish()
+            return
+        if data is STREAMED:
+            self.ref_rh.finish()
+            return
+        cached = None
+        if isinstance(data, _CachedResponse):
+            cached = data
+        elif status == 200 and self._etag is not None:
+            cached = _CachedResponse(data.encode())
+            self.application.response_cache[self._etag] = cached
         if self.content_type == 'csv':
             content_type = 'text/csv'
         else:
@@ -160,6 +263,9 @@ class BaseResource(TornadoResource, metaclass=ABCMeta):
             'Content-Type', '{}; charset=UTF-8'.format(content_type)
         )
         self.ref_rh.set_status(status)
+        if cached is not None:
+            self._finish_cached(cached)
+            return
         self.ref_rh.finish(data)
 
     def handle_error(self, err):
@@ -186,6 +292,8 @@ class BaseResource(TornadoResource, metaclass=ABCMeta):
             err = exc.NotFound()
         elif isinstance(err, understood):
             err = exc.BadRequest(err)
+        self.ref_rh.clear_header('Etag')
+        self.ref_rh.clear_header('Last-Modified')
         logging.exception(err)
         return super().handle_error(err)
 
@@ -259,7 +367,8 @@ class BaseResource(TornadoResource, metaclass=ABCMeta):
     def _specific_fields(self, model_or_models, is_detail=True):
         """Pick out the specified fields on the given models.
 
-        TODO: Confirm that this is not a performance bottleneck.
+        This is the fallback for fields that _fields_projection cannot
+        select directly.
         """
         fields = self._query_arg('fields', list)
 
@@ -273,18 +382,160 @@ class BaseResource(TornadoResource, metaclass=ABCMeta):
         models = model_or_models
         return [get_fields_subset(model, fields) for model in models]
 
+    def _fields_projection(self):
+        """The SQL projection for the ?fields= of this request, if possible.
+
+        CSV exports need the whole models.
+
+        :return: see dokomoforms.models.util.fields_projection, or None
+        """
+        fields = self._query_arg('fields', list)
+        if fields is None or self.content_type == 'csv':
+            return None
+        return fields_projection(self.resource_type, fields)
+
+    def _child_versions(self, model_id) -> list:
+        """Queries for the versions of the parts of a model's representation.
+
+        Override this for models whose dictionary representation includes
+        other models, so that changes to those models change the ETag. Any
+        datetime in the results also counts towards Last-Modified.
+
+        :param model_id: the id of the model
+        :return: a list of SQLAlchemy selectables
+        """
+        return []
+
+    def _version(self, model_id):
+        """Get the Last-Modified time and ETag of a model without loading it.
+
+        :param model_id: the id of the model
+        :return: a (datetime, str) tuple, or None if the model has no
+                 version column
+        :raises: sqlalchemy.orm.exc.NoResultFound
+        """
+        if self.version_column_name is None:
+            return None
+        model_cls = self.resource_type
+        last_modified = (
+            self.session
+            .query(getattr(model_cls, self.version_column_name))
+            .filter(model_cls.id == model_id)
+            .one()
+        )[0]
+        version_hash = sha1(
+            '{}?{}'.format(model_id, self.request.query).encode()
+        )
+        version_hash.update(last_modified.isoformat().encode())
+        for query in self._child_versions(model_id):
+            rows = self.session.execute(query).fetchall()
+            for row in rows:
+                for value in row:
+                    if isinstance(value, datetime.datetime):
+                        last_modified = max(last_modified, value)
+            version_hash.update(repr(rows).encode())
+        return last_modified, '"{}"'.format(version_hash.hexdigest())
+
+    def _not_modified(self, model_id) -> bool:
+        """Handle conditional GET requests for a single model.
+
+        Sets the ETag and Last-Modified headers, then checks the
+        If-None-Match and If-Modified-Since headers (in that order). This
+        only applies to API GET requests, not to handlers that use the
+        resource internally.
+
+        :param model_id: the id of the model
+        :return: whether the client already has the current version
+        """
+        handler = self.r_handler
+        conditional = (
+            isinstance(handler, BaseAPIHandler) and
+            self.request_method() == 'GET'
+        )
+        if not conditional:
+            return False
+        version = self._version(model_id)
+        if version is None:
+            return False
+        last_modified, etag = version
+        self._etag = etag
+        handler.set_header('Etag', etag)
+        handler.set_header('Last-Modified', last_modified)
+
+        headers = self.request.headers
+        if_none_match = headers.get('If-None-Match')
+        if if_none_match is not None:
+            client_etags = {
+                tag.strip().lstrip('W/') for tag in if_none_match.split(',')
+            }
+            return '*' in client_etags or etag in client_etags
+        if_modified_since = headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            try:
+                client_time = parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+            if client_time.tzinfo is None:
+                client_time = client_time.replace(tzinfo=datetime.timezone.utc)
+            return last_modified.replace(microsecond=0) <= client_time
+        return False
+
     def detail(self, model_id):
-        """Return a single instance of a model."""
+        """Return a single instance of a model.
+
+        Returns NOT_MODIFIED (skipping the model's _asdict and the JSON
+        encoding) if the client's cached copy is current, or the cached
+        serialized response if there is one for the current version.
+        """
+        if self._not_modified(model_id):
+            return NOT_MODIFIED
+        cached = self._cached_response()
+        if cached is not None:
+            return cached
+        projection = self._fields_projection()
+        if projection is not None:
+            model_cls = self.resource_type
+            row = (
+                self.session
+                .query(*(column for column, _ in projection.values()))
+                .filter(model_cls.id == model_id)
+                .one()
+            )
+            return projected_asdict(projection, row)
         return self._specific_fields(self._get_model(model_id))
 
     def list(self, where=None):
         """Return a list of instances of this model.
 
         Given a model class, build up the ORM query based on query params
-        and return the query result.
+        and return the query result. If the requested ?fields= can all be
+        selected directly, the result contains dictionaries instead of
+        models.
+
+        The ?count= parameter determines how total_entries and
+        filtered_entries are computed:
+        - exact (the default) counts the rows.
+        - estimate uses the query planner's estimates, which is much faster
+          for large tables.
+        - none skips counting, and both numbers are None.
         """
+        count_mode = self._query_arg('count', default='exact')
+        if count_mode not in self.count_modes:
+            raise exc.BadRequest(
+                'count must be one of: {}'.format(', '.join(self.count_modes))
+            )
+        exact = count_mode == 'exact'
+
         model_cls = self.resource_type
-        query = self.session.query(model_cls, count().over())
+        projection = self._fields_projection()
+        if projection is None:
+            query = self.session.query(model_cls)
+        else:
+            query = self.session.query(
+                *(column for column, _ in projection.values())
+            )
+        if exact:
+            query = query.add_columns(count().over())
 
         limit = self._query_arg('limit', int)
         offset = self._query_arg('offset', int)
@@ -306,16 +557,16 @@ class BaseResource(TornadoResource, metaclass=ABCMeta):
         type_constraint = self._query_arg('type')
         user_id = self._query_arg('user_id')
 
-        num_total = self.session.query(func.count(self.resource_type.id))
-        if user_id is not None:
-            if model_cls is Submission:
-                num_total = num_total.join(Survey.submissions)
-            num_total = (
-                num_total
-                .outerjoin(_administrator_table)
-                .filter(administrator_filter(user_id))
+        if exact:
+            num_total = self._total_query(
+                func.count(model_cls.id), user_id
+            ).scalar()
+        elif count_mode == 'estimate':
+            num_total = estimate_count(
+                self.session, self._total_query(model_cls.id, user_id)
             )
-        num_total = num_total.scalar()
+        else:
+            num_total = None
 
         if search_term is not None:
             for search_field in search_fields:
@@ -346,6 +597,11 @@ class BaseResource(TornadoResource, metaclass=ABCMeta):
         if where is not None:
             query = query.filter(where)
 
+        if count_mode == 'estimate':
+            num_filtered = estimate_count(self.session, query)
+        elif count_mode == 'none':
+            num_filtered = None
+
         for attribute_name, direction in order_by_text:
             try:
                 order = getattr(model_cls, attribute_name)
@@ -365,12 +621,33 @@ class BaseResource(TornadoResource, metaclass=ABCMeta):
             query = query.offset(offset)
 
         result = query.all()
-        if result:
-            num_filtered = result[0][1]
-            models = [res[0] for res in result]
-            result = self._specific_fields(models, is_detail=False)
+        if exact:
+            num_filtered = result[0][-1] if result else 0
+        if projection is not None:
+            # zip in projected_asdict leaves out the count column
+            result = [projected_asdict(projection, row) for row in result]
             return num_filtered, num_total, result
-        return 0, num_total, []
+        if exact:
+            result = [row[0] for row in result]
+        result = self._specific_fields(result, is_detail=False)
+        return num_filtered, num_total, result
+
+    def _total_query(self, entity, user_id=None):
+        """The query for total_entries, before counting.
+
+        :param entity: what to select (e.g., the count or the id column)
+        :param user_id: if given, only include this user's models
+        """
+        query = self.session.query(entity)
+        if user_id is not None:
+            if self.resource_type is Submission:
+                query = query.join(Survey.submissions)
+            query = (
+                query
+                .outerjoin(_administrator_table)
+                .filter(administrator_filter(user_id))
+            )
+        return query
 
     def update(self, model_id):
         """Update a model."""
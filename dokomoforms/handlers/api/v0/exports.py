@@ -0,0 +1,286 @@
+"""Export jobs: write an export to a file in the background, then download it.
+
+POST /api/v0/exports with a survey_id (and optionally a layout of 'long' or
+'wide', and a CSV dialect) responds 202 ACCEPTED with an ExportJob (see
+dokomoforms.models.ExportJob). The ExportJobs of the server process write the
+CSV file on options.export_workers threads, and record their progress in
+rows_written. GET /api/v0/exports/<id> shows the progress, and once the
+status is 'done', GET /api/v0/exports/<id>/download sends the file.
+
+The files in options.export_dir are named after the survey and the version
+of its data (see dokomoforms.models.artifact_key), so exporting data that
+has not changed reuses the last file instead of starting a job.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import datetime
+from itertools import islice
+import logging
+import os
+
+import restless.exceptions as exc
+from restless.constants import ACCEPTED
+
+import sqlalchemy as sa
+from sqlalchemy.orm import sessionmaker, with_polymorphic
+
+import tornado.gen
+
+from dokomoforms.handlers.api.v0 import BaseResource
+from dokomoforms.handlers.api.v0.base import STREAMED
+from dokomoforms.handlers.api.v0.submissions import CSV_FIELDNAMES
+from dokomoforms.models import (
+    Answer, ExportJob, Submission, Survey, artifact_key, fetch_batches,
+    get_model, wide_columns, wide_export_query, wide_header
+)
+from dokomoforms.options import options
+
+
+# A running job that has not made progress in this long died with its process
+STALE_AFTER = datetime.timedelta(minutes=10)
+
+# How much of the file to send at a time
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def artifact_path(key: str) -> str:
+    """The path of the export file with the given artifact_key."""
+    return os.path.join(options.export_dir, key + '.csv')
+
+
+class ExportJobs:
+
+    """Runs export jobs on worker threads.
+
+    Jobs that are queued when the process exits are not picked up by another
+    process. Starting the same export again after STALE_AFTER starts a new
+    job.
+    """
+
+    def __init__(self, bind):
+        """Create a worker pool that uses its own sessions.
+
+        :param bind: the Engine (or Connection) of the database to export from
+        """
+        self.bind = bind
+        self.Session = sessionmaker(bind=bind, autocommit=True)
+        self._executor = None
+
+    def start(self):
+        """Start the worker threads."""
+        self._executor = ThreadPoolExecutor(
+            max_workers=options.export_workers
+        )
+
+    def submit(self, job_id):
+        """Run the job on a worker thread (if the workers have started)."""
+        if self._executor is None:
+            return
+        self._executor.submit(self.run, job_id)
+
+    def run(self, job_id):
+        """Write the export file of the job, recording the outcome."""
+        session = self.Session()
+        try:
+            job = session.query(ExportJob).get(job_id)
+            with session.begin():
+                job.status = 'running'
+                job.started_time = sa.func.now()
+            try:
+                self._write(session, job)
+            except Exception as error:
+                logging.exception('Could not export %s.', job_id)
+                with session.begin():
+                    job.status = 'failed'
+                    job.error = str(error) or type(error).__name__
+                    job.finished_time = sa.func.now()
+            else:
+                with session.begin():
+                    job.status = 'done'
+                    job.finished_time = sa.func.now()
+        finally:
+            session.close()
+
+    def _write(self, session, job):
+        """Write to a temporary file, then move it into place.
+
+        Older files of the same export are deleted, since they are out of
+        date.
+        """
+        os.makedirs(options.export_dir, exist_ok=True)
+        path = artifact_path(job.artifact_key)
+        partial_path = '{}.{}.partial'.format(path, job.id)
+        # The rows come from a server-side cursor on a connection of their
+        # own, while the progress gets committed through the session
+        connection = self.bind.connect()
+        try:
+            header, num_rows, batches = self._rows(connection, job)
+            with session.begin():
+                job.rows_total = num_rows
+            rows_written = 0
+            with open(partial_path, 'w', newline='') as out:
+                writer = csv.writer(out, dialect=job.dialect)
+                writer.writerow(header)
+                for rows in batches:
+                    writer.writerows(rows)
+                    rows_written += len(rows)
+                    with session.begin():
+                        job.rows_written = rows_written
+            os.replace(partial_path, path)
+        except Exception:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+        finally:
+            connection.close()
+        prefix = job.artifact_key.rsplit('_', 1)[0] + '_'
+        for file_name in os.listdir(options.export_dir):
+            old = (
+                file_name.startswith(prefix) and
+                file_name.endswith('.csv') and
+                file_name != os.path.basename(path)
+            )
+            if old:
+                os.remove(os.path.join(options.export_dir, file_name))
+
+    def _rows(self, connection, job) -> tuple:
+        """The header, the number of rows, and the batches of rows."""
+        session = self.Session(bind=connection)
+        survey = session.query(Survey).get(job.survey_id)
+        batch_size = options.export_batch_size
+        if job.layout == 'wide':
+            columns = wide_columns(session, survey)
+            num_rows = (
+                session
+                .query(sa.func.count(Submission.id))
+                .filter(Submission.survey_id == survey.id)
+                .filter(sa.not_(Submission.deleted))
+                .scalar()
+            )
+            batches = fetch_batches(
+                connection, wide_export_query(survey, columns), batch_size
+            )
+            return wide_header(columns), num_rows, batches
+        answer = with_polymorphic(Answer, '*')
+        answers = (
+            session
+            .query(answer)
+            .filter(answer.survey_id == survey.id)
+            .filter(sa.not_(answer.deleted))
+            .order_by(
+                answer.save_time, answer.submission_id, answer.answer_number
+            )
+        )
+        num_rows = answers.order_by(None).count()
+        answers = iter(answers.yield_per(batch_size))
+
+        def batches():
+            batch = list(islice(answers, batch_size))
+            while batch:
+                yield [
+                    [row[name] for name in CSV_FIELDNAMES]
+                    for row in (model._asdict('csv') for model in batch)
+                ]
+                batch = list(islice(answers, batch_size))
+
+        return CSV_FIELDNAMES, num_rows, batches()
+
+
+class ExportResource(BaseResource):
+
+    """Restless resource for export jobs."""
+
+    resource_type = ExportJob
+    default_sort_column_name = 'created_time'
+    objects_key = 'exports'
+
+    http_methods = {
+        'list': {
+            'POST': 'create',
+        },
+        'detail': {
+            'GET': 'detail',
+        },
+        'download': {
+            'GET': 'download',
+        },
+    }
+
+    def create(self):
+        """Start an export, unless the same one is running or done.
+
+        A finished export of the same data comes back with the status
+        'done' right away.
+        """
+        # status_map is shared by every resource
+        self.status_map = dict(self.status_map, create=ACCEPTED)
+        survey = get_model(
+            self.session, Survey, self.data['survey_id'],
+            exc.BadRequest('survey not found')
+        )
+        layout = self.data.get('layout', 'long')
+        if layout not in {'long', 'wide'}:
+            raise exc.BadRequest('layout must be long or wide')
+        dialect = self.data.get('dialect', 'excel')
+        if dialect not in csv.list_dialects():
+            raise exc.BadRequest('unknown CSV dialect: {}'.format(dialect))
+        key = artifact_key(self.session, survey, layout, dialect)
+        existing = (
+            self.session
+            .query(ExportJob)
+            .filter(ExportJob.artifact_key == key)
+            .filter(sa.or_(
+                ExportJob.status == 'done',
+                sa.and_(
+                    ExportJob.status.in_(['queued', 'running']),
+                    ExportJob.last_update_time > sa.func.now() - STALE_AFTER,
+                ),
+            ))
+            .order_by(ExportJob.created_time.desc())
+            .first()
+        )
+        done = os.path.isfile(artifact_path(key))
+        if existing is not None and (existing.status != 'done' or done):
+            return self._located(existing)
+        job = ExportJob(
+            survey_id=survey.id, layout=layout, dialect=dialect,
+            artifact_key=key, status='done' if done else 'queued',
+        )
+        if done:
+            job.finished_time = sa.func.now()
+        with self.session.begin():
+            self.session.add(job)
+        if not done:
+            self.application.export_jobs.submit(job.id)
+        return self._located(job)
+
+    def _located(self, job):
+        """Set the Location header to the URL of the job."""
+        self.ref_rh.set_header(
+            'Location', self.application.reverse_url('export', job.id)
+        )
+        return job
+
+    @tornado.gen.coroutine
+    def download(self, job_id):
+        """Send the file of a finished export."""
+        job = self._get_model(job_id)
+        path = artifact_path(job.artifact_key)
+        if job.status != 'done' or not os.path.isfile(path):
+            raise exc.NotFound('The export is not ready: {}'.format(job_id))
+        handler = self.ref_rh
+        handler.set_header('Content-Type', 'text/csv; charset=UTF-8')
+        handler.set_header('Content-Length', os.path.getsize(path))
+        self._set_filename(
+            'survey_{}_submissions_{}'.format(
+                job.survey.title[job.survey.default_language], job.layout
+            ),
+            'csv'
+        )
+        with open(path, 'rb') as artifact:
+            chunk = artifact.read(DOWNLOAD_CHUNK_SIZE)
+            while chunk:
+                handler.write(chunk)
+                yield handler.flush()
+                chunk = artifact.read(DOWNLOAD_CHUNK_SIZE)
+        return STREAMED
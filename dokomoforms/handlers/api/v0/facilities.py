@@ -0,0 +1,623 @@
+"""A caching proxy for the facility data from Revisit."""
+from collections import OrderedDict
+from datetime import datetime
+import heapq
+from math import asin, cos, pi, radians, sin, sqrt
+from time import time
+from urllib.parse import urlencode
+
+import lzstring
+
+from tornado.escape import json_decode
+import tornado.gen
+import tornado.httpclient
+import tornado.web
+
+from dokomoforms.handlers.util import (
+    BaseAPIHandler, accepted_encodings, gzip_compress
+)
+from dokomoforms.options import options
+
+
+EARTH_RADIUS = 6371008.8  # mean radius in meters
+
+
+def _iso_now() -> str:
+    """The current UTC time in the format Revisit uses for updatedAt."""
+    now = datetime.utcnow()
+    return '{:%Y-%m-%dT%H:%M:%S}.{:03d}Z'.format(now, now.microsecond // 1000)
+
+
+def _quadtree_facilities(node, lzs) -> list:
+    """Decompress the facilities in the leaves of a Revisit quadtree.
+
+    The data of a leaf is a list of LZString (UTF-16) compressed JSON arrays.
+    """
+    facilities = []
+    for compressed in node.get('data') or ():
+        facilities.extend(json_decode(lzs.decompressFromUTF16(compressed)))
+    for child in (node.get('children') or {}).values():
+        facilities.extend(_quadtree_facilities(child, lzs))
+    return facilities
+
+
+def decode_facilities(body: bytes) -> list:
+    """The list of facilities in a Revisit response body.
+
+    With compressed=true the facilities come as a quadtree, otherwise as a
+    list.
+    """
+    facilities = json_decode(body)['facilities']
+    if isinstance(facilities, dict):
+        facilities = _quadtree_facilities(facilities, lzstring.LZString())
+    return facilities
+
+
+class CachedFacilities:
+
+    """A response from Revisit, as is and gzipped.
+
+    as_of is the time of the request to Revisit. Each facility is stamped
+    with the as_of time of the first response in which it appeared in its
+    current form, and facilities missing from this response with the time
+    they went missing. That way a delta does not depend on the clocks of
+    Revisit or of the client.
+
+    Those removals are only known from first_as_of (the as_of time of the
+    first response in the chain of previous responses) on. The cache entry
+    can be evicted, the process restarted, or a request can reach another
+    process, so an older delta has to start over with every facility.
+    """
+
+    def __init__(self, body: bytes, previous=None):
+        """Store the body of a response from Revisit.
+
+        :param body: the response body
+        :param previous: the CachedFacilities this response replaces, if any
+        """
+        self.body = body
+        self.gzipped = gzip_compress(body)
+        self.fetched_at = time()
+        self.as_of = _iso_now()
+        self.facilities = OrderedDict(
+            (facility['uuid'], facility)
+            for facility in decode_facilities(body)
+        )
+        if previous is None:
+            self.first_as_of = self.as_of
+            self.changed_at = dict.fromkeys(self.facilities, self.as_of)
+            self.removed_at = {}
+            return
+        self.first_as_of = previous.first_as_of
+        self.changed_at = {
+            uuid: (
+                previous.changed_at[uuid]
+                if previous.facilities.get(uuid) == facility
+                else self.as_of
+            ) for uuid, facility in self.facilities.items()
+        }
+        self.removed_at = {
+            uuid: removed for uuid, removed in previous.removed_at.items()
+            if uuid not in self.facilities
+        }
+        self.removed_at.update(
+            (uuid, self.as_of) for uuid in previous.facilities
+            if uuid not in self.facilities
+        )
+
+    @property
+    def expired(self) -> bool:
+        """Whether this response is older than options.facility_cache_time."""
+        return time() - self.fetched_at > options.facility_cache_time
+
+    def expire(self):
+        """Refetch this response on the next request."""
+        self.fetched_at = float('-inf')
+
+    def delta(self, since: str) -> dict:
+        """The facilities that changed or went missing after since.
+
+        If since is before first_as_of, the removals are unknown, so the
+        delta has every facility and full is true: the client should
+        replace what it has instead of updating it.
+
+        :param since: an as_of time from a previous response
+        :return: a dict with the changed facilities, the UUIDs of the removed
+                 ones, whether the delta is full, and the as_of time to use
+                 next time
+        """
+        full = since < self.first_as_of
+        changed = [
+            facility for uuid, facility in self.facilities.items()
+            if full or self.changed_at[uuid] > since
+        ]
+        removed = [] if full else sorted(
+            uuid for uuid, removed in self.removed_at.items()
+            if removed > since
+        )
+        return OrderedDict((
+            ('facilities', changed),
+            ('count', len(changed)),
+            ('removed', removed),
+            ('full', full),
+            ('updatedAt', self.as_of),
+        ))
+
+
+def _to_xyz(lat: float, lng: float) -> tuple:
+    """Convert latitude and longitude to a point on the unit sphere.
+
+    Straight-line distance between these points grows with distance along
+    the Earth's surface, without any trouble at the poles or at 180 degrees.
+    """
+    lat, lng = radians(lat), radians(lng)
+    return cos(lat) * cos(lng), cos(lat) * sin(lng), sin(lat)
+
+
+def _chord_to_meters(chord_squared: float) -> float:
+    return 2 * EARTH_RADIUS * asin(min(1.0, sqrt(chord_squared) / 2))
+
+
+def _meters_to_chord(meters: float) -> float:
+    return 2 * sin(min(meters / EARTH_RADIUS, pi) / 2)
+
+
+def _squared_distance(a, b) -> float:
+    return (a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2 + (a[2] - b[2]) ** 2
+
+
+def _build_kd_tree(points: list, depth: int=0):
+    """Build a k-d tree of (x, y, z, uuid) points.
+
+    :return: nested (point, axis, left, right) tuples, or None if there are
+             no points
+    """
+    if not points:
+        return None
+    axis = depth % 3
+    points.sort(key=lambda point: point[axis])
+    median = len(points) // 2
+    return (
+        points[median], axis,
+        _build_kd_tree(points[:median], depth + 1),
+        _build_kd_tree(points[median + 1:], depth + 1),
+    )
+
+
+class FacilityIndex:
+
+    """A spatial index of facilities for nearest and within-radius queries.
+
+    Facilities (keyed by UUID) are kept in a k-d tree over points on the unit
+    sphere. Facilities added or changed since the tree was built sit in a
+    small pending list that queries scan directly, and replaced or removed
+    facilities are skipped in the tree. Once there are more of those than
+    about the square root of the size of the tree, the tree gets rebuilt.
+    """
+
+    min_pending = 32
+
+    def __init__(self, facilities=()):
+        """Index the given facilities."""
+        self._facilities = {}
+        self._tree = None
+        self._tree_size = 0
+        self._in_tree = set()
+        self._stale = set()
+        self._pending = {}
+        for facility in facilities:
+            self._add(facility)
+        self.rebuild()
+
+    def __len__(self):
+        """The number of indexed facilities."""
+        return len(self._facilities)
+
+    def __contains__(self, uuid):
+        """Whether the facility with this UUID is indexed."""
+        return uuid in self._facilities
+
+    def add(self, facility: dict):
+        """Add or update a facility.
+
+        Facilities without a UUID or valid [lng, lat] coordinates are
+        ignored.
+        """
+        self._add(facility)
+        self._maybe_rebuild()
+
+    def _add(self, facility: dict):
+        try:
+            uuid = facility['uuid']
+            lng, lat = map(float, facility['coordinates'][:2])
+        except (KeyError, TypeError, ValueError):
+            return
+        self._facilities[uuid] = facility
+        if uuid in self._in_tree:
+            self._stale.add(uuid)
+        self._pending[uuid] = _to_xyz(lat, lng) + (uuid,)
+
+    def remove(self, uuid):
+        """Remove the facility with this UUID, if it is indexed."""
+        self._remove(uuid)
+        self._maybe_rebuild()
+
+    def _remove(self, uuid):
+        self._facilities.pop(uuid, None)
+        self._pending.pop(uuid, None)
+        if uuid in self._in_tree:
+            self._stale.add(uuid)
+
+    def update(self, cached: 'CachedFacilities', keep=frozenset()):
+        """Apply the changes in a fresh response from Revisit.
+
+        :param cached: the CachedFacilities
+        :param keep: UUIDs not to remove (e.g., still in other responses)
+        """
+        for uuid, facility in cached.facilities.items():
+            if cached.changed_at[uuid] == cached.as_of:
+                self._add(facility)
+        for uuid, removed in cached.removed_at.items():
+            if removed == cached.as_of and uuid not in keep:
+                self._remove(uuid)
+        self._maybe_rebuild()
+
+    def _maybe_rebuild(self):
+        limit = max(self.min_pending, int(sqrt(self._tree_size)))
+        if len(self._pending) + len(self._stale) > limit:
+            self.rebuild()
+
+    def rebuild(self):
+        """Rebuild the k-d tree from scratch."""
+        points = [
+            point for point in self._tree_points()
+            if point[3] not in self._stale
+        ]
+        points.extend(self._pending.values())
+        self._tree_size = len(points)
+        self._in_tree = {point[3] for point in points}
+        self._tree = _build_kd_tree(points)
+        self._stale = set()
+        self._pending = {}
+
+    def _tree_points(self):
+        stack = [self._tree]
+        while stack:
+            node = stack.pop()
+            if node is not None:
+                stack.extend(node[2:])
+                yield node[0]
+
+    def nearest(self, lat: float, lng: float, k: int=1) -> list:
+        """The k facilities nearest to a location.
+
+        :return: a list of (distance in meters, facility) pairs, nearest
+                 first
+        """
+        if k <= 0:
+            return []
+        target = _to_xyz(lat, lng)
+        stale = self._stale
+        # max-heap of the best k so far, as (-squared distance, uuid)
+        best = []
+
+        def consider(point):
+            squared = _squared_distance(point, target)
+            if len(best) < k:
+                heapq.heappush(best, (-squared, point[3]))
+            elif squared < -best[0][0]:
+                heapq.heapreplace(best, (-squared, point[3]))
+
+        # (node, a lower bound on the squared distance to its points)
+        stack = [(self._tree, 0.0)]
+        while stack:
+            node, bound = stack.pop()
+            if node is None:
+                continue
+            if len(best) == k and bound >= -best[0][0]:
+                continue
+            point, axis, left, right = node
+            if point[3] not in stale:
+                consider(point)
+            difference = target[axis] - point[axis]
+            near, far = (left, right) if difference < 0 else (right, left)
+            # The near side gets popped (and searched) first
+            stack.append((far, max(bound, difference ** 2)))
+            stack.append((near, bound))
+        for point in self._pending.values():
+            consider(point)
+        return [
+            (_chord_to_meters(-squared), self._facilities[uuid])
+            for squared, uuid in sorted(best, reverse=True)
+        ]
+
+    def within(self, lat: float, lng: float, radius: float) -> list:
+        """The facilities within radius meters of a location.
+
+        :return: a list of (distance in meters, facility) pairs, nearest
+                 first
+        """
+        target = _to_xyz(lat, lng)
+        limit = _meters_to_chord(radius) ** 2
+        stale = self._stale
+        found = []
+        stack = [self._tree]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            point, axis, left, right = node
+            if point[3] not in stale:
+                squared = _squared_distance(point, target)
+                if squared <= limit:
+                    found.append((squared, point[3]))
+            difference = target[axis] - point[axis]
+            if difference <= 0 or difference ** 2 <= limit:
+                stack.append(left)
+            if difference >= 0 or difference ** 2 <= limit:
+                stack.append(right)
+        for point in self._pending.values():
+            squared = _squared_distance(point, target)
+            if squared <= limit:
+                found.append((squared, point[3]))
+        found.sort()
+        return [
+            (_chord_to_meters(squared), self._facilities[uuid])
+            for squared, uuid in found
+        ]
+
+
+class BaseFacilityHandler(BaseAPIHandler):
+
+    """Fetches facilities from options.revisit_url through a cache.
+
+    The query arguments (e.g., within=nlat,wlng,slat,elng&compressed=true),
+    except for the local_arguments, are passed along to Revisit, and the
+    response is cached per set of arguments (i.e., per bounding box) for
+    options.facility_cache_time seconds. If Revisit cannot be reached, a
+    stale cached response is better than none. Requests that miss the cache
+    for the same arguments at the same time wait for the same fetch.
+
+    Every fresh response also updates the application's facility_index.
+    """
+
+    local_arguments = frozenset({'updatedAt'})
+
+    def _proxied_arguments(self) -> tuple:
+        """The sorted (name, value) query arguments to pass to Revisit."""
+        return tuple(sorted(
+            (name, value.decode())
+            for name, values in self.request.query_arguments.items()
+            if name not in self.local_arguments
+            for value in values
+        ))
+
+    @tornado.gen.coroutine
+    def _get_facilities(self, arguments: tuple) -> CachedFacilities:
+        """Get the cached response for the arguments, refreshing if needed.
+
+        :raise tornado.web.HTTPError: 502 if Revisit cannot be reached and
+                                      nothing is cached
+        """
+        cached = self.application.facility_cache.get(arguments)
+        if cached is not None and not cached.expired:
+            return cached
+        fetches = self.application.facility_fetches
+        fetching = fetches.get(arguments)
+        if fetching is None:
+            fetching = fetches[arguments] = self._fetch_facilities(
+                arguments, cached
+            )
+            fetching.add_done_callback(
+                lambda future: fetches.pop(arguments, None)
+            )
+        refreshed = yield fetching
+        return refreshed
+
+    @tornado.gen.coroutine
+    def _fetch_facilities(self, arguments: tuple, cached) -> CachedFacilities:
+        """Fetch the response for the arguments from Revisit and cache it.
+
+        :param cached: the expired CachedFacilities, if any
+        """
+        cache = self.application.facility_cache
+        upstream_url = options.revisit_url
+        if arguments:
+            upstream_url += '?' + urlencode(arguments)
+        http_client = tornado.httpclient.AsyncHTTPClient()
+        try:
+            response = yield http_client.fetch(upstream_url)
+        except (tornado.httpclient.HTTPError, OSError):
+            if cached is None:
+                raise tornado.web.HTTPError(502)
+            return cached
+        refreshed = CachedFacilities(response.body, previous=cached)
+        cache[arguments] = refreshed
+        # A facility can be in the responses for several bounding boxes
+        keep = set()
+        if refreshed.removed_at:
+            for other in cache.values():
+                if other is not refreshed:
+                    keep.update(other.facilities)
+        self.application.facility_index.update(refreshed, keep=keep)
+        return refreshed
+
+    def _search_arguments(self) -> tuple:
+        """The arguments to pass to Revisit before searching the index.
+
+        A search has to name the region it needs with the within argument
+        (nlat,wlng,slat,elng), which makes sure the facilities in that
+        region are loaded. Without it, the whole dataset would be fetched.
+
+        :raise tornado.web.HTTPError: 400 if within is missing or invalid
+        """
+        within = self.get_query_argument('within', None)
+        if within is None:
+            raise tornado.web.HTTPError(400, 'Missing within argument')
+        try:
+            nlat, wlng, slat, elng = map(float, within.split(','))
+        except ValueError:
+            raise tornado.web.HTTPError(400, 'Invalid within argument')
+        return self._proxied_arguments()
+
+    def _float_argument(self, name: str) -> float:
+        """Get a required numeric query argument.
+
+        :raise tornado.web.HTTPError: 400 if it is missing or not a number
+        """
+        try:
+            return float(self.get_query_argument(name))
+        except ValueError:
+            raise tornado.web.HTTPError(
+                400, 'Invalid {} argument'.format(name)
+            )
+
+    def _write_found(self, found: list):
+        """Write (distance, facility) pairs with the distance in meters."""
+        self.write({
+            'facilities': [
+                dict(facility, distance=distance)
+                for distance, facility in found
+            ],
+            'count': len(found),
+        })
+
+
+class FacilityProxyHandler(BaseFacilityHandler):
+
+    """GET facilities from Revisit, or POST a new one.
+
+    The X-Facilities-As-Of header of a response can be sent back as the
+    updatedAt argument, in which case the response only contains what
+    changed since then:
+
+        {
+            "facilities": [<new or updated facilities>],
+            "count": <the number of new or updated facilities>,
+            "removed": [<UUIDs of facilities that are gone>],
+            "full": <whether to replace every facility instead>,
+            "updatedAt": <the updatedAt to use next time>
+        }
+
+    full is true (and facilities has every facility) when the removals
+    since updatedAt are not known, e.g. after a restart.
+
+    POSTs (adding a facility) are passed along to Revisit, add the facility
+    to the facility_index, and expire the cache.
+    """
+
+    @tornado.gen.coroutine
+    def get(self):
+        """Get facilities (or what changed since updatedAt)."""
+        cached = yield self._get_facilities(self._proxied_arguments())
+        self.set_header('X-Facilities-As-Of', cached.as_of)
+        updated_at = self.get_query_argument('updatedAt', None)
+        if updated_at is not None:
+            self.write(cached.delta(updated_at))
+            return
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        # The GZipContentEncoding transform adds Vary when it is on
+        if not options.compress_response:
+            self.set_header('Vary', 'Accept-Encoding')
+        if 'gzip' in accepted_encodings(self.request):
+            self.set_header('Content-Encoding', 'gzip')
+            self.write(cached.gzipped)
+        else:
+            self.write(cached.body)
+
+    @tornado.gen.coroutine
+    def post(self):
+        """Add a facility to Revisit."""
+        headers = {'Content-Type': 'application/json'}
+        authorization = self.request.headers.get('Authorization')
+        if authorization is not None:
+            headers['Authorization'] = authorization
+        http_client = tornado.httpclient.AsyncHTTPClient()
+        try:
+            response = yield http_client.fetch(
+                options.revisit_url, method='POST', headers=headers,
+                body=self.request.body,
+            )
+        except tornado.httpclient.HTTPError as error:
+            if error.response is None:
+                raise tornado.web.HTTPError(502)
+            response = error.response
+        except OSError:
+            raise tornado.web.HTTPError(502)
+        else:
+            try:
+                self.application.facility_index.add(
+                    json_decode(self.request.body)
+                )
+            except (ValueError, AttributeError):
+                pass
+            for cached in self.application.facility_cache.values():
+                cached.expire()
+        self.set_status(response.code)
+        content_type = response.headers.get('Content-Type')
+        if content_type is not None:
+            self.set_header('Content-Type', content_type)
+        if response.body:
+            self.write(response.body)
+
+
+class NearestFacilitiesHandler(BaseFacilityHandler):
+
+    """GET the k facilities nearest to lat, lng.
+
+    The within argument (a bounding box, as for FacilityProxyHandler) is
+    required, and it and any other query arguments are passed along to
+    Revisit to load the facilities in that region first. The search itself
+    covers the application's one facility_index, i.e., every facility
+    loaded so far for any bounding box, so the results are not limited to
+    the box. The response looks like
+
+        {"facilities": [<facility with a distance in meters>], "count": k}
+    """
+
+    local_arguments = frozenset({'lat', 'lng', 'k'})
+
+    max_k = 100
+
+    @tornado.gen.coroutine
+    def get(self):
+        """Find the nearest facilities."""
+        lat = self._float_argument('lat')
+        lng = self._float_argument('lng')
+        try:
+            k = int(self.get_query_argument('k', '1'))
+        except ValueError:
+            raise tornado.web.HTTPError(400, 'Invalid k argument')
+        if not 0 < k <= self.max_k:
+            raise tornado.web.HTTPError(
+                400, 'k must be between 1 and {}'.format(self.max_k)
+            )
+        yield self._get_facilities(self._search_arguments())
+        self._write_found(
+            self.application.facility_index.nearest(lat, lng, k)
+        )
+
+
+class FacilitiesWithinHandler(BaseFacilityHandler):
+
+    """GET the facilities within radius meters of lat, lng.
+
+    The within argument is required, and the search covers the whole
+    facility_index, as for NearestFacilitiesHandler. The response looks like
+    the one from NearestFacilitiesHandler.
+    """
+
+    local_arguments = frozenset({'lat', 'lng', 'radius'})
+
+    @tornado.gen.coroutine
+    def get(self):
+        """Find the facilities within the radius."""
+        lat = self._float_argument('lat')
+        lng = self._float_argument('lng')
+        radius = self._float_argument('radius')
+        if radius < 0:
+            raise tornado.web.HTTPError(400, 'Invalid radius argument')
+        yield self._get_facilities(self._search_arguments())
+        self._write_found(
+            self.application.facility_index.within(lat, lng, radius)
+        )
@@ -0,0 +1,246 @@
+"""Write-behind ingest: queue submissions now, save them in batches later.
+
+With options.write_behind_ingest, POST /api/v0/surveys/<id>/submit checks
+the request and the shape of the submission, stores it in the
+pending_submission table (see dokomoforms.models.PendingSubmission), and
+responds 202 ACCEPTED with a receipt. The IngestQueue of each server process
+saves the queued submissions on options.ingest_workers threads, in
+transactions of up to options.ingest_batch_size submissions. The client can
+follow the outcome at /api/v0/submissions/receipts/<receipt id>.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import logging
+
+import restless.exceptions as exc
+
+import sqlalchemy as sa
+from sqlalchemy.orm import sessionmaker
+
+import tornado.ioloop
+
+from dokomoforms.handlers.api.v0 import BaseResource
+from dokomoforms.handlers.api.v0.submissions import (
+    _authorize_submission, duplicate_submission, save_submission
+)
+from dokomoforms.models import PendingSubmission, SurveyNode, User
+from dokomoforms.options import options
+
+
+# A claim this old belongs to a worker that died in the middle of a batch
+CLAIM_TIMEOUT = datetime.timedelta(minutes=5)
+
+
+def _validate(session, submission_data):
+    """Check what can be checked cheaply before queueing a submission.
+
+    Everything else (e.g., the answers' types) is up to the worker.
+    """
+    answers = submission_data.get('answers', [])
+    well_formed = isinstance(answers, list) and all(
+        isinstance(answer, dict) and 'survey_node_id' in answer
+        for answer in answers
+    )
+    if not well_formed:
+        raise exc.BadRequest('answers must be a list of objects with a'
+                             ' survey_node_id')
+    survey_node_ids = {answer['survey_node_id'] for answer in answers}
+    if not survey_node_ids:
+        return
+    num_found = (
+        session
+        .query(sa.func.count(SurveyNode.id))
+        .filter(SurveyNode.id.in_(survey_node_ids))
+        .scalar()
+    )
+    if num_found != len(survey_node_ids):
+        raise exc.BadRequest('survey_node not found')
+
+
+def enqueue_submission(self, survey) -> PendingSubmission:
+    """Queue the submission of a SurveyResource request.
+
+    Sets the Location header to the URL of the receipt.
+    """
+    enumerator = _authorize_submission(self, survey)
+    _validate(self.session, self.data)
+    pending = PendingSubmission(
+        survey_id=survey.id,
+        enumerator_user_id=None if enumerator is None else enumerator.id,
+        submission_data=self.data,
+    )
+    with self.session.begin():
+        self.session.add(pending)
+    self.ref_rh.set_header(
+        'Location',
+        self.application.reverse_url('submission_receipt', pending.id)
+    )
+    self.application.ingest_queue.wake()
+    return pending
+
+
+class IngestQueue:
+
+    """Saves the queued submissions on worker threads.
+
+    A worker claims a batch in one short transaction, then saves it in
+    another, with a savepoint for each submission so that a rejected
+    submission does not roll back the rest of the batch. The claim locks the
+    rows, so several workers (and processes) can drain the same queue.
+    """
+
+    def __init__(self, bind, *, metrics=None):
+        """Create a queue that uses its own sessions.
+
+        :param bind: the Engine (or Connection) of the primary database
+        :param metrics: the Metrics to count saved submissions in, if any
+        """
+        self.Session = sessionmaker(bind=bind, autocommit=True)
+        self.metrics = metrics
+        self._executor = None
+        self._io_loop = None
+        self._running = 0
+
+    def start(self, io_loop=None):
+        """Check for queued submissions every options.ingest_interval."""
+        self._io_loop = io_loop or tornado.ioloop.IOLoop.current()
+        self._executor = ThreadPoolExecutor(
+            max_workers=options.ingest_workers
+        )
+        tornado.ioloop.PeriodicCallback(
+            self.wake, options.ingest_interval * 1000, io_loop=self._io_loop
+        ).start()
+
+    def wake(self):
+        """Put any idle worker to work (if the queue has been started)."""
+        if self._executor is None:
+            return
+        while self._running < options.ingest_workers:
+            self._running += 1
+            future = self._executor.submit(self.drain_all)
+            self._io_loop.add_future(future, self._worker_done)
+
+    def _worker_done(self, future):
+        self._running -= 1
+
+    def drain_all(self) -> int:
+        """Save batches until the queue is empty.
+
+        :return: the number of submissions processed
+        """
+        total = 0
+        try:
+            num_processed = self.drain()
+            while num_processed:
+                total += num_processed
+                num_processed = self.drain()
+        except Exception:
+            logging.exception('Could not save the queued submissions.')
+        return total
+
+    def drain(self) -> int:
+        """Claim a batch of queued submissions and save them.
+
+        :return: the number of submissions processed (accepted or rejected)
+        """
+        session = self.Session()
+        try:
+            pending_ids = self._claim(session, options.ingest_batch_size)
+            if not pending_ids:
+                return 0
+            with session.begin():
+                batch = (
+                    session
+                    .query(PendingSubmission)
+                    .filter(PendingSubmission.id.in_(pending_ids))
+                    .order_by(PendingSubmission.received_time)
+                )
+                for pending in batch:
+                    self._save(session, pending)
+            return len(pending_ids)
+        finally:
+            session.close()
+
+    def _claim(self, session, limit) -> list:
+        table = PendingSubmission.__table__
+        abandoned = sa.and_(
+            table.c.status == 'processing',
+            table.c.claimed_time < sa.func.now() - CLAIM_TIMEOUT,
+        )
+        claimable = (
+            sa.select([table.c.id])
+            .where(sa.or_(table.c.status == 'queued', abandoned))
+            .order_by(table.c.received_time)
+            .limit(limit)
+            .with_for_update()
+        )
+        with session.begin():
+            return [
+                row.id for row in session.execute(
+                    table.update()
+                    .where(table.c.id.in_(claimable))
+                    .values(status='processing', claimed_time=sa.func.now())
+                    .returning(table.c.id)
+                )
+            ]
+
+    def _save(self, session, pending):
+        pending.processed_time = sa.func.now()
+        survey = pending.survey
+        data = dict(pending.submission_data)
+        # A retry gets the submission that was already saved
+        duplicate = duplicate_submission(session, survey, data)
+        if duplicate is not None:
+            pending.status = 'accepted'
+            pending.submission_id = duplicate.id
+            return
+        if pending.enumerator_user_id is not None:
+            data['enumerator'] = session.query(User).get(
+                pending.enumerator_user_id
+            )
+        try:
+            with session.begin_nested():
+                submission = save_submission(session, survey, data)
+        except sa.exc.OperationalError:
+            # e.g., the connection dropped. The batch stays claimed until the
+            # claim times out and another worker tries it again.
+            raise
+        except Exception as error:
+            duplicate = None
+            if isinstance(error, sa.exc.IntegrityError):
+                # ... including a retry that was saved in the meantime
+                duplicate = duplicate_submission(session, survey, data)
+            if duplicate is None:
+                pending.status = 'rejected'
+                pending.error = str(error) or type(error).__name__
+            else:
+                pending.status = 'accepted'
+                pending.submission_id = duplicate.id
+        else:
+            pending.status = 'accepted'
+            pending.submission_id = submission.id
+            if self.metrics is not None:
+                self.metrics.count_ingest('submission')
+
+
+class ReceiptResource(BaseResource):
+
+    """Restless resource for the receipts of queued submissions.
+
+    The receipt id is a random UUID that only the submitter gets, so anyone
+    with the id can see the outcome.
+    """
+
+    resource_type = PendingSubmission
+    default_sort_column_name = 'received_time'
+    objects_key = 'receipts'
+
+    http_methods = {
+        'detail': {
+            'GET': 'detail',
+        },
+    }
+
+    def is_authenticated(self):
+        """GET detail is allowed unauthenticated."""
+        return True
@@ -1,4 +1,6 @@
 """TornadoResource class for dokomoforms.models.node.Node subclasses."""
+import sqlalchemy as sa
+
 from dokomoforms.handlers.api.v0 import BaseResource
 from dokomoforms.models import (
     Node, Choice, construct_node
@@ -17,6 +19,15 @@ class NodeResource(BaseResource):
     default_sort_column_name = 'last_update_time'
     objects_key = 'nodes'
 
+    replica_views = frozenset({'list', 'detail'})
+
+    def _child_versions(self, node_id):
+        """The choices of a multiple choice question."""
+        return [
+            sa.select([sa.func.max(Choice.last_update_time), sa.func.count()])
+            .where(Choice.question_id == node_id)
+        ]
+
     def create(self):
         """Create a new node."""
         is_mc = self.data['type_constraint'] == 'multiple_choice'
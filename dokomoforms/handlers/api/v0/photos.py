@@ -11,6 +11,8 @@ class PhotoResource(BaseResource):
     default_sort_column_name = 'created_on'
     objects_key = 'photos'
 
+    replica_views = frozenset({'list', 'detail'})
+
     def is_authenticated(self):
         """Allow unauthenticated POSTs."""
         if self.request_method() == 'POST':
@@ -25,6 +27,9 @@ class PhotoResource(BaseResource):
 
         self.data['image'] = self.data['image'].encode()
         photo = add_new_photo_to_session(self.session, **self.data)
+        self.application.metrics.count_ingest(
+            'photo', len(self.data['image'])
+        )
         photo_dict = photo._asdict()
         del photo_dict['image']
         return photo_dict
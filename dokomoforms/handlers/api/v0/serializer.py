@@ -30,4 +30,4 @@ class ModelJSONSerializer(JSONSerializer):
         else:
             if content_type == 'csv':
                 return data['data']
-        return json.dumps(data, cls=ModelJSONEncoder).replace('</', '<\\/')
+        return json.dumps(data, cls=ModelJSONEncoder)
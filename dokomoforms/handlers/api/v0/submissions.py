@@ -1,22 +1,44 @@
 """TornadoResource class for dokomoforms.models.submission.Submission."""
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
 from contextlib import closing
 from csv import DictWriter
+from hashlib import sha256
 from io import StringIO
 from itertools import chain
+import json
+import uuid
 
 import restless.exceptions as exc
 
+import sqlalchemy as sa
+from sqlalchemy.exc import IntegrityError
+
 from dokomoforms.handlers.api.v0 import BaseResource
+from dokomoforms.handlers.api.v0.base import NOT_MODIFIED
 from dokomoforms.models import (
     Survey, Submission, User,
     construct_submission, construct_answer, Answer,
-    SurveyNode, skipped_required,
-    get_model
+    SurveyNode, skipped_required, submission_by_idempotency_key,
+    submission_changes, get_model
 )
 from dokomoforms.models.answer import ANSWER_TYPES
 from dokomoforms.exc import RequiredQuestionSkipped
 
 
+# The columns of the CSV export, one row per answer
+CSV_FIELDNAMES = (
+    'id', 'deleted', 'answer_number', 'submission_id', 'save_time',
+    'survey_id', 'survey_node_id', 'question_id', 'type_constraint',
+    'last_update_time', 'main_answer', 'response', 'response_type',
+    'metadata',
+)
+
+# The number of changes in a page of the change feed, by default and at most
+CHANGES_PAGE_SIZE = 100
+MAX_CHANGES_PAGE_SIZE = 1000
+
+
 def _create_answer(session, answer_dict) -> Answer:
     survey_node_id = answer_dict['survey_node_id']
     error = exc.BadRequest('survey_node not found: {}'.format(survey_node_id))
@@ -25,7 +47,69 @@ def _create_answer(session, answer_dict) -> Answer:
     return construct_answer(**answer_dict)
 
 
-def _create_submission(self, survey):
+def submission_idempotency_key(submission_data) -> str:
+    """The key that identifies retries of a submission, or None.
+
+    A client can send its own idempotency_key (the survey client sends a
+    UUID). Otherwise, a submission with a start_time gets a key derived from
+    the start_time, the submitter, and a hash of the answers.
+    """
+    key = submission_data.get('idempotency_key')
+    if key is not None:
+        return str(key)
+    if not submission_data.get('start_time'):
+        return None
+    content = json.dumps([
+        submission_data['start_time'],
+        submission_data.get('submitter_name', ''),
+        submission_data.get('submitter_email', ''),
+        submission_data.get('answers', []),
+    ], sort_keys=True)
+    return 'sha256:' + sha256(content.encode()).hexdigest()
+
+
+def duplicate_submission(session, survey, submission_data):
+    """The submission that submission_data is a retry of, or None."""
+    return submission_by_idempotency_key(
+        session, survey.id, submission_idempotency_key(submission_data)
+    )
+
+
+def encode_cursor(submission) -> str:
+    """The change feed cursor that resumes after this submission."""
+    position = '{} {}'.format(
+        submission.last_update_time.isoformat(), submission.id
+    )
+    return urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """The (last_update_time, id) of the submission a cursor resumes after.
+
+    :raises: ValueError if the cursor is malformed
+    """
+    position = urlsafe_b64decode(cursor.encode()).decode()
+    last_update_time, submission_id = position.split(' ')
+    return last_update_time, str(uuid.UUID(submission_id))
+
+
+def _change(submission) -> OrderedDict:
+    """A submission in the change feed. A deleted one is a tombstone."""
+    if not submission.deleted:
+        return submission._asdict()
+    return OrderedDict((
+        ('id', submission.id),
+        ('deleted', submission.deleted),
+        ('survey_id', submission.survey_id),
+        ('last_update_time', submission.last_update_time),
+    ))
+
+
+def _authorize_submission(self, survey):
+    """Check that the request may submit to the survey.
+
+    :return: the enumerator (a User), or None if nobody is logged in
+    """
     # Unauthenticated submissions are only allowed if the survey_type is
     # 'public'.
     authenticated = super(self.__class__, self).is_authenticated()
@@ -36,53 +120,84 @@ def _create_submission(self, survey):
             raise exc.Unauthorized()
 
     # If logged in, add enumerator
-    if self.current_user_model is not None:
-        try:
-            enumerator = self._get_model(
-                self.data['enumerator_user_id'], model_cls=User
-            )
-        except KeyError:
-            self.data['enumerator'] = self.current_user_model
-        else:
-            self.data['enumerator'] = enumerator
+    if self.current_user_model is None:
+        return None
+    try:
+        return self._get_model(
+            self.data['enumerator_user_id'], model_cls=User
+        )
+    except KeyError:
+        return self.current_user_model
 
-    self.data['survey'] = survey
 
-    with self.session.begin():
-        # create a list of Answer models
-        if 'answers' in self.data:
-            raw_answers = self.data['answers']
-            answers = [
-                _create_answer(self.session, answer) for answer in raw_answers
-            ]
-            self.data['answers'] = answers
+def save_submission(session, survey, submission_data) -> Submission:
+    """Add a submission to the session's current transaction.
 
-        self.data['submission_type'] = survey.survey_type + '_submission'
+    :param session: the SQLAlchemy session, in a transaction
+    :param survey: the Survey
+    :param submission_data: the submission from the client (not modified),
+                            plus the enumerator, if any
+    :return: the flushed Submission
+    :raises: restless.exceptions.BadRequest if an answer's survey_node does
+             not exist, dokomoforms.exc.RequiredQuestionSkipped,
+             sqlalchemy.exc.IntegrityError if a submission with the same
+             idempotency key exists (see duplicate_submission)
+    """
+    data = dict(submission_data, survey=survey)
+    data['idempotency_key'] = submission_idempotency_key(submission_data)
 
-        submission = construct_submission(**self.data)
+    # create a list of Answer models
+    if 'answers' in data:
+        raw_answers = data['answers']
+        answers = [
+            _create_answer(session, dict(answer)) for answer in raw_answers
+        ]
+        data['answers'] = answers
 
-        # add the answer models
-        # if 'answers' in self.data:
-        #    submission.answers = answers
+    data['submission_type'] = survey.survey_type + '_submission'
 
-        # add the submission
-        self.session.add(submission)
-        self.session.flush()
+    submission = construct_submission(**data)
 
-        for answer in submission.answers:
-            answer.main_answer = (
-                self.session
-                .query(ANSWER_TYPES[answer.answer_type].main_answer)
-                .filter_by(id=answer.id)
-                .scalar()
-            )
+    # add the submission
+    session.add(submission)
+    session.flush()
 
-        skipped_question = skipped_required(survey, submission.answers)
-        if skipped_question is not None:
-            raise RequiredQuestionSkipped(
-                '{} skipped'.format(skipped_question)
-            )
+    for answer in submission.answers:
+        answer.main_answer = (
+            session
+            .query(ANSWER_TYPES[answer.answer_type].main_answer)
+            .filter_by(id=answer.id)
+            .scalar()
+        )
 
+    skipped_question = skipped_required(survey, submission.answers)
+    if skipped_question is not None:
+        raise RequiredQuestionSkipped(
+            '{} skipped'.format(skipped_question)
+        )
+    return submission
+
+
+def _create_submission(self, survey):
+    enumerator = _authorize_submission(self, survey)
+    if enumerator is not None:
+        self.data['enumerator'] = enumerator
+
+    # A retry gets the submission that was already saved
+    duplicate = duplicate_submission(self.session, survey, self.data)
+    if duplicate is not None:
+        return duplicate
+    try:
+        with self.session.begin():
+            submission = save_submission(self.session, survey, self.data)
+    except IntegrityError:
+        # ... including a retry that was saved in the meantime
+        duplicate = duplicate_submission(self.session, survey, self.data)
+        if duplicate is None:
+            raise
+        return duplicate
+
+    self.application.metrics.count_ingest('submission')
     return submission
 
 
@@ -99,18 +214,33 @@ class SubmissionResource(BaseResource):
     default_sort_column_name = 'save_time'
     objects_key = 'submissions'
 
+    # Not changes, whose cursor must come from the primary
+    replica_views = frozenset({'list', 'detail'})
+
+    http_methods = {
+        'list': {
+            'GET': 'list',
+            'POST': 'create',
+            'PUT': 'update_list',
+            'DELETE': 'delete_list',
+        },
+        'detail': {
+            'GET': 'detail',
+            'POST': 'create_detail',
+            'PUT': 'update',
+            'DELETE': 'delete',
+        },
+        'changes': {
+            'GET': 'changes',
+        },
+    }
+
     def _csv(self, raw_answers) -> dict:
         """Return {'format': 'csv', 'data': <csv-formatted string>}."""
         answers = [answer._asdict('csv') for answer in raw_answers]
         dialect = self._query_arg('dialect', default='excel')
-        fieldnames = [
-            'id', 'deleted', 'answer_number', 'submission_id', 'save_time',
-            'survey_id', 'survey_node_id', 'question_id', 'type_constraint',
-            'last_update_time', 'main_answer', 'response', 'response_type',
-            'metadata'
-        ]
         with closing(StringIO()) as out:
-            dw = DictWriter(out, fieldnames=fieldnames, dialect=dialect)
+            dw = DictWriter(out, fieldnames=CSV_FIELDNAMES, dialect=dialect)
             dw.writeheader()
             dw.writerows(answers)
             return {'format': 'csv', 'data': out.getvalue()}
@@ -137,13 +267,59 @@ class SubmissionResource(BaseResource):
             return True
         return super().is_authenticated()
 
+    def _child_versions(self, submission_id):
+        """The answers."""
+        return [
+            sa.select([sa.func.max(Answer.last_update_time), sa.func.count()])
+            .where(Answer.submission_id == submission_id)
+        ]
+
     def detail(self, submission_id):
         """Allow CSV export of a single submission."""
         if self.content_type == 'csv':
+            if self._not_modified(submission_id):
+                return NOT_MODIFIED
             self._set_filename('submission_{}'.format(submission_id), 'csv')
+            cached = self._cached_response()
+            if cached is not None:
+                return cached
             return self._csv(self._get_model(submission_id).answers)
         return super().detail(submission_id)
 
+    def changes(self):
+        """The submissions that changed after the cursor argument.
+
+        The changes come oldest first, in pages of up to the limit argument,
+        with deleted submissions as tombstones (just the id, survey_id,
+        deleted and last_update_time). Send next_cursor back as the cursor
+        to get the next page; more is false once the feed has caught up.
+        Without a cursor, the feed starts from the beginning. The survey_id
+        argument limits the feed to one survey.
+
+        This view is not in replica_views, so the feed and its horizon
+        always come from the primary database.
+        """
+        limit = self._query_arg('limit', int, default=CHANGES_PAGE_SIZE)
+        if not 0 < limit <= MAX_CHANGES_PAGE_SIZE:
+            raise exc.BadRequest(
+                'limit must be between 1 and {}'.format(MAX_CHANGES_PAGE_SIZE)
+            )
+        cursor = self._query_arg('cursor')
+        after = None if cursor is None else decode_cursor(cursor)
+        submissions = submission_changes(
+            self.session, after, limit=limit + 1,
+            survey_id=self._query_arg('survey_id'),
+        ).all()
+        more = len(submissions) > limit
+        submissions = submissions[:limit]
+        if submissions:
+            cursor = encode_cursor(submissions[-1])
+        return OrderedDict((
+            ('next_cursor', cursor),
+            ('more', more),
+            ('submissions', [_change(sub) for sub in submissions]),
+        ))
+
     # POST /api/submissions/
     def create(self):
         """Create a new submission.
@@ -1,25 +1,40 @@
 """TornadoResource class for dokomoforms.models.survey.Survey."""
+from collections import OrderedDict
+from csv import writer as csv_writer
+from io import StringIO
 import os.path
 import datetime
 
 import restless.exceptions as exc
-from restless.constants import CREATED
+from restless.constants import ACCEPTED, CREATED
 
+import sqlalchemy as sa
 from sqlalchemy import cast, Date
+from sqlalchemy.orm import with_polymorphic
 from sqlalchemy.sql import func
 
+import tornado.gen
+
 from dokomoforms.exc import SurveyAccessForbidden
 from dokomoforms.handlers.api.v0 import BaseResource
+from dokomoforms.handlers.api.v0.base import STREAMED
+from dokomoforms.handlers.api.v0.ingest import enqueue_submission
 from dokomoforms.handlers.api.v0.submissions import (
     SubmissionResource, _create_submission
 )
 from dokomoforms.models import (
-    Survey, Submission, SubSurvey, Choice,
+    Survey, Submission, SubSurvey, Choice, SurveyNode, User,
     construct_survey, construct_survey_node, construct_bucket,
     administrator_filter, get_model,
-    Node, construct_node
+    Node, construct_node, Question, AnswerableSurveyNode,
+    wide_columns, wide_header, wide_export_query, fetch_batches,
+    change_horizon
+)
+from dokomoforms.models.util import estimate_count
+from dokomoforms.models.survey import (
+    _administrator_table, Bucket, MultipleChoiceBucket
 )
-from dokomoforms.models.survey import _administrator_table
+from dokomoforms.options import options
 
 
 # TODO: clean up this mess
@@ -80,6 +95,12 @@ class SurveyResource(BaseResource):
     default_sort_column_name = 'created_on'
     objects_key = 'surveys'
 
+    # Not changes, whose until must come from the primary
+    replica_views = frozenset({
+        'list', 'detail', 'list_submissions', 'stats', 'activity',
+        'activity_all',
+    })
+
     http_methods = {
         'list': {
             'GET': 'list',
@@ -107,7 +128,10 @@ class SurveyResource(BaseResource):
         },
         'submit': {
             'POST': 'submit'
-        }
+        },
+        'changes': {
+            'GET': 'changes'
+        },
     }
 
     def __init__(self, *args, **kwargs):
@@ -116,7 +140,10 @@ class SurveyResource(BaseResource):
         self.status_map['submit'] = CREATED
 
     def is_authenticated(self):
-        """GET detail is allowed unauthenticated."""
+        """GET detail and changes are allowed unauthenticated."""
+        if self.r_handler.__resource_view_type__ == 'changes':
+            # See _check_read_access
+            return True
         # TODO: always allowed unauthenticated?
         uri = self.request.uri
         uri_parts = uri.rstrip('/').split('/')
@@ -134,6 +161,46 @@ class SurveyResource(BaseResource):
                 return True
         return super().is_authenticated()
 
+    def _child_versions(self, survey_id):
+        """The versions of the survey's tree, plus the creator.
+
+        The tree is the survey nodes, nodes, choices, sub-surveys, and
+        buckets. All of the survey nodes in the tree (including those in
+        sub-surveys) share the survey's containing_id.
+        """
+        survey_nodes = (
+            sa.select([
+                SurveyNode.id, SurveyNode.node_id, SurveyNode.last_update_time
+            ])
+            .select_from(SurveyNode.__table__.join(
+                Survey.__table__,
+                SurveyNode.containing_survey_id == Survey.containing_id
+            ))
+            .where(Survey.id == survey_id)
+            .cte('survey_nodes')
+        )
+        versions = sa.union_all(
+            sa.select([survey_nodes.c.last_update_time]),
+            sa.select([Node.last_update_time])
+            .where(Node.id == survey_nodes.c.node_id),
+            sa.select([Choice.last_update_time])
+            .where(Choice.question_id == survey_nodes.c.node_id),
+            sa.select([SubSurvey.last_update_time])
+            .where(SubSurvey.parent_survey_node_id == survey_nodes.c.id),
+            sa.select([Bucket.last_update_time])
+            .where(
+                Bucket.sub_survey_parent_survey_node_id == survey_nodes.c.id
+            ),
+        ).alias('versions')
+        return [
+            sa.select([
+                func.max(versions.c.last_update_time), func.count()
+            ]),
+            sa.select([User.last_update_time])
+            .where(User.id == Survey.creator_id)
+            .where(Survey.id == survey_id),
+        ]
+
     def detail(self, survey_id):
         """Return the given survey.
 
@@ -142,18 +209,47 @@ class SurveyResource(BaseResource):
         be one of the survey's enumerators or an administrator.
         """
         result = super().detail(survey_id)
-        survey = self.session.query(Survey).get(survey_id)
+        self._check_read_access(self.session.query(Survey).get(survey_id))
+        return result
+
+    def _check_read_access(self, survey):
+        """Make sure the user can see the survey.
+
+        Anyone can see a public survey. Only administrators and the survey's
+        enumerators can see an enumerator-only survey.
+        """
         if survey.survey_type == 'public':
-            return result
+            return
         authenticated = super().is_authenticated(admin_only=False)
         if not authenticated:
             raise exc.Unauthorized()
         user = self.current_user_model
         if user.role == 'administrator':
-            return result
+            return
         if user not in survey.enumerators:
             raise SurveyAccessForbidden(survey.id)
-        return result
+
+    def changes(self, survey_id):
+        """The parts of the survey that changed since the since argument.
+
+        Returns flat lists of the survey nodes, nodes, choices, sub-surveys,
+        and buckets whose last_update_time is at or after since (or all of
+        them, without since), with the ids of the deleted ones in a separate
+        'deleted' object. Send the 'until' time back as since next time.
+        Models that were removed from the database (rather than marked
+        deleted) do not show up.
+
+        until is the change_horizon rather than the current time, since an
+        edit in a transaction that is still open gets an earlier
+        last_update_time than the time it commits. This view is not in
+        replica_views, so the changes and the horizon both come from the
+        primary database.
+        """
+        survey = self._get_model(survey_id)
+        self._check_read_access(survey)
+        since = self._query_arg('since')
+        until = change_horizon(self.session)
+        return _survey_changes(self.session, survey, since, until)
 
     def create(self):
         """Create a new survey.
@@ -174,11 +270,26 @@ class SurveyResource(BaseResource):
         return survey
 
     def submit(self, survey_id):
-        """Submit to a survey."""
-        return _create_submission(self, self._get_model(survey_id))
+        """Submit to a survey.
+
+        With options.write_behind_ingest, queue the submission and return a
+        receipt instead (see dokomoforms.handlers.api.v0.ingest).
+        """
+        survey = self._get_model(survey_id)
+        if options.write_behind_ingest:
+            # status_map is shared by every SurveyResource
+            self.status_map = dict(self.status_map, submit=ACCEPTED)
+            return enqueue_submission(self, survey)
+        return _create_submission(self, survey)
 
     def list_submissions(self, survey_id):
-        """List all submissions for a survey."""
+        """List all submissions for a survey.
+
+        With format=csv&layout=wide, stream one row per submission instead
+        (see dokomoforms.models.export).
+        """
+        if self.content_type == 'csv' and self._query_arg('layout') == 'wide':
+            return self._stream_wide_csv(survey_id)
         sub_resource = SubmissionResource()
         sub_resource.ref_rh = self.ref_rh
         sub_resource.request = self.request
@@ -195,15 +306,63 @@ class SurveyResource(BaseResource):
             )
             self._set_filename('survey_{}_submissions'.format(title), 'csv')
         else:
-            response['total_entries'] = (
-                self.session
-                .query(func.count(Submission.id))
-                .filter_by(survey_id=survey_id)
-                .scalar()
+            # The same ?count= as for the list (already checked)
+            count_mode = self._query_arg('count', default='exact')
+            total = self.session.query(Submission.id).filter_by(
+                survey_id=survey_id
             )
+            if count_mode == 'exact':
+                response['total_entries'] = (
+                    total.with_entities(func.count(Submission.id)).scalar()
+                )
+            elif count_mode == 'estimate':
+                response['total_entries'] = estimate_count(
+                    self.session, total
+                )
+            else:
+                response['total_entries'] = None
             response['survey_id'] = survey_id
         return response
 
+    @tornado.gen.coroutine
+    def _stream_wide_csv(self, survey_id):
+        """Write the wide export in batches of options.export_batch_size.
+
+        The rows come from a server-side cursor on a connection of its own,
+        since the session is shared by the requests that run while this one
+        waits for the client to read each batch.
+        """
+        survey = self._get_model(survey_id)
+        columns = wide_columns(self.session, survey)
+        dialect = self._query_arg('dialect', default='excel')
+        handler = self.ref_rh
+        handler.set_header('Content-Type', 'text/csv; charset=UTF-8')
+        self._set_filename(
+            'survey_{}_submissions_wide'.format(
+                survey.title[survey.default_language]
+            ),
+            'csv'
+        )
+        with StringIO() as out:
+            writer = csv_writer(out, dialect=dialect)
+            writer.writerow(wide_header(columns))
+            connection = self.session.bind.connect()
+            try:
+                batches = fetch_batches(
+                    connection, wide_export_query(survey, columns),
+                    options.export_batch_size
+                )
+                for rows in batches:
+                    writer.writerows(rows)
+                    handler.write(out.getvalue())
+                    out.seek(0)
+                    out.truncate()
+                    yield handler.flush()
+                handler.write(out.getvalue())
+            finally:
+                connection.close()
+        return STREAMED
+
     def stats(self, survey_id):
         """Get stats for a survey."""
         result = (
@@ -299,6 +458,170 @@ class SurveyResource(BaseResource):
     #     return data
 
 
+def _survey_change(survey) -> OrderedDict:
+    return OrderedDict((
+        ('id', survey.id),
+        ('deleted', survey.deleted),
+        ('languages', survey.languages),
+        ('title', OrderedDict(sorted(survey.title.items()))),
+        ('url_slug', survey.url_slug),
+        ('default_language', survey.default_language),
+        ('survey_type', survey.survey_type),
+        ('version', survey.version),
+        ('metadata', survey.survey_metadata),
+        ('last_update_time', survey.last_update_time),
+    ))
+
+
+def _survey_node_change(survey_node) -> OrderedDict:
+    result = OrderedDict((
+        ('id', survey_node.id),
+        ('node_id', survey_node.node_id),
+        ('node_number', survey_node.node_number),
+        ('type_constraint', survey_node.type_constraint),
+        ('root_survey_id', survey_node.root_survey_id),
+        ('sub_survey_id', survey_node.sub_survey_id),
+        ('logic', survey_node.logic),
+    ))
+    if isinstance(survey_node, AnswerableSurveyNode):
+        result['required'] = survey_node.required
+        result['allow_dont_know'] = survey_node.allow_dont_know
+    result['last_update_time'] = survey_node.last_update_time
+    return result
+
+
+def _node_change(node) -> OrderedDict:
+    result = OrderedDict((
+        ('id', node.id),
+        ('languages', node.languages),
+        ('title', node.title),
+        ('hint', node.hint),
+        ('type_constraint', node.type_constraint),
+        ('logic', node.logic),
+    ))
+    if isinstance(node, Question):
+        result['allow_multiple'] = node.allow_multiple
+        result['allow_other'] = node.allow_other
+    result['last_update_time'] = node.last_update_time
+    return result
+
+
+def _choice_change(choice) -> OrderedDict:
+    return OrderedDict((
+        ('id', choice.id),
+        ('question_id', choice.question_id),
+        ('choice_number', choice.choice_number),
+        ('choice_text', OrderedDict(sorted(choice.choice_text.items()))),
+        ('last_update_time', choice.last_update_time),
+    ))
+
+
+def _sub_survey_change(sub_survey) -> OrderedDict:
+    return OrderedDict((
+        ('id', sub_survey.id),
+        ('parent_survey_node_id', sub_survey.parent_survey_node_id),
+        ('sub_survey_number', sub_survey.sub_survey_number),
+        ('repeatable', sub_survey.repeatable),
+        ('last_update_time', sub_survey.last_update_time),
+    ))
+
+
+def _bucket_change(bucket) -> OrderedDict:
+    return OrderedDict((
+        ('id', bucket.id),
+        ('sub_survey_id', bucket.sub_survey_id),
+        ('bucket_type', bucket.bucket_type),
+        (
+            'bucket',
+            bucket.choice_id if isinstance(bucket, MultipleChoiceBucket)
+            else bucket.bucket
+        ),
+        ('last_update_time', bucket.last_update_time),
+    ))
+
+
+def _survey_changes(session, survey, since, until) -> OrderedDict:
+    """See SurveyResource.changes.
+
+    Every part of the survey tree shares the survey's containing_id, and
+    each query uses an index on (parent, last_update_time).
+    """
+    def changed(entity, query):
+        if since is None:
+            return query
+        # A change at exactly the previous until might not have been
+        # committed yet then
+        return query.filter(entity.last_update_time >= since)
+
+    containing_id = survey.containing_id
+    node_ids = (
+        session
+        .query(SurveyNode.node_id)
+        .filter(SurveyNode.containing_survey_id == containing_id)
+        .subquery()
+    )
+    sub_survey_ids = (
+        session
+        .query(SubSurvey.id)
+        .filter(SubSurvey.containing_survey_id == containing_id)
+        .subquery()
+    )
+    survey_node = with_polymorphic(SurveyNode, '*')
+    node = with_polymorphic(Node, '*')
+    bucket = with_polymorphic(Bucket, '*')
+    kinds = (
+        ('survey_nodes', _survey_node_change, changed(
+            survey_node,
+            session.query(survey_node)
+            .filter(survey_node.containing_survey_id == containing_id)
+            .order_by(survey_node.last_update_time)
+        )),
+        ('nodes', _node_change, changed(
+            node,
+            session.query(node)
+            .filter(node.id.in_(node_ids))
+            .order_by(node.last_update_time)
+        )),
+        ('choices', _choice_change, changed(
+            Choice,
+            session.query(Choice)
+            .filter(Choice.question_id.in_(node_ids))
+            .order_by(Choice.last_update_time)
+        )),
+        ('sub_surveys', _sub_survey_change, changed(
+            SubSurvey,
+            session.query(SubSurvey)
+            .filter(SubSurvey.containing_survey_id == containing_id)
+            .order_by(SubSurvey.last_update_time)
+        )),
+        ('buckets', _bucket_change, changed(
+            bucket,
+            session.query(bucket)
+            .filter(bucket.sub_survey_id.in_(sub_survey_ids))
+            .order_by(bucket.last_update_time)
+        )),
+    )
+
+    survey_changed = changed(
+        Survey, session.query(Survey.id).filter(Survey.id == survey.id)
+    ).first() is not None
+    result = OrderedDict((
+        ('survey_id', survey.id),
+        ('since', since),
+        ('until', until),
+        ('survey', _survey_change(survey) if survey_changed else None),
+    ))
+    deleted = OrderedDict()
+    for kind, as_change, query in kinds:
+        models = query.all()
+        result[kind] = [
+            as_change(model) for model in models if not model.deleted
+        ]
+        deleted[kind] = [model.id for model in models if model.deleted]
+    result['deleted'] = deleted
+    return result
+
+
 def get_survey_for_handler(tornado_handler, survey_id):
     """Maybe a handler needs a survey from the API."""
     survey_resource = SurveyResource()
@@ -1,9 +1,11 @@
 """TornadoResource class for dokomoforms.models.user.User."""
+import sqlalchemy as sa
 from sqlalchemy.orm.exc import NoResultFound
 
 from dokomoforms.handlers.api.v0 import BaseResource
 from dokomoforms.exc import UserRequiresEmailError
 from dokomoforms.models import User, Email, Survey, construct_user, get_model
+from dokomoforms.models.survey import _administrator_table, _enumerator_table
 
 
 class UserResource(BaseResource):
@@ -14,6 +16,29 @@ class UserResource(BaseResource):
     default_sort_column_name = 'name'
     objects_key = 'users'
 
+    replica_views = frozenset({'list', 'detail'})
+
+    def _child_versions(self, user_id):
+        """The e-mail addresses and the survey lists.
+
+        The survey lists live in association tables without a
+        last_update_time, so the survey ids themselves go into the ETag.
+        """
+        enumerator_survey_id = _enumerator_table.c.enumerator_only_survey_id
+        return [
+            sa.select([sa.func.max(Email.last_update_time), sa.func.count()])
+            .where(Email.user_id == user_id),
+            sa.select([enumerator_survey_id])
+            .where(_enumerator_table.c.user_id == user_id)
+            .order_by(enumerator_survey_id),
+            sa.select([Survey.id])
+            .where(Survey.creator_id == user_id)
+            .order_by(Survey.id),
+            sa.select([_administrator_table.c.survey_id])
+            .where(_administrator_table.c.user_id == user_id)
+            .order_by(_administrator_table.c.survey_id),
+        ]
+
     def _survey(self, survey_id: str) -> Survey:
         return get_model(self.session, Survey, survey_id)
 
@@ -0,0 +1,263 @@
+"""In-process metrics, served in the Prometheus text format at /metrics.
+
+Application.metrics collects everything in memory as requests finish, so
+each server process reports its own numbers.
+"""
+from bisect import bisect_left
+from collections import Counter, defaultdict
+import ipaddress
+from timeit import default_timer
+
+from sqlalchemy.pool import QueuePool
+
+import tornado.ioloop
+import tornado.web
+
+from dokomoforms.handlers.util import BaseHandler
+from dokomoforms.models import Administrator
+from dokomoforms.options import options
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+
+class Histogram:
+
+    """Counts observations in cumulative buckets, like Prometheus does."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """Create an empty histogram with the given (sorted) upper bounds."""
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        """Add an observation."""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self) -> int:
+        """The number of observations."""
+        return sum(self.counts)
+
+    def cumulative(self):
+        """Generate (upper bound, observations up to that bound) pairs."""
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield bound, total
+
+
+def _labels(**labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(
+            key,
+            str(value)
+            .replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+        ) for key, value in sorted(labels.items())
+    ) + '}'
+
+
+class _Writer:
+
+    """Builds the lines of the Prometheus text format."""
+
+    def __init__(self):
+        self.lines = []
+
+    def header(self, name, kind, description):
+        self.lines.append('# HELP {} {}'.format(name, description))
+        self.lines.append('# TYPE {} {}'.format(name, kind))
+
+    def sample(self, name, value, **labels):
+        self.lines.append('{}{} {}'.format(name, _labels(**labels), value))
+
+    def histogram(self, name, histogram, **labels):
+        for bound, count in histogram.cumulative():
+            self.sample(name + '_bucket', count, le=bound, **labels)
+        self.sample(name + '_sum', histogram.sum, **labels)
+        self.sample(name + '_count', histogram.count, **labels)
+
+    def text(self) -> str:
+        return '\n'.join(self.lines) + '\n'
+
+
+class Metrics:
+
+    """The metrics of one server process.
+
+    Requests get recorded by Application.log_request. Everything else is
+    read when the metrics get rendered.
+    """
+
+    def __init__(self):
+        """Start with no observations."""
+        self.latency = defaultdict(Histogram)
+        self.responses = Counter()
+        self.ingested = Counter()
+        self.ingested_bytes = Counter()
+        self.ioloop_lag = Histogram(LAG_BUCKETS)
+        self.last_ioloop_lag = 0.0
+        self._lag_interval = None
+
+    def observe_request(self, route: str, status: int, seconds: float):
+        """Record a finished request."""
+        self.latency[route].observe(seconds)
+        self.responses[route, status] += 1
+
+    def count_ingest(self, kind: str, num_bytes: int=None):
+        """Record something uploaded by a client, e.g. a 'submission'."""
+        self.ingested[kind] += 1
+        if num_bytes is not None:
+            self.ingested_bytes[kind] += num_bytes
+
+    def monitor_ioloop(self, interval: float, io_loop=None):
+        """Measure how late the IOLoop runs a callback every interval seconds.
+
+        A busy or blocked IOLoop runs callbacks late, and every request on it
+        waits that long.
+        """
+        if interval <= 0:
+            return
+        self._lag_interval = interval
+        io_loop = io_loop or tornado.ioloop.IOLoop.current()
+        self._schedule_lag_check(io_loop)
+
+    def _schedule_lag_check(self, io_loop):
+        expected = default_timer() + self._lag_interval
+        io_loop.call_later(
+            self._lag_interval, self._check_lag, io_loop, expected
+        )
+
+    def _check_lag(self, io_loop, expected):
+        lag = max(default_timer() - expected, 0.0)
+        self.last_ioloop_lag = lag
+        self.ioloop_lag.observe(lag)
+        self._schedule_lag_check(io_loop)
+
+    def render(self, application) -> str:
+        """The metrics in the Prometheus text format."""
+        out = _Writer()
+
+        name = 'dokomoforms_request_duration_seconds'
+        out.header(name, 'histogram', 'Request latency by route.')
+        for route in sorted(self.latency):
+            out.histogram(name, self.latency[route], route=route)
+
+        name = 'dokomoforms_responses_total'
+        out.header(name, 'counter', 'Responses by route and status code.')
+        for (route, status), count in sorted(self.responses.items()):
+            out.sample(name, count, route=route, status=status)
+
+        name = 'dokomoforms_ingested_total'
+        out.header(name, 'counter', 'Submissions and photos received.')
+        for kind in ('submission', 'photo'):
+            out.sample(name, self.ingested[kind], kind=kind)
+        name = 'dokomoforms_ingested_bytes_total'
+        out.header(name, 'counter', 'Bytes of photos received.')
+        out.sample(name, self.ingested_bytes['photo'], kind='photo')
+
+        self._render_caches(out, application)
+        self._render_pools(out, application)
+
+        if self._lag_interval is not None:
+            name = 'dokomoforms_ioloop_lag_seconds'
+            out.header(name, 'histogram', 'How late the IOLoop runs timers.')
+            out.histogram(name, self.ioloop_lag)
+            name = 'dokomoforms_ioloop_last_lag_seconds'
+            out.header(name, 'gauge', 'The most recent IOLoop lag.')
+            out.sample(name, self.last_ioloop_lag)
+
+        return out.text()
+
+    def _render_caches(self, out, application):
+        caches = (
+            ('response', application.response_cache),
+            ('facility', application.facility_cache),
+        )
+        for suffix, kind, description in (
+            ('hits_total', 'counter', 'Cache lookups that found an item.'),
+            ('misses_total', 'counter', 'Cache lookups that found nothing.'),
+            ('hit_ratio', 'gauge', 'The fraction of lookups that hit.'),
+            ('items', 'gauge', 'The number of items in the cache.'),
+        ):
+            name = 'dokomoforms_cache_' + suffix
+            out.header(name, kind, description)
+            for cache_name, cache in caches:
+                value = {
+                    'hits_total': cache.hits,
+                    'misses_total': cache.misses,
+                    'hit_ratio': cache.hit_ratio,
+                    'items': len(cache),
+                }[suffix]
+                out.sample(name, value, cache=cache_name)
+
+    def _render_pools(self, out, application):
+        # A session can be bound to an Engine or to a Connection
+        sessions = [('primary', application.session)]
+        if application.has_replica:
+            sessions.append(('replica', application.replica_session))
+        pools = [
+            (database, session.bind.engine.pool)
+            for database, session in sessions
+            if isinstance(session.bind.engine.pool, QueuePool)
+        ]
+        for suffix, description in (
+            ('size', 'The number of connections the pool keeps open.'),
+            ('checked_out', 'Connections in use.'),
+            ('overflow', 'Connections open beyond the pool size.'),
+        ):
+            name = 'dokomoforms_db_pool_' + suffix
+            out.header(name, 'gauge', description)
+            for database, pool in pools:
+                value = {
+                    'size': pool.size,
+                    'checked_out': pool.checkedout,
+                    # QueuePool counts up from -size
+                    'overflow': lambda: max(pool.overflow(), 0),
+                }[suffix]()
+                out.sample(name, value, database=database)
+
+
+class MetricsHandler(BaseHandler):
+
+    """GET /metrics.
+
+    Allowed for administrators, and for anyone connecting from the loopback
+    interface if options.metrics_local is set (e.g. a Prometheus server on
+    the same host). A request that a proxy on the same host forwarded also
+    comes from the loopback interface, so a request with a proxy header is
+    not local.
+    """
+
+    _proxy_headers = ('X-Real-IP', 'X-Forwarded-For')
+
+    def _allowed(self) -> bool:
+        proxied = any(
+            header in self.request.headers for header in self._proxy_headers
+        )
+        if options.metrics_local and not proxied:
+            try:
+                address = ipaddress.ip_address(self.request.remote_ip)
+            except ValueError:  # pragma: no cover
+                pass
+            else:
+                if address.is_loopback:
+                    return True
+        return isinstance(self.current_user_model, Administrator)
+
+    def get(self):
+        """The metrics of this server process."""
+        if not self._allowed():
+            raise tornado.web.HTTPError(403)
+        self.set_header('Content-Type', CONTENT_TYPE)
+        self.set_header('Cache-Control', 'no-cache')
+        self.write(self.application.metrics.render(self.application))
@@ -0,0 +1,96 @@
+"""Profiling single requests with cProfile.
+
+An administrator can ask for a profile of a request with the X-Profile: 1
+header (or the profile=1 query argument). Setting options.profile_sample_rate
+also profiles that fraction of all requests. The stats go to a .pstats file
+in options.profile_dir (for pstats, snakeviz, flameprof, etc.), and only the
+newest options.profile_keep files are kept.
+
+cProfile can only profile one thing at a time, so a request that starts while
+another one is being profiled does not get profiled. Whatever else the
+IOLoop runs while a profiled request waits (e.g., for an HTTP fetch) shows up
+in the profile as well.
+"""
+import cProfile
+import datetime
+import os
+from random import random
+import uuid
+
+from dokomoforms.options import options
+
+
+PROFILE_EXTENSION = '.pstats'
+
+_active = None
+
+
+def profile_requested(value: str) -> bool:
+    """Whether an X-Profile header or profile argument asks for a profile."""
+    return value.strip().lower() in {'1', 'true', 'yes'}
+
+
+def profile_sampled() -> bool:
+    """Whether to profile a request, given options.profile_sample_rate."""
+    rate = options.profile_sample_rate
+    return rate > 0 and random() < rate
+
+
+def profile_path(file_name: str) -> str:
+    """The path of a profile in options.profile_dir."""
+    return os.path.join(options.profile_dir, file_name)
+
+
+def profile_file_names() -> list:
+    """The names of the saved profiles, newest first."""
+    try:
+        names = os.listdir(options.profile_dir)
+    except FileNotFoundError:
+        return []
+    return sorted(
+        (name for name in names if name.endswith(PROFILE_EXTENSION)),
+        reverse=True,
+    )
+
+
+class RequestProfiler:
+
+    """Profiles one request and saves the stats in options.profile_dir."""
+
+    def __init__(self, route: str):
+        """Name the profile after the time and the route of the request.
+
+        The file names sort by time.
+        """
+        self.file_name = '{}-{}-{}{}'.format(
+            datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S%f'),
+            route, uuid.uuid4().hex[:8], PROFILE_EXTENSION,
+        )
+        self.profile = cProfile.Profile()
+
+    def start(self) -> bool:
+        """Start profiling, unless another request is being profiled.
+
+        :return: whether profiling started
+        """
+        global _active
+        if _active is not None:
+            return False
+        _active = self
+        self.profile.enable()
+        return True
+
+    def stop(self):
+        """Stop profiling, save the stats, and delete the oldest profiles."""
+        global _active
+        if _active is not self:
+            return
+        self.profile.disable()
+        _active = None
+        os.makedirs(options.profile_dir, exist_ok=True)
+        self.profile.dump_stats(profile_path(self.file_name))
+        for old_name in profile_file_names()[max(options.profile_keep, 1):]:
+            try:
+                os.remove(profile_path(old_name))
+            except FileNotFoundError:  # pragma: no cover
+                pass
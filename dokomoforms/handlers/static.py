@@ -0,0 +1,153 @@
+"""Static file serving."""
+import hashlib
+import logging
+import mimetypes
+import os.path
+
+import tornado.web
+
+from dokomoforms.handlers.util import BaseHandler, accepted_encodings
+from dokomoforms.options import options
+
+
+class PrecompressedStaticFileHandler(tornado.web.StaticFileHandler):
+
+    """Serve precompressed copies of static files when possible.
+
+    The build can write compressed siblings next to a static file (e.g.
+    bundle.js.br and bundle.js.gz next to bundle.js). If the client accepts
+    one of their encodings, the sibling gets served as is so that nothing
+    has to be compressed per request. Brotli is preferred over gzip.
+    """
+
+    # (Content-Encoding, file extension) in order of preference
+    precompressed_encodings = (('br', '.br'), ('gzip', '.gz'))
+
+    content_encoding = None
+
+    def validate_absolute_path(self, root, absolute_path):
+        """Swap in a compressed sibling of the requested file, if any."""
+        absolute_path = super().validate_absolute_path(root, absolute_path)
+        if absolute_path is None:
+            return None
+        self.uncompressed_path = absolute_path
+        accepted = accepted_encodings(self.request)
+        for encoding, extension in self.precompressed_encodings:
+            if encoding not in accepted:
+                continue
+            compressed_path = absolute_path + extension
+            if os.path.isfile(compressed_path):
+                self.content_encoding = encoding
+                return compressed_path
+        return absolute_path
+
+    def get_content_type(self):
+        """Use the content type of the uncompressed file."""
+        mime_type, encoding = mimetypes.guess_type(self.uncompressed_path)
+        return mime_type
+
+    def set_extra_headers(self, path):
+        """Set Content-Encoding for compressed files.
+
+        Responses vary with Accept-Encoding. The GZipContentEncoding
+        transform adds that header when response compression is on.
+        """
+        if self.content_encoding is not None:
+            self.set_header('Content-Encoding', self.content_encoding)
+        if not options.compress_response:
+            self.set_header('Vary', 'Accept-Encoding')
+
+
+class OfflineManifest:
+
+    """The application cache manifest of the survey app.
+
+    The entries come from static/src/survey/cache.appcache. Each entry under
+    /static/dist/ gets a comment with the content hash of its file, and the
+    $version in the manifest becomes a hash of all the entries. The manifest
+    only changes when an asset does, and the browser only downloads the
+    assets whose content changed (the others revalidate with the same ETag,
+    since StaticFileHandler uses the same hash).
+    """
+
+    template = os.path.join('src', 'survey', 'cache.appcache')
+
+    def __init__(self, static_path: str):
+        """Hash static/dist and render the manifest.
+
+        :param static_path: the static_path setting of the Application
+        """
+        self.static_path = static_path
+        self.hashes = self.index(static_path)
+        self.version, self.text = self.render()
+
+    @staticmethod
+    def index(static_path: str) -> dict:
+        """The content hash of every file in static/dist, by URL.
+
+        Compressed siblings are served in place of the files next to them,
+        so they are left out.
+        """
+        compressed = tuple(
+            extension for encoding, extension in
+            PrecompressedStaticFileHandler.precompressed_encodings
+        )
+        hashes = {}
+        dist_path = os.path.join(static_path, 'dist')
+        for directory, _, file_names in os.walk(dist_path):
+            for file_name in file_names:
+                if file_name.endswith(compressed):
+                    continue
+                path = os.path.join(directory, file_name)
+                relative_path = os.path.relpath(path, static_path)
+                url = '/static/' + relative_path.replace(os.path.sep, '/')
+                hashes[url] = (
+                    tornado.web.StaticFileHandler.get_content_version(path)
+                )
+        return hashes
+
+    def render(self) -> tuple:
+        """The version and the text of the manifest."""
+        with open(os.path.join(self.static_path, self.template)) as f:
+            lines = f.read().splitlines()
+        output = []
+        entries = []
+        missing = []
+        for line in lines:
+            entry = line.strip()
+            if entry.startswith('/static/dist/'):
+                content_hash = self.hashes.get(entry)
+                if content_hash is None:
+                    missing.append(entry)
+                    content_hash = 'missing'
+                output.append('# ' + content_hash)
+                entries.append('{} {}'.format(entry, content_hash))
+            output.append(line)
+        if missing:
+            logging.warning(
+                'The offline manifest lists %d files that are not in'
+                ' static/dist (has the front end been built?): %s',
+                len(missing), ', '.join(missing)
+            )
+        version = hashlib.md5('\n'.join(entries).encode()).hexdigest()
+        text = '\n'.join(output).replace('$version', version) + '\n'
+        return version, text
+
+
+class OfflineManifestHandler(BaseHandler):
+
+    """GET /offline.appcache.
+
+    Application.offline_manifest is built once at startup, or on every
+    request in debug mode (when the assets can be rebuilt at any time).
+    """
+
+    def get(self):
+        """The manifest, which browsers should always revalidate."""
+        if self.settings.get('debug'):  # pragma: no cover
+            manifest = OfflineManifest(self.settings['static_path'])
+        else:
+            manifest = self.application.offline_manifest
+        self.set_header('Content-Type', 'text/cache-manifest')
+        self.set_header('Cache-Control', 'no-cache')
+        self.write(manifest.text)
@@ -1,16 +1,25 @@
 """Admin view handlers."""
-from dokomoforms.models import generate_question_stats
+import os.path
+
+import tornado.web
+
+from dokomoforms.models import generate_question_stats, slow_queries
 from dokomoforms.models.answer import ANSWER_TYPES
-from dokomoforms.handlers.util import BaseHandler, authenticated_admin
+from dokomoforms.handlers.util import (
+    BaseHandler, authenticated_admin, READ_ONLY_METHODS
+)
 from dokomoforms.handlers.api.v0 import (
     get_survey_for_handler, get_submission_for_handler
 )
+from dokomoforms.handlers.profiling import profile_file_names, profile_path
 
 
 class AdminHomepageHandler(BaseHandler):
 
     """The endpoint for the main Administrator interface."""
 
+    replica_methods = READ_ONLY_METHODS
+
     @authenticated_admin
     def get(self):
         """GET the admin interface."""
@@ -21,6 +30,8 @@ class ViewSurveyHandler(BaseHandler):
 
     """The endpoint for getting a single survey's admin page."""
 
+    replica_methods = READ_ONLY_METHODS
+
     @authenticated_admin
     def get(self, survey_id: str):
         """GET the admin page for a survey."""
@@ -36,6 +47,8 @@ class ViewSurveyDataHandler(BaseHandler):
 
     """The endpoint for getting a single survey's data page."""
 
+    replica_methods = READ_ONLY_METHODS
+
     def _get_map_data(self, survey_nodes):
         for survey_node in survey_nodes:
             if survey_node.type_constraint not in {'location', 'facility'}:
@@ -96,6 +109,8 @@ class ViewSubmissionHandler(BaseHandler):
 
     """The endpoint for viewing a submission."""
 
+    replica_methods = READ_ONLY_METHODS
+
     @authenticated_admin
     def get(self, submission_id: str):
         """GET the visualization page."""
@@ -110,6 +125,8 @@ class ViewUserAdminHandler(BaseHandler):
 
     """The endpoint for getting the user administration admin page."""
 
+    replica_methods = READ_ONLY_METHODS
+
     @authenticated_admin
     def get(self):
         """GET the user admin page."""
@@ -118,3 +135,52 @@ class ViewUserAdminHandler(BaseHandler):
         self.render(
             'view_user_admin.html'
         )
+
+
+class ProfileListHandler(BaseHandler):
+
+    """The endpoint for listing the saved request profiles.
+
+    See dokomoforms.handlers.profiling.
+    """
+
+    @authenticated_admin
+    def get(self):
+        """GET the file names of the profiles, newest first."""
+        self.write({'profiles': profile_file_names()})
+
+
+class ProfileHandler(BaseHandler):
+
+    """The endpoint for downloading a request profile."""
+
+    @authenticated_admin
+    def get(self, file_name: str):
+        """GET the .pstats file."""
+        path = profile_path(file_name)
+        if not os.path.isfile(path):
+            raise tornado.web.HTTPError(404)
+        with open(path, 'rb') as profile_file:
+            stats = profile_file.read()
+        self.set_header('Content-Type', 'application/octet-stream')
+        self.set_header(
+            'Content-Disposition', 'attachment; filename="{}"'.format(
+                file_name
+            )
+        )
+        self.write(stats)
+
+
+class SlowQueriesHandler(BaseHandler):
+
+    """The endpoint for the slow query aggregates of this server process.
+
+    See dokomoforms.models.instrumentation.SlowQueryLog.
+    """
+
+    @authenticated_admin
+    def get(self):
+        """GET the slow statements, by total time."""
+        self.write({
+            'slow_queries': [query.as_dict() for query in slow_queries.worst()]
+        })
@@ -41,12 +41,16 @@ class Enumerate(BaseHandler):
         except SurveyAccessForbidden:
             raise tornado.web.HTTPError(403)
 
-        # pass in the revisit url
+        # pass in the facilities url
+        if options.facility_proxy:
+            revisit_url = self.application._api_root_path + '/facilities'
+        else:
+            revisit_url = options.revisit_url
         self.render(
             'view_enumerate.html',
             current_user_model=self.current_user_model,
             survey=survey,
-            revisit_url=options.revisit_url
+            revisit_url=revisit_url
         )
 
 
@@ -1,5 +1,10 @@
 """Useful reusable functions for handlers, plus the BaseHandler."""
+from collections import OrderedDict
 from functools import wraps
+import gzip
+from io import BytesIO
+from time import time
+import uuid
 
 import urllib.parse as urlparse
 from urllib.parse import urlencode
@@ -10,8 +15,17 @@ from sqlalchemy.orm.exc import NoResultFound
 import tornado.web
 from tornado.escape import to_unicode, json_encode
 
-from dokomoforms.models import User, Administrator
+from dokomoforms.models import (
+    User, Administrator, QueryStats, activate_query_stats, active_query_stats
+)
 from dokomoforms.models.survey import most_recent_surveys
+from dokomoforms.handlers.profiling import (
+    RequestProfiler, profile_requested, profile_sampled
+)
+from dokomoforms.options import options
+
+
+READ_ONLY_METHODS = frozenset({'GET', 'HEAD'})
 
 
 def auth_redirect(self):
@@ -27,6 +41,145 @@ def auth_redirect(self):
     return
 
 
+def accepted_encodings(request) -> set:
+    """The content codings that the client accepts.
+
+    Parses the Accept-Encoding header, leaving out codings with q=0.
+
+    :param request: the tornado.httputil.HTTPServerRequest
+    :return: a set of lowercase coding names like {'gzip', 'br'}
+    """
+    accepted = set()
+    for coding in request.headers.get('Accept-Encoding', '').split(','):
+        name, *parameters = coding.split(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        for parameter in parameters:
+            key, _, value = parameter.partition('=')
+            if key.strip() == 'q':
+                try:
+                    if float(value) == 0:
+                        break
+                except ValueError:
+                    break
+        else:
+            accepted.add(name)
+    return accepted
+
+
+def gzip_compress(data: bytes) -> bytes:
+    """Gzip the given bytes at options.compression_level."""
+    return gzip.compress(data, compresslevel=options.compression_level)
+
+
+class LRUCache:
+
+    """A small least-recently-used cache.
+
+    Holds at most max_size items. A max_size of 0 disables the cache. Counts
+    the hits and misses of get for the metrics.
+    """
+
+    def __init__(self, max_size: int):
+        """Create an empty cache holding at most max_size items."""
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Get an item, marking it as recently used."""
+        try:
+            self._items.move_to_end(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return self._items[key]
+
+    @property
+    def hit_ratio(self) -> float:
+        """The fraction of calls to get that found an item (0 if none)."""
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0.0
+        return self.hits / lookups
+
+    def __setitem__(self, key, value):
+        """Add an item, evicting the least recently used if necessary."""
+        if self.max_size <= 0:
+            return
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def __contains__(self, key):
+        """Whether the key is in the cache (without marking it as used)."""
+        return key in self._items
+
+    def __len__(self):
+        """The number of items in the cache."""
+        return len(self._items)
+
+    def values(self) -> list:
+        """The items in the cache (without marking them as used)."""
+        return list(self._items.values())
+
+    def clear(self):
+        """Empty the cache."""
+        self._items.clear()
+
+
+class GZipContentEncoding(tornado.web.GZipContentEncoding):
+
+    """Gzip compressible responses larger than options.compression_threshold.
+
+    Tornado's own transform compresses everything longer than 5 bytes at
+    the slowest compression level. Small responses barely shrink, so this
+    leaves them alone and uses options.compression_level for the rest.
+    """
+
+    def __init__(self, request):
+        """Compress if the client accepts gzip."""
+        super().__init__(request)
+        self._gzipping = 'gzip' in accepted_encodings(request)
+        self.MIN_LENGTH = options.compression_threshold
+
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        """Decide whether to compress, then compress the first chunk."""
+        vary = headers.get('Vary')
+        if vary is None:
+            headers['Vary'] = 'Accept-Encoding'
+        else:
+            headers['Vary'] = '{}, Accept-Encoding'.format(to_unicode(vary))
+        if self._gzipping:
+            ctype = to_unicode(headers.get('Content-Type', '')).split(';')[0]
+            self._gzipping = (
+                self._compressible_type(ctype) and
+                (not finishing or len(chunk) >= self.MIN_LENGTH) and
+                'Content-Encoding' not in headers
+            )
+        if not self._gzipping:
+            return status_code, headers, chunk
+        headers['Content-Encoding'] = 'gzip'
+        self._gzip_value = BytesIO()
+        self._gzip_file = gzip.GzipFile(
+            mode='w', fileobj=self._gzip_value,
+            compresslevel=options.compression_level
+        )
+        chunk = self.transform_chunk(chunk, finishing)
+        if 'Content-Length' in headers:
+            # With a single chunk the new length is known. Otherwise fall
+            # back to chunked encoding.
+            if finishing:
+                headers['Content-Length'] = str(len(chunk))
+            else:
+                del headers['Content-Length']
+        return status_code, headers, chunk
+
+
 def authenticated_admin(method):
     """A copy of tornado.web.authenticated for Administrator access."""
     @wraps(method)
@@ -49,18 +202,140 @@ class BaseHandler(tornado.web.RequestHandler):
     """The base class for handlers.
 
     Makes the database session and current user available.
+
+    Requests using one of the replica_methods read from the replica database
+    (if there is one). Any other request makes the client read from the
+    primary database for the next options.read_your_writes_window seconds so
+    that it sees its own writes.
     """
 
     num_surveys_for_menu = 20
 
+    replica_methods = frozenset()
+
+    def initialize(self):
+        """Identify the request, count its SQL statements, and maybe profile.
+
+        The request ID comes from the X-Request-Id header (e.g., set by a
+        proxy) if there is one, and goes back in the X-Request-Id response
+        header.
+
+        See dokomoforms.models.instrumentation. In debug mode, statements that
+        repeat more than options.n_plus_one_threshold times get a warning.
+
+        See dokomoforms.handlers.profiling. The X-Profile response header
+        gives the URL of the profile.
+        """
+        self.request_id = (
+            self.request.headers.get('X-Request-Id') or uuid.uuid4().hex
+        )
+        self.set_header('X-Request-Id', self.request_id)
+
+        self.query_stats = None
+        if options.query_stats:
+            threshold = None
+            if options.debug:
+                threshold = options.n_plus_one_threshold
+            self.query_stats = QueryStats(self.route_name, threshold)
+        activate_query_stats(self.query_stats)
+
+        self.profiler = None
+        if self._wants_profile():
+            profiler = RequestProfiler(self.route_name)
+            if profiler.start():
+                self.profiler = profiler
+                self.set_header('X-Profile', self.reverse_url(
+                    'admin_profile', profiler.file_name
+                ))
+
+    def _wants_profile(self) -> bool:
+        """Whether an administrator asked for a profile, or it's sampled."""
+        requested = self.request.headers.get(
+            'X-Profile', self.get_query_argument('profile', '')
+        )
+        if profile_requested(requested):
+            return isinstance(self.current_user_model, Administrator)
+        return profile_sampled()
+
+    def _stop_profiling(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+
+    @property
+    def route_name(self) -> str:
+        """The name of the URL this handler serves (or the class name)."""
+        return self.application.route_name(type(self))
+
+    def flush(self, include_footers=False, callback=None):
+        """Add the Server-Timing header before the headers get sent."""
+        if self.query_stats is not None and not self._headers_written:
+            self.set_header('Server-Timing', self._server_timing())
+        return super().flush(include_footers, callback)
+
+    def _server_timing(self) -> str:
+        stats = self.query_stats
+        template = 'db;dur={:.1f};desc="{} queries, {} rows", app;dur={:.1f}'
+        return template.format(
+            stats.milliseconds, stats.queries, stats.rows,
+            self.request.request_time() * 1000,
+        )
+
+    def on_connection_close(self):
+        """Stop profiling if the client goes away."""
+        self._stop_profiling()
+        super().on_connection_close()
+
+    def on_finish(self):
+        """Save the profile and stop counting SQL statements.
+
+        Application.log_request has already logged the request (with the SQL
+        statistics) by now.
+        """
+        self._stop_profiling()
+        stats = self.query_stats
+        if stats is not None and active_query_stats() is stats:
+            activate_query_stats(None)
+
     @property
     def session(self):
         """The SQLAlchemy session for interacting with the models.
 
         :return: the SQLAlchemy session
         """
+        if self._reads_from_replica():
+            return self.application.replica_session
         return self.application.session
 
+    def _reads_from_replica(self) -> bool:
+        """Whether this request should use the replica database."""
+        if not self.application.has_replica:
+            return False
+        if self.request.method not in self.replica_methods:
+            return False
+        primary_until = self.get_cookie('read_primary_until')
+        if primary_until is not None:
+            try:
+                return time() >= float(primary_until)
+            except ValueError:
+                pass
+        return True
+
+    def _start_read_your_writes_window(self):
+        """Make this client read from the primary for a little while."""
+        primary_until = time() + options.read_your_writes_window
+        self.set_cookie(
+            'read_primary_until', str(primary_until), expires=primary_until
+        )
+
+    @property
+    def cookie_user_id(self):
+        """The user id in the session cookie (without querying the user)."""
+        current_user_id = self._current_user_cookie()
+        if current_user_id:
+            return to_unicode(current_user_id)
+        return None
+
     @property
     def current_user_model(self):
         """Return the current logged in User, or None."""
@@ -120,11 +395,15 @@ class BaseHandler(tornado.web.RequestHandler):
     def prepare(self):
         """Default behavior before any HTTP method.
 
-        By default, just sets up the XSRF token.
+        By default, sets up the XSRF token and, if this request might write
+        to the database, starts the read-your-writes window.
 
         """
         # Just accessing the token makes the handler send it to the browser
         self.xsrf_token
+        writes = self.request.method not in {'GET', 'HEAD', 'OPTIONS'}
+        if writes and self.application.has_replica:
+            self._start_read_your_writes_window()
 
     def get(self, *args, **kwargs):
         """404 unless this method is overridden.
@@ -227,7 +506,23 @@ class BaseHandler(tornado.web.RequestHandler):
 
 class BaseAPIHandler(BaseHandler):
 
-    """The Tornado handler class for API resource classes."""
+    """The Tornado handler class for API resource classes.
+
+    A GET or HEAD of one of the replica_views of the resource (see
+    dokomoforms.handlers.api.v0.BaseResource) reads from the replica
+    database. Every other API request, and every handler that is not a
+    resource, uses the primary.
+    """
+
+    @property
+    def replica_methods(self) -> frozenset:
+        """READ_ONLY_METHODS if the resource view may read from the replica."""
+        resource_cls = getattr(self, '__resource_cls__', None)
+        if resource_cls is None:
+            return frozenset()
+        if self.__resource_view_type__ not in resource_cls.replica_views:
+            return frozenset()
+        return READ_ONLY_METHODS
 
     @property
     def api_version(self):
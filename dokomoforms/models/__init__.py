@@ -1,7 +1,7 @@
 """All the models used in Dokomo Forms."""
 from dokomoforms.models.util import (
-    Base, create_engine, jsonify, get_model, ModelJSONEncoder,
-    UUID_REGEX
+    Base, create_engine, create_replica_engine, jsonify, get_model,
+    ModelJSONEncoder, UUID_REGEX
 )
 from dokomoforms.models.user import User, Administrator, Email, construct_user
 from dokomoforms.models.node import (
@@ -20,22 +20,35 @@ from dokomoforms.models.survey import (
 )
 from dokomoforms.models.submission import (
     Submission, EnumeratorOnlySubmission, PublicSubmission,
-    construct_submission, most_recent_submissions
+    construct_submission, most_recent_submissions, most_active_survey_ids,
+    submission_by_idempotency_key, PendingSubmission, change_horizon,
+    submission_changes
 )
 from dokomoforms.models.answer import (
     Answer, Photo, construct_answer, add_new_photo_to_session
 )
+from dokomoforms.models.instrumentation import (
+    QueryStats, activate_query_stats, active_query_stats,
+    SlowQueryLog, slow_queries
+)
+from dokomoforms.models.migrations import (
+    LATEST_VERSION, migrate, check_schema_version
+)
 from dokomoforms.models.column_properties import (
     answer_min, answer_max, answer_sum, answer_avg, answer_mode,
     answer_stddev_pop, answer_stddev_samp,
     generate_question_stats
 )
+from dokomoforms.models.export import (
+    wide_columns, wide_header, wide_export_query, fetch_batches, ExportJob,
+    artifact_key
+)
 
 
 __all__ = (
     # Util
-    'Base', 'create_engine', 'jsonify', 'get_model', 'ModelJSONEncoder',
-    'UUID_REGEX',
+    'Base', 'create_engine', 'create_replica_engine', 'jsonify', 'get_model',
+    'ModelJSONEncoder', 'UUID_REGEX',
     # User
     'User', 'Administrator', 'Email', 'construct_user',
     # Node
@@ -54,10 +67,20 @@ __all__ = (
     # Submission
     'Submission', 'EnumeratorOnlySubmission', 'PublicSubmission',
     'construct_submission', 'most_recent_submissions',
+    'most_active_survey_ids', 'submission_by_idempotency_key',
+    'PendingSubmission', 'change_horizon', 'submission_changes',
     # Answer
     'Answer', 'Photo', 'construct_answer', 'add_new_photo_to_session',
+    # instrumentation
+    'QueryStats', 'activate_query_stats', 'active_query_stats',
+    'SlowQueryLog', 'slow_queries',
+    # migrations
+    'LATEST_VERSION', 'migrate', 'check_schema_version',
     # column_properties
     'answer_min', 'answer_max', 'answer_sum', 'answer_avg', 'answer_mode',
     'answer_stddev_pop', 'answer_stddev_samp',
     'generate_question_stats',
+    # export
+    'wide_columns', 'wide_header', 'wide_export_query', 'fetch_batches',
+    'ExportJob', 'artifact_key',
 )
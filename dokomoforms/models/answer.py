@@ -196,6 +196,8 @@ class Answer(Base):
             unique=True,
             postgresql_where=sa.not_(sa.or_(allow_multiple, repeatable)),
         ),
+        # For the wide export (see dokomoforms.models.export)
+        sa.Index('ix_answer_survey_id', 'survey_id'),
     )
 
     def _asdict(self, mode='json') -> OrderedDict:
@@ -323,6 +325,7 @@ class Photo(Base):
         nullable=False,
         server_default=current_timestamp(),
     )
+    last_update_time = util.last_update_time()
 
     def _asdict(self) -> OrderedDict:
         return OrderedDict((
@@ -331,6 +334,7 @@ class Photo(Base):
             ('image', self.image),
             ('mime_type', self.mime_type),
             ('created_on', self.created_on),
+            ('last_update_time', self.last_update_time),
         ))
 
 
@@ -348,6 +352,9 @@ def add_new_photo_to_session(session, *, id, **kwargs):
     with session.begin():
         answer.photo = Photo(id=id, **kwargs)
         answer.actual_photo_id = answer.main_answer
+        # actual_photo_id is in answer_photo, so the UPDATE would not reach
+        # the answer table's last_update_time on its own
+        answer.last_update_time = func.now()
     return answer.photo
 
 
@@ -10,7 +10,7 @@ from sqlalchemy.orm import column_property, object_session
 from sqlalchemy.sql.functions import Function
 
 from dokomoforms.models import (
-    Answer, Node, Choice, Survey, Submission, AnswerableSurveyNode
+    Answer, Node, Choice, Survey, Submission, AnswerableSurveyNode, User
 )
 from dokomoforms.models.answer import ANSWER_TYPES
 from dokomoforms.exc import InvalidTypeForOperation
@@ -49,6 +49,17 @@ Survey.num_submissions = column_property(
 )
 
 
+# Deferred since Survey._asdict uses the creator relationship instead. This
+# is for selecting ?fields=creator_name without loading the creator.
+Survey.creator_name = column_property(
+    sa.select([User.name])
+    .where(User.id == Survey.creator_id)
+    .correlate_except(User)
+    .label('creator_name'),
+    deferred=True,
+)
+
+
 Survey.earliest_submission_time = column_property(
     sa.select([sa.func.min(Submission.save_time)])
     .where(Submission.survey_id == Survey.id)
@@ -0,0 +1,307 @@
+"""Wide-format exports: one row per submission, one column per answer.
+
+The long format (one row per answer, see SubmissionResource._csv) needs a
+pivot before most analyses. wide_export_query does that pivot in PostgreSQL,
+so that the rows can be streamed straight into a CSV file.
+
+There is a column for every answerable survey node, in the order of
+Survey._sequentialize. A node that can have several answers in a submission
+(allow_multiple, or in a repeatable sub-survey) gets a column for each one,
+suffixed _1, _2, ... in answer_number order, up to the most answers any
+submission has.
+
+Exports that take too long for a request run as an ExportJob instead (see
+dokomoforms.handlers.api.v0.exports).
+"""
+from collections import Counter, OrderedDict, namedtuple
+from hashlib import sha1
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql as pg
+from sqlalchemy.orm import relationship
+from sqlalchemy.sql.functions import current_timestamp
+
+from dokomoforms.models import util, Base
+from dokomoforms.models.answer import Answer, ANSWER_TYPES
+from dokomoforms.models.node import Choice
+from dokomoforms.models.submission import Submission
+
+
+SUBMISSION_COLUMNS = (
+    'submission_id', 'submission_type', 'start_time', 'save_time',
+    'submission_time', 'submitter_name', 'submitter_email',
+)
+
+WideColumn = namedtuple('WideColumn', 'name survey_node_id position')
+
+
+def answer_counts(session, survey_id) -> dict:
+    """The most answers any submission has to each survey node, by id."""
+    answer = Answer.__table__
+    per_submission = (
+        sa.select([
+            answer.c.survey_node_id, sa.func.count().label('num_answers')
+        ])
+        .where(answer.c.survey_id == survey_id)
+        .where(sa.not_(answer.c.deleted))
+        .group_by(answer.c.submission_id, answer.c.survey_node_id)
+        .alias('per_submission')
+    )
+    return dict(session.execute(
+        sa.select([
+            per_submission.c.survey_node_id,
+            sa.func.max(per_submission.c.num_answers),
+        ])
+        .group_by(per_submission.c.survey_node_id)
+    ).fetchall())
+
+
+def _title(node, language) -> str:
+    title = node.title.get(language)
+    if title is None:
+        title = next(iter(node.title.values()), '')
+    return title
+
+
+def wide_columns(session, survey) -> list:
+    """The answer columns of the wide export of a survey.
+
+    Duplicate titles get a number, e.g. 'Name' and 'Name (2)'.
+
+    :return: a list of WideColumn
+    """
+    counts = answer_counts(session, survey.id)
+    titles = Counter()
+    columns = []
+    survey_nodes = survey._sequentialize(include_non_answerable=False)
+    for survey_node in survey_nodes:
+        title = _title(survey_node.node, survey.default_language)
+        titles[title] += 1
+        if titles[title] > 1:
+            title = '{} ({})'.format(title, titles[title])
+        num_answers = counts.get(survey_node.id, 0)
+        multiple = (
+            survey_node.allow_multiple or
+            survey_node.the_sub_survey_repeatable or
+            num_answers > 1
+        )
+        if not multiple:
+            columns.append(WideColumn(title, survey_node.id, 1))
+            continue
+        for position in range(1, max(num_answers, 1) + 1):
+            columns.append(WideColumn(
+                '{}_{}'.format(title, position), survey_node.id, position
+            ))
+    return columns
+
+
+def wide_header(columns) -> list:
+    """The header row of the wide export."""
+    return list(SUBMISSION_COLUMNS) + [column.name for column in columns]
+
+
+def _point_json(table, *fields):
+    return sa.cast(
+        sa.func.json_build_object(*(fields + (
+            'lng', sa.func.ST_X(table.c.main_answer),
+            'lat', sa.func.ST_Y(table.c.main_answer),
+        ))),
+        pg.TEXT
+    )
+
+
+def _response_text(tables, choice, language):
+    """The response of an answer as text, whichever table it is in.
+
+    An answer has a row in exactly one of the tables, so the COALESCE picks
+    that row's answer, "other" response, or "don't know" response.
+    """
+    answers = []
+    for type_constraint, table in sorted(tables.items()):
+        if type_constraint == 'photo':
+            # Like the long format, only photos that have been uploaded
+            answers.append(sa.cast(table.c.actual_photo_id, pg.TEXT))
+        elif type_constraint == 'location':
+            answers.append(_point_json(table))
+        elif type_constraint == 'facility':
+            answers.append(_point_json(
+                table,
+                'facility_id', table.c.facility_id,
+                'facility_name', table.c.facility_name,
+                'facility_sector', table.c.facility_sector,
+            ))
+        elif type_constraint == 'multiple_choice':
+            answers.append(choice.c.choice_text.op('->>')(language))
+        else:
+            answers.append(sa.cast(table.c.main_answer, pg.TEXT))
+    others = [table.c.other for _, table in sorted(tables.items())]
+    dont_knows = [table.c.dont_know for _, table in sorted(tables.items())]
+    return sa.func.coalesce(*(answers + others + dont_knows))
+
+
+def wide_export_query(survey, columns):
+    """The SELECT statement of the wide export of a survey.
+
+    The rows match wide_header(columns), in save_time order. Deleted
+    submissions and answers are left out.
+
+    :param survey: the Survey
+    :param columns: the result of wide_columns
+    """
+    answer = Answer.__table__
+    tables = {
+        type_constraint: answer_class.__table__
+        for type_constraint, answer_class in ANSWER_TYPES.items()
+    }
+    choice = Choice.__table__
+    answers = answer
+    for _, table in sorted(tables.items()):
+        answers = answers.outerjoin(table, table.c.id == answer.c.id)
+    answers = answers.outerjoin(
+        choice, choice.c.id == tables['multiple_choice'].c.main_answer
+    )
+    ranked = (
+        sa.select([
+            answer.c.submission_id,
+            answer.c.survey_node_id,
+            sa.func.row_number().over(
+                partition_by=(answer.c.submission_id, answer.c.survey_node_id),
+                order_by=answer.c.answer_number,
+            ).label('position'),
+            _response_text(tables, choice, survey.default_language)
+            .label('response'),
+        ])
+        .select_from(answers)
+        .where(answer.c.survey_id == survey.id)
+        .where(sa.not_(answer.c.deleted))
+        .alias('ranked')
+    )
+    pivoted = [
+        sa.func.max(ranked.c.response).filter(sa.and_(
+            ranked.c.survey_node_id == column.survey_node_id,
+            ranked.c.position == column.position,
+        )).label('answer_{}'.format(index))
+        for index, column in enumerate(columns)
+    ]
+    submission = Submission.__table__
+    return (
+        sa.select([
+            submission.c.id,
+            submission.c.submission_type,
+            submission.c.start_time,
+            submission.c.save_time,
+            submission.c.submission_time,
+            submission.c.submitter_name,
+            submission.c.submitter_email,
+        ] + pivoted)
+        .select_from(submission.outerjoin(
+            ranked, ranked.c.submission_id == submission.c.id
+        ))
+        .where(submission.c.survey_id == survey.id)
+        .where(sa.not_(submission.c.deleted))
+        # The other columns depend on the primary key
+        .group_by(submission.c.id)
+        .order_by(submission.c.save_time)
+    )
+
+
+def fetch_batches(connection, query, batch_size: int):
+    """Generate the rows of the query in lists of up to batch_size rows.
+
+    The rows come from a server-side cursor, so only one batch is in memory
+    at a time.
+    """
+    result = connection.execution_options(stream_results=True).execute(query)
+    rows = result.fetchmany(batch_size)
+    while rows:
+        yield rows
+        rows = result.fetchmany(batch_size)
+
+
+class ExportJob(Base):
+
+    """An export of a survey's submissions, written to a file by a worker.
+
+    The file is named after the artifact_key, so a job for data that has not
+    changed since the last export can reuse that file.
+    """
+
+    __tablename__ = 'export_job'
+
+    id = util.pk()
+    survey_id = sa.Column(pg.UUID, util.fk('survey.id'), nullable=False)
+    survey = relationship('Survey')
+    layout = sa.Column(
+        sa.Enum(
+            'long', 'wide', name='export_layout_enum', inherit_schema=True
+        ),
+        nullable=False,
+    )
+    dialect = sa.Column(pg.TEXT, nullable=False, server_default='excel')
+    artifact_key = sa.Column(pg.TEXT, nullable=False)
+    status = sa.Column(
+        sa.Enum(
+            'queued', 'running', 'done', 'failed',
+            name='export_job_status_enum', inherit_schema=True
+        ),
+        nullable=False,
+        server_default='queued',
+    )
+    rows_written = sa.Column(sa.Integer, nullable=False, server_default='0')
+    rows_total = sa.Column(sa.Integer)
+    error = sa.Column(pg.TEXT)
+    created_time = sa.Column(
+        pg.TIMESTAMP(timezone=True),
+        nullable=False,
+        server_default=current_timestamp(),
+    )
+    started_time = sa.Column(pg.TIMESTAMP(timezone=True))
+    finished_time = sa.Column(pg.TIMESTAMP(timezone=True))
+    last_update_time = util.last_update_time()
+
+    __table_args__ = (
+        sa.Index('ix_export_job_artifact_key', 'artifact_key', 'status'),
+    )
+
+    def _asdict(self) -> OrderedDict:
+        return OrderedDict((
+            ('id', self.id),
+            ('deleted', self.deleted),
+            ('survey_id', self.survey_id),
+            ('layout', self.layout),
+            ('dialect', self.dialect),
+            ('status', self.status),
+            ('rows_written', self.rows_written),
+            ('rows_total', self.rows_total),
+            ('error', self.error),
+            ('created_time', self.created_time),
+            ('started_time', self.started_time),
+            ('finished_time', self.finished_time),
+            ('last_update_time', self.last_update_time),
+        ))
+
+
+def artifact_key(session, survey, layout: str, dialect: str) -> str:
+    """The name of the export file for the current data of a survey.
+
+    It changes whenever a submission or answer is added, changed (e.g., a
+    photo is uploaded for a PhotoAnswer), or deleted, or the survey (e.g.,
+    a title in the header) changes.
+    """
+    versions = []
+    for model_cls in Submission, Answer:
+        latest, count = (
+            session
+            .query(
+                sa.func.max(model_cls.last_update_time),
+                sa.func.count(model_cls.id),
+            )
+            .filter(model_cls.survey_id == survey.id)
+            .one()
+        )
+        versions.extend((latest and latest.isoformat(), count))
+    versions.append(survey.last_update_time.isoformat())
+    version = sha1(
+        ' '.join(str(part) for part in versions).encode()
+    ).hexdigest()
+    return '{}_{}_{}_{}'.format(survey.id, layout, dialect, version[:16])
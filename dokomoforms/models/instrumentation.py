@@ -0,0 +1,279 @@
+"""Per-request statistics about the SQL statements sent to the database.
+
+Listeners on every SQLAlchemy Engine add each statement to the QueryStats
+that is currently active (see activate_query_stats). The handlers activate
+one QueryStats per request.
+
+Database access is synchronous, so the active QueryStats is the one of the
+request being handled. A coroutine that queries the database after a yield
+might have its statements counted towards another request. The active
+QueryStats belongs to the thread that activated it, so statements from
+worker threads (e.g., the write-behind ingest queue) are not counted.
+
+The same listeners record statements slower than options.slow_query_threshold
+in slow_queries (see SlowQueryLog).
+"""
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import re
+import threading
+from timeit import default_timer
+
+import sqlalchemy as sa
+from sqlalchemy.engine import Engine
+
+from dokomoforms.options import options
+
+
+_local = threading.local()
+
+slow_query_log = logging.getLogger('dokomoforms.slow_queries')
+
+
+class QueryStats:
+
+    """Counts the statements, rows and database time of one request.
+
+    If n_plus_one_threshold is set, a warning gets logged (once) for any
+    statement that runs more than that many times, which is usually a
+    relationship being loaded one model at a time.
+    """
+
+    def __init__(self, name: str='', n_plus_one_threshold: int=None):
+        """Start counting from zero.
+
+        :param name: what to call the request in warnings (e.g., the route)
+        :param n_plus_one_threshold: the number of times the same statement
+                                     can run before the warning, or None
+        """
+        self.name = name
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.queries = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self.statements = Counter()
+
+    def record(self, statement: str, seconds: float, rows: int):
+        """Count a statement that took seconds and returned/affected rows."""
+        self.queries += 1
+        self.rows += max(rows, 0)
+        self.seconds += seconds
+        self.statements[statement] += 1
+        threshold = self.n_plus_one_threshold
+        if threshold is None:
+            return
+        if self.statements[statement] == threshold + 1:
+            logging.warning(
+                'Possible N+1 queries in %s. This statement ran more than %d'
+                ' times: %s', self.name, threshold, statement
+            )
+
+    @property
+    def milliseconds(self) -> float:
+        """The total database time in milliseconds."""
+        return self.seconds * 1000
+
+
+def activate_query_stats(stats):
+    """Make stats the QueryStats that statements are counted towards.
+
+    :param stats: a QueryStats, or None to stop counting
+    """
+    _local.stats = stats
+
+
+def active_query_stats():
+    """The QueryStats that statements are counted towards, or None."""
+    return getattr(_local, 'stats', None)
+
+
+_PLACEHOLDER_LIST = re.compile(r'\(%\(\w+\)s(?:, %\(\w+\)s)*\)')
+_SELECT = re.compile(r'\s*SELECT\b', re.IGNORECASE)
+
+
+def statement_shape(statement: str) -> str:
+    """The statement with lists of placeholders (e.g., IN (...)) collapsed.
+
+    Statements that only differ in the length of such lists have the same
+    shape.
+    """
+    return _PLACEHOLDER_LIST.sub('(%(...)s)', ' '.join(statement.split()))
+
+
+def parameter_shape(parameters, executemany: bool=False):
+    """Describe the bound parameters by type instead of by value."""
+    if executemany:
+        parameters = list(parameters)
+        return {
+            'executemany': len(parameters),
+            'each': parameter_shape(parameters[0]) if parameters else None,
+        }
+    if isinstance(parameters, dict):
+        return {
+            key: type(value).__name__ for key, value in parameters.items()
+        }
+    return [type(value).__name__ for value in parameters]
+
+
+def _explainable(statement: str) -> bool:
+    """Whether the statement is a SELECT, the only kind that gets a plan."""
+    return bool(_SELECT.match(statement))
+
+
+class SlowQuery:
+
+    """Everything recorded about the slow runs of one statement shape."""
+
+    def __init__(self, shape: str):
+        """Start with no runs."""
+        self.shape = shape
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.routes = Counter()
+        self.parameters = None
+        self.plan = None
+        self.explaining = False
+
+    def as_dict(self) -> dict:
+        """The aggregate as a JSON-friendly dictionary."""
+        return {
+            'statement': self.shape,
+            'count': self.count,
+            'total_ms': round(self.seconds * 1000, 3),
+            'max_ms': round(self.max_seconds * 1000, 3),
+            'mean_ms': round(self.seconds * 1000 / self.count, 3),
+            'routes': dict(self.routes),
+            'parameters': self.parameters,
+            'plan': self.plan,
+        }
+
+
+class SlowQueryLog:
+
+    """Aggregates slow statements by shape, and captures their plans.
+
+    Every slow statement gets logged to the dokomoforms.slow_queries logger.
+    The first time a SELECT shape is slow, a worker thread captures its plan
+    with EXPLAIN on its own connection. That is a plain EXPLAIN (estimates,
+    no ANALYZE): the statement is never run again, since even a SELECT can
+    have side effects (e.g., pg_advisory_lock or nextval) that a rollback
+    does not undo. Only the max_shapes most recently added shapes are kept.
+
+    Statements from any thread can be recorded, so the aggregates are only
+    touched while holding a lock.
+    """
+
+    def __init__(self, max_shapes: int=200):
+        """Start with no slow queries."""
+        self.max_shapes = max_shapes
+        self.queries = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def record(self, engine, statement: str, parameters, seconds: float,
+               *, executemany: bool=False, route: str='') -> SlowQuery:
+        """Add a slow statement to the aggregate for its shape."""
+        shape = statement_shape(statement)
+        with self._lock:
+            slow_query = self.queries.get(shape)
+            if slow_query is None:
+                slow_query = self.queries[shape] = SlowQuery(shape)
+                while len(self.queries) > self.max_shapes:
+                    self.queries.popitem(last=False)
+            slow_query.count += 1
+            slow_query.seconds += seconds
+            slow_query.max_seconds = max(slow_query.max_seconds, seconds)
+            slow_query.routes[route] += 1
+            slow_query.parameters = parameter_shape(parameters, executemany)
+            count = slow_query.count
+            explain = (
+                options.slow_query_explain and
+                not executemany and
+                slow_query.plan is None and
+                not slow_query.explaining and
+                _explainable(statement)
+            )
+            if explain:
+                slow_query.explaining = True
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=1)
+        slow_query_log.warning(json.dumps({
+            'route': route,
+            'ms': round(seconds * 1000, 3),
+            'statement': shape,
+            'parameters': slow_query.parameters,
+            'count': count,
+        }, sort_keys=True))
+        if explain:
+            self._executor.submit(
+                self._explain, engine, slow_query, statement, parameters
+            )
+        return slow_query
+
+    def _explain(self, engine, slow_query, statement, parameters):
+        connection = engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + statement, parameters)
+            plan = cursor.fetchone()[0]
+            connection.rollback()
+        except Exception:
+            slow_query_log.exception('Could not explain %s', slow_query.shape)
+            plan = None
+        finally:
+            connection.close()
+        with self._lock:
+            slow_query.plan = plan
+            slow_query.explaining = False
+        if plan is not None:
+            slow_query_log.info(json.dumps({
+                'statement': slow_query.shape, 'plan': plan,
+            }, sort_keys=True))
+
+    def wait_for_plans(self):
+        """Wait until the plans that are being captured are done."""
+        if self._executor is not None:
+            self._executor.submit(lambda: None).result()
+
+    def worst(self) -> list:
+        """The slow queries, by total time (the most worth indexing first)."""
+        with self._lock:
+            queries = list(self.queries.values())
+        return sorted(queries, key=lambda query: query.seconds, reverse=True)
+
+    def clear(self):
+        """Forget every slow query."""
+        with self._lock:
+            self.queries.clear()
+
+
+slow_queries = SlowQueryLog()
+
+
+@sa.event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if context is not None:
+        context.query_start_time = default_timer()
+
+
+@sa.event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    if context is None:
+        return
+    seconds = default_timer() - context.query_start_time
+    route = ''
+    stats = active_query_stats()
+    if stats is not None:
+        stats.record(statement, seconds, cursor.rowcount)
+        route = stats.name
+    threshold = options.slow_query_threshold
+    if threshold >= 0 and seconds * 1000 >= threshold:
+        slow_queries.record(
+            conn.engine, statement, parameters, seconds,
+            executemany=executemany, route=route,
+        )
@@ -0,0 +1,316 @@
+"""Versioned schema migrations.
+
+The schema_version table has a row for every migration applied to
+options.schema. Starting the server only compares the newest of those
+against LATEST_VERSION (see check_schema_version). The DDL runs when someone
+runs
+
+    python webapp.py --migrate
+
+A fresh schema is created from the models and marked as up to date, so the
+migrations only ever run against existing databases. To change the schema,
+change the models and add a migration to the end of MIGRATIONS that makes the
+same change to an existing database. Something like
+
+    @migration(2, 'Index submissions by submitter', transactional=False)
+    def _index_submitter(connection):
+        _create_index_concurrently(
+            connection, 'ix_submission_submitter_name', 'submission',
+            ['submitter_name'],
+        )
+
+Each migration runs in its own transaction along with its schema_version
+row, unless it is not transactional (e.g., CREATE INDEX CONCURRENTLY, which
+does not lock the table).
+"""
+from collections import namedtuple
+import logging
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql as pg
+from sqlalchemy.sql.functions import current_timestamp
+
+from dokomoforms.exc import SchemaVersionError
+from dokomoforms.models.export import ExportJob
+from dokomoforms.models.submission import PendingSubmission
+from dokomoforms.models.util import Base
+from dokomoforms.options import options
+
+
+schema_version = sa.Table(
+    'schema_version',
+    Base.metadata,
+    sa.Column('version', sa.Integer, primary_key=True, autoincrement=False),
+    sa.Column('description', pg.TEXT, nullable=False),
+    sa.Column(
+        'applied_on',
+        pg.TIMESTAMP(timezone=True),
+        nullable=False,
+        server_default=current_timestamp(),
+    ),
+)
+
+# Held while migrating, so that two processes don't migrate at once
+_LOCK_KEY = 0x646f6b6f
+
+Migration = namedtuple(
+    'Migration', 'version description upgrade transactional'
+)
+
+MIGRATIONS = []
+
+
+def migration(version: int, description: str, *, transactional=True):
+    """Add the decorated function(connection) to MIGRATIONS.
+
+    :param version: the next version number
+    :param description: what the migration does
+    :param transactional: whether to run the migration in a transaction
+    """
+    def decorator(upgrade):
+        expected = len(MIGRATIONS) + 1
+        if version != expected:
+            raise ValueError(
+                'Migration {} should be version {}'.format(version, expected)
+            )
+        MIGRATIONS.append(
+            Migration(version, description, upgrade, transactional)
+        )
+        return upgrade
+    return decorator
+
+
+def _add_column(connection, table_name, column_name, definition):
+    """ALTER TABLE ... ADD COLUMN, unless the column exists."""
+    columns = sa.inspect(connection).get_columns(table_name, options.schema)
+    if column_name in {column['name'] for column in columns}:
+        return
+    connection.execute('ALTER TABLE {}.{} ADD COLUMN {} {}'.format(
+        options.schema, table_name, column_name, definition
+    ))
+
+
+def _create_index_concurrently(connection, index_name, table_name, columns,
+                               *, unique=False):
+    """CREATE INDEX CONCURRENTLY, unless the index exists.
+
+    CONCURRENTLY does not lock the table against writes, but it cannot run
+    in a transaction. If it fails (e.g., a duplicate in a unique index) or
+    gets interrupted, it leaves an INVALID index behind, which is not used
+    or enforced. Such an index gets dropped and built again.
+
+    PostgreSQL 9.4 has no CREATE INDEX IF NOT EXISTS, hence the check.
+    """
+    valid = connection.execute(
+        sa.text(
+            'SELECT pg_index.indisvalid FROM pg_index'
+            ' JOIN pg_class ON pg_class.oid = pg_index.indexrelid'
+            ' JOIN pg_namespace'
+            ' ON pg_namespace.oid = pg_class.relnamespace'
+            ' WHERE pg_class.relname = :index_name'
+            ' AND pg_namespace.nspname = :schema'
+        ),
+        index_name=index_name, schema=options.schema,
+    ).scalar()
+    if valid:
+        return
+    if valid is not None:
+        logging.warning(
+            'Rebuilding the invalid index {}.{}.'.format(
+                options.schema, index_name
+            )
+        )
+        connection.execute('DROP INDEX CONCURRENTLY {}.{}'.format(
+            options.schema, index_name
+        ))
+    connection.execute(
+        'CREATE {}INDEX CONCURRENTLY {} ON {}.{} ({})'.format(
+            'UNIQUE ' if unique else '', index_name, options.schema,
+            table_name, ', '.join(columns)
+        )
+    )
+
+
+@migration(1, 'Create the initial schema')
+def _create_initial_schema(connection):
+    # For databases created with create_all before there were versions
+    Base.metadata.create_all(connection)
+
+
+@migration(2, 'Add the write-behind submission queue')
+def _create_pending_submission(connection):
+    PendingSubmission.__table__.create(connection, checkfirst=True)
+
+
+@migration(3, 'Add idempotency keys to submissions', transactional=False)
+def _add_idempotency_key(connection):
+    _add_column(connection, 'submission', 'idempotency_key', 'TEXT')
+    _create_index_concurrently(
+        connection, 'ix_submission_idempotency_key', 'submission',
+        ['survey_id', 'idempotency_key'], unique=True,
+    )
+
+
+@migration(4, 'Index survey changes by last_update_time', transactional=False)
+def _index_survey_changes(connection):
+    _add_column(
+        connection, 'sub_survey', 'last_update_time',
+        'TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP'
+    )
+    for table_name, parent_column in (
+        ('survey_node', 'containing_survey_id'),
+        ('sub_survey', 'containing_survey_id'),
+        ('bucket', 'sub_survey_id'),
+    ):
+        _create_index_concurrently(
+            connection,
+            'ix_{}_{}_last_update_time'.format(table_name, parent_column),
+            table_name, [parent_column, 'last_update_time'],
+        )
+
+
+@migration(5, 'Index answers by survey', transactional=False)
+def _index_answer_survey_id(connection):
+    _create_index_concurrently(
+        connection, 'ix_answer_survey_id', 'answer', ['survey_id']
+    )
+
+
+@migration(6, 'Add export jobs')
+def _create_export_job(connection):
+    ExportJob.__table__.create(connection, checkfirst=True)
+
+
+@migration(7, 'Index submissions by last_update_time', transactional=False)
+def _index_submission_changes(connection):
+    _create_index_concurrently(
+        connection, 'ix_submission_last_update_time', 'submission',
+        ['last_update_time', 'id'],
+    )
+    _create_index_concurrently(
+        connection, 'ix_submission_survey_id_last_update_time', 'submission',
+        ['survey_id', 'last_update_time', 'id'],
+    )
+
+
+@migration(8, 'Add last_update_time to photos')
+def _add_photo_last_update_time(connection):
+    # Adding the column with a default would rewrite every image
+    _add_column(connection, 'photo', 'last_update_time',
+                'TIMESTAMP WITH TIME ZONE')
+    table = '{}.photo'.format(options.schema)
+    connection.execute(
+        'UPDATE {} SET last_update_time = created_on'
+        ' WHERE last_update_time IS NULL'.format(table)
+    )
+    connection.execute(
+        'ALTER TABLE {} ALTER COLUMN last_update_time'
+        ' SET DEFAULT CURRENT_TIMESTAMP,'
+        ' ALTER COLUMN last_update_time SET NOT NULL'.format(table)
+    )
+
+
+LATEST_VERSION = len(MIGRATIONS)
+
+
+def current_version(connection) -> int:
+    """The newest version applied to the schema.
+
+    :return: the version, 0 if no migration has been recorded, or None if
+             there is no schema_version table
+    """
+    dialect = connection.dialect
+    if not dialect.has_table(connection, 'schema_version', options.schema):
+        return None
+    return connection.execute(
+        sa.select([sa.func.coalesce(sa.func.max(schema_version.c.version), 0)])
+    ).scalar()
+
+
+def _record(connection, applied):
+    connection.execute(schema_version.insert(), [
+        {'version': applied_migration.version,
+         'description': applied_migration.description}
+        for applied_migration in applied
+    ])
+
+
+def migrate(engine) -> list:
+    """Bring the schema up to LATEST_VERSION.
+
+    :param engine: the SQLAlchemy engine to use
+    :return: the versions that were applied (for a fresh schema, every
+             version)
+    """
+    with engine.connect() as connection:
+        connection.execute(sa.select([sa.func.pg_advisory_lock(_LOCK_KEY)]))
+        try:
+            return _migrate(connection)
+        finally:
+            connection.execute(
+                sa.select([sa.func.pg_advisory_unlock(_LOCK_KEY)])
+            )
+
+
+def _migrate(connection):
+    version = current_version(connection)
+    dialect = connection.dialect
+    if version is None:
+        if not dialect.has_table(connection, 'survey', options.schema):
+            logging.info(
+                'Creating schema {} at version {}.'.format(
+                    options.schema, LATEST_VERSION
+                )
+            )
+            with connection.begin():
+                Base.metadata.create_all(connection)
+                _record(connection, MIGRATIONS)
+            return [applied.version for applied in MIGRATIONS]
+        schema_version.create(connection)
+        version = 0
+    applied = []
+    for pending in MIGRATIONS[version:]:
+        logging.info('Migrating schema {} to version {}: {}'.format(
+            options.schema, pending.version, pending.description
+        ))
+        if pending.transactional:
+            with connection.begin():
+                pending.upgrade(connection)
+                _record(connection, [pending])
+        else:
+            # Changing the isolation level of this connection would last
+            # until it goes back to the pool
+            with connection.engine.connect() as autocommit:
+                pending.upgrade(
+                    autocommit.execution_options(isolation_level='AUTOCOMMIT')
+                )
+            _record(connection, [pending])
+        applied.append(pending.version)
+    return applied
+
+
+def check_schema_version(engine) -> int:
+    """Make sure the schema is at LATEST_VERSION, without changing it.
+
+    This takes two cheap queries, unlike Base.metadata.create_all.
+
+    :param engine: the SQLAlchemy engine to use
+    :return: the version of the schema
+    :raise dokomoforms.exc.SchemaVersionError: if the schema is missing or
+                                               behind
+    """
+    with engine.connect() as connection:
+        version = current_version(connection)
+    if version is None or version < LATEST_VERSION:
+        raise SchemaVersionError(
+            'The schema {} is at version {} but this code needs version {}.'
+            ' Run python webapp.py --migrate'.format(
+                options.schema, version or 0, LATEST_VERSION
+            )
+        )
+    if version > LATEST_VERSION:
+        logging.warning(
+            'The schema {} is at version {}, which is newer than this code'
+            ' (version {}).'.format(options.schema, version, LATEST_VERSION)
+        )
+    return version
@@ -4,11 +4,12 @@ from collections import OrderedDict
 
 import sqlalchemy as sa
 from sqlalchemy.dialects import postgresql as pg
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, subqueryload, with_polymorphic
 from sqlalchemy.sql.functions import current_timestamp
 from sqlalchemy.ext.orderinglist import ordering_list
 
 from dokomoforms.models import util, Base, survey_type_enum
+from dokomoforms.models.answer import Answer
 from dokomoforms.models.survey import (
     Survey, _administrator_table, administrator_filter
 )
@@ -51,6 +52,9 @@ class Submission(Base):
         pg.TEXT, sa.CheckConstraint("submitter_email ~ '^$|.*@.*'"),
         nullable=False, server_default=''
     )
+    # Identifies retries of the same submission (see
+    # dokomoforms.handlers.api.v0.submissions.submission_idempotency_key)
+    idempotency_key = sa.Column(pg.TEXT)
     answers = relationship(
         'Answer',
         order_by='Answer.answer_number',
@@ -74,6 +78,16 @@ class Submission(Base):
         sa.UniqueConstraint(
             'id', 'survey_containing_id', 'save_time', 'survey_id'
         ),
+        sa.Index(
+            'ix_submission_idempotency_key', 'survey_id', 'idempotency_key',
+            unique=True,
+        ),
+        # For submission_changes
+        sa.Index('ix_submission_last_update_time', 'last_update_time', 'id'),
+        sa.Index(
+            'ix_submission_survey_id_last_update_time',
+            'survey_id', 'last_update_time', 'id',
+        ),
     )
 
     def _default_asdict(self) -> OrderedDict:
@@ -94,6 +108,22 @@ class Submission(Base):
             ]),
         ))
 
+    @classmethod
+    def _asdict_expressions(cls) -> dict:
+        return {
+            'id': cls.id,
+            'deleted': cls.deleted,
+            'survey_id': cls.survey_id,
+            'start_time': cls.start_time,
+            'save_time': cls.save_time,
+            'submission_time': cls.submission_time,
+            'last_update_time': cls.last_update_time,
+            'submitter_name': cls.submitter_name,
+            'submitter_email': cls.submitter_email,
+            'survey_title': cls.survey_title,
+            'survey_default_language': cls.survey_default_language,
+        }
+
 
 class EnumeratorOnlySubmission(Submission):
 
@@ -162,6 +192,61 @@ class PublicSubmission(Submission):
         return result
 
 
+class PendingSubmission(Base):
+
+    """A submission received in write-behind mode, waiting to be saved.
+
+    The id is the receipt given to the client. See
+    dokomoforms.handlers.api.v0.ingest for the workers that save the
+    submissions and record the outcome.
+    """
+
+    __tablename__ = 'pending_submission'
+
+    id = util.pk()
+    survey_id = sa.Column(pg.UUID, util.fk('survey.id'), nullable=False)
+    survey = relationship('Survey')
+    enumerator_user_id = sa.Column(pg.UUID, util.fk('auth_user.id'))
+    submission_data = util.json_column('submission_data')
+    status = sa.Column(
+        sa.Enum(
+            'queued', 'processing', 'accepted', 'rejected',
+            name='pending_submission_status_enum', inherit_schema=True
+        ),
+        nullable=False,
+        server_default='queued',
+    )
+    submission_id = sa.Column(
+        pg.UUID, sa.ForeignKey('submission.id', ondelete='SET NULL')
+    )
+    error = sa.Column(pg.TEXT)
+    received_time = sa.Column(
+        pg.TIMESTAMP(timezone=True),
+        nullable=False,
+        server_default=current_timestamp(),
+    )
+    claimed_time = sa.Column(pg.TIMESTAMP(timezone=True))
+    processed_time = sa.Column(pg.TIMESTAMP(timezone=True))
+    last_update_time = util.last_update_time()
+
+    __table_args__ = (
+        sa.Index('ix_pending_submission_status', 'status', 'received_time'),
+    )
+
+    def _asdict(self) -> OrderedDict:
+        return OrderedDict((
+            ('id', self.id),
+            ('deleted', self.deleted),
+            ('survey_id', self.survey_id),
+            ('status', self.status),
+            ('submission_id', self.submission_id),
+            ('error', self.error),
+            ('received_time', self.received_time),
+            ('processed_time', self.processed_time),
+            ('last_update_time', self.last_update_time),
+        ))
+
+
 def construct_submission(*, submission_type: str, **kwargs) -> Submission:
     """Return a subclass of dokomoforms.models.submission.Submission.
 
@@ -198,3 +283,106 @@ def most_recent_submissions(session, user_id, limit=None):
         .order_by(Submission.save_time.desc())
         .limit(limit)
     )
+
+
+def submission_by_idempotency_key(session, survey_id, idempotency_key):
+    """Get the submission to a survey with that idempotency key, if any.
+
+    :return: the Submission, or None
+    """
+    if idempotency_key is None:
+        return None
+    return (
+        session
+        .query(Submission)
+        .filter_by(survey_id=survey_id, idempotency_key=idempotency_key)
+        .first()
+    )
+
+
+def most_active_survey_ids(session, since, limit=None) -> list:
+    """Get the ids of the surveys with the most submissions saved since then.
+
+    :param since: a timezone-aware datetime.datetime
+    :param limit: the maximum number of ids
+    :return: a list of survey ids, most submissions first
+    """
+    return [
+        survey_id for survey_id, in (
+            session
+            .query(Submission.survey_id)
+            .filter(Submission.save_time >= since)
+            .group_by(Submission.survey_id)
+            .order_by(sa.func.count().desc())
+            .limit(limit)
+        )
+    ]
+
+
+def change_horizon(session):
+    """The time before which no more submissions can change.
+
+    last_update_time is the start of the transaction that made the change,
+    so a transaction that is still running can commit a change older than
+    the ones that are already visible. The horizon is the start of the
+    oldest transaction in the database (other than this one), or the
+    current time if there is none.
+
+    The session must be bound to the primary database: a replica reports
+    its own transactions, not the ones that are still writing.
+    """
+    activity = sa.table(
+        'pg_stat_activity',
+        sa.column('pid'), sa.column('datname'), sa.column('xact_start'),
+    )
+    oldest_transaction = (
+        sa.select([sa.func.min(activity.c.xact_start)])
+        .where(activity.c.datname == sa.func.current_database())
+        .where(activity.c.pid != sa.func.pg_backend_pid())
+        .as_scalar()
+    )
+    # LEAST ignores NULL
+    return session.query(
+        sa.func.least(sa.func.clock_timestamp(), oldest_transaction)
+    ).scalar()
+
+
+def submission_changes(session, after=None, *, limit, survey_id=None):
+    """Get the submissions that changed after a position in the change feed.
+
+    The changes are in (last_update_time, id) order, and stop at the
+    change_horizon, so reading from the position of the last change
+    returned never skips one. Deleted submissions are included.
+
+    :param after: the (last_update_time, id) of the last change already
+                  read, or None to start from the beginning
+    :param limit: the maximum number of submissions
+    :param survey_id: if given, only include submissions to this survey
+    :return: a query for the Submissions
+    """
+    horizon = change_horizon(session)
+    submission = with_polymorphic(Submission, '*')
+    query = (
+        session
+        .query(submission)
+        .options(subqueryload(
+            submission.answers.of_type(with_polymorphic(Answer, '*'))
+        ))
+        .filter(submission.last_update_time < horizon)
+    )
+    if survey_id is not None:
+        query = query.filter(submission.survey_id == survey_id)
+    if after is not None:
+        last_update_time, submission_id = after
+        query = query.filter(
+            sa.tuple_(submission.last_update_time, submission.id) >
+            sa.tuple_(
+                sa.cast(last_update_time, pg.TIMESTAMP(timezone=True)),
+                sa.cast(submission_id, pg.UUID),
+            )
+        )
+    return (
+        query
+        .order_by(submission.last_update_time, submission.id)
+        .limit(limit)
+    )
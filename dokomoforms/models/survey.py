@@ -157,6 +157,27 @@ class Survey(Base):
             ('nodes', self.nodes),
         ))
 
+    @classmethod
+    def _asdict_expressions(cls) -> dict:
+        return {
+            'id': cls.id,
+            'deleted': cls.deleted,
+            'languages': cls.languages,
+            'title': (cls.title, util.sorted_dict),
+            'url_slug': cls.url_slug,
+            'default_language': cls.default_language,
+            'survey_type': cls.survey_type,
+            'version': cls.version,
+            'creator_id': cls.creator_id,
+            'creator_name': cls.creator_name,
+            'metadata': cls.survey_metadata,
+            'created_on': cls.created_on,
+            'last_update_time': cls.last_update_time,
+            'num_submissions': cls.num_submissions,
+            'earliest_submission_time': cls.earliest_submission_time,
+            'latest_submission_time': cls.latest_submission_time,
+        }
+
     def _sequentialize(self, *, include_non_answerable=True):
         """Generate a pre-order traversal of this survey's nodes.
 
@@ -272,8 +293,13 @@ class SubSurvey(Base):
         cascade='all, delete-orphan',
         passive_deletes=True,
     )
+    last_update_time = util.last_update_time()
 
     __table_args__ = (
+        sa.Index(
+            'ix_sub_survey_containing_survey_id_last_update_time',
+            'containing_survey_id', 'last_update_time',
+        ),
         sa.UniqueConstraint(
             'id', 'containing_survey_id', 'root_survey_languages', 'repeatable'
         ),
@@ -358,6 +384,10 @@ class Bucket(Base):
 
     __mapper_args__ = {'polymorphic_on': bucket_type}
     __table_args__ = (
+        sa.Index(
+            'ix_bucket_sub_survey_id_last_update_time',
+            'sub_survey_id', 'last_update_time',
+        ),
         sa.CheckConstraint(
             'bucket_type::TEXT = sub_survey_parent_type_constraint::TEXT',
             name='bucket_type_matches_question_type'
@@ -562,6 +592,10 @@ class SurveyNode(Base):
 
     __mapper_args__ = {'polymorphic_on': survey_node_answerable}
     __table_args__ = (
+        sa.Index(
+            'ix_survey_node_containing_survey_id_last_update_time',
+            'containing_survey_id', 'last_update_time',
+        ),
         sa.UniqueConstraint('id', 'node_id', 'type_constraint'),
         sa.UniqueConstraint(
             'id', 'containing_survey_id', 'root_survey_languages', 'node_id',
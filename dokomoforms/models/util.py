@@ -17,10 +17,12 @@ from decimal import Decimal
 
 import sqlalchemy as sa
 import sqlalchemy.engine
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.declarative import declarative_base, DeclarativeMeta
 from sqlalchemy.dialects import postgresql as pg
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.sql import func
+from sqlalchemy.sql.expression import ClauseElement, Executable
 from sqlalchemy.sql.functions import current_timestamp
 
 from psycopg2.extras import Range
@@ -86,12 +88,23 @@ class Base(declarative_base(metadata=metadata, metaclass=_Meta)):
         method always return the keys in the same order.
         """
 
+    @classmethod
+    def _asdict_expressions(cls) -> dict:
+        """SQL expressions for the parts of _asdict that need no model.
+
+        Maps keys of the dictionary representation (or other attributes that
+        can be requested with ?fields=) to column expressions, or to
+        (expression, function) pairs if the value from the database needs to
+        be converted. A request for only these fields selects just those
+        columns instead of loading whole models and their relationships.
+
+        By default this is empty, so every request loads the models.
+        """
+        return {}
+
     def __str__(self) -> str:
         """Return the string representation of this model."""
-        return (
-            json.dumps(self, cls=ModelJSONEncoder, indent=4)
-            .replace('</', '<\\/')
-        )
+        return json.dumps(self, cls=ModelJSONEncoder, indent=4)
 
 
 sa.event.listen(
@@ -120,19 +133,54 @@ UUID_REGEX = (
 )
 
 
+def _asdict(obj):
+    return obj._asdict()
+
+
+def _isoformat(obj):
+    return obj.isoformat()
+
+
+def _range_to_str(obj):
+    left, right = obj._bounds
+    return '{}{},{}{}'.format(left, obj.lower, obj.upper, right)
+
+
+# type -> function converting instances of that type for JSON. Subclasses
+# are handled too (e.g. every model, datetime.datetime).
+_jsonifiers = {
+    Base: _asdict,
+    bytes: bytes.decode,
+    datetime.date: _isoformat,
+    datetime.time: _isoformat,
+    Decimal: float,  # might want to return a string instead
+    Range: _range_to_str,
+}
+
+# Every type jsonify has seen -> its converter (or None)
+_jsonifier_cache = {}
+
+
+def _jsonifier(cls):
+    """Look up the converter for the given type, following its MRO."""
+    try:
+        return _jsonifier_cache[cls]
+    except KeyError:
+        pass
+    converter = None
+    for base in cls.__mro__:
+        if base in _jsonifiers:
+            converter = _jsonifiers[base]
+            break
+    _jsonifier_cache[cls] = converter
+    return converter
+
+
 def jsonify(obj, *, raise_exception=False) -> object:
     """Convert the given object to something JSON can handle."""
-    if isinstance(obj, Base):
-        return obj._asdict()
-    if isinstance(obj, bytes):
-        return obj.decode()
-    if isinstance(obj, (datetime.date, datetime.time)):
-        return obj.isoformat()
-    if isinstance(obj, Decimal):  # might want to return a string instead
-        return float(obj)
-    if isinstance(obj, Range):
-        left, right = obj._bounds
-        return '{}{},{}{}'.format(left, obj.lower, obj.upper, right)
+    converter = _jsonifier(type(obj))
+    if converter is not None:
+        return converter(obj)
 
     if raise_exception:
         raise NotJSONifiableError(obj)
@@ -149,6 +197,8 @@ class ModelJSONEncoder(json.JSONEncoder):
         json.dumps(
             model, cls=dokomoforms.models.util.ModelJSONEncoder, **kwargs
         )
+
+    The output has </ escaped as <\\/ so that it can be embedded in HTML.
     """
 
     def default(self, obj):
@@ -167,27 +217,42 @@ class ModelJSONEncoder(json.JSONEncoder):
         See
         https://docs.python.org/3/library/json.html#json.JSONEncoder.default
         """
-        try:
-            return jsonify(obj, raise_exception=True)
-        except NotJSONifiableError:
+        converter = _jsonifier(type(obj))
+        if converter is None:
             return super().default(obj)
+        return converter(obj)
+
+    def encode(self, obj) -> str:
+        """Return the JSON string representation of obj.
+
+        Most responses contain no </ at all, in which case checking for it
+        is cheaper than copying the whole string with str.replace.
+        """
+        text = super().encode(obj)
+        if '</' in text:
+            return text.replace('</', '<\\/')
+        return text
 
 
 def create_engine(pool_size: int=None,
                   max_overflow: int=None,
-                  echo: bool=None) -> sqlalchemy.engine.Engine:
+                  echo: bool=None,
+                  host: str=None,
+                  port: str=None) -> sqlalchemy.engine.Engine:
     """Get a connection to the database.
 
     Return a sqlalchemy.engine.Engine configured with the options set in
     dokomoforms.options.options
 
+    :param host: the database host (default: options.db_host)
+    :param port: the database port (default: options.db_port)
     :return: a SQLAlchemy engine
     """
     connection_string = 'postgresql+psycopg2://{}:{}@{}:{}/{}'.format(
         options.db_user,
         options.db_password,
-        options.db_host,
-        options.db_port,
+        host or options.db_host,
+        port or options.db_port,
         options.db_database,
     )
     pool_size = pool_size or options.pool_size
@@ -202,6 +267,22 @@ def create_engine(pool_size: int=None,
     return sa.create_engine(connection_string, **engine_params)
 
 
+def create_replica_engine(**kwargs) -> sqlalchemy.engine.Engine:
+    """Get a connection to the read-only replica of the database.
+
+    The replica shares every setting with the primary database except for
+    options.db_replica_host and options.db_replica_port.
+
+    :param kwargs: the keyword arguments to pass to create_engine
+    :return: a SQLAlchemy engine, or None if no replica is configured
+    """
+    if options.db_replica_host is None:
+        return None
+    return create_engine(
+        host=options.db_replica_host, port=options.db_replica_port, **kwargs
+    )
+
+
 def pk(*foreign_key_column_names: str) -> sa.Column:
     """A UUID primary key.
 
@@ -313,6 +394,44 @@ def last_update_time() -> sa.Column:
     )
 
 
+class Explain(Executable, ClauseElement):
+
+    """An EXPLAIN statement for a SELECT statement, with JSON output.
+
+    session.execute(Explain(query.statement)).scalar() returns the plan as
+    a list containing a single dictionary.
+    """
+
+    def __init__(self, statement, *, analyze=False, buffers=False):
+        """Explain the statement, optionally running it (analyze)."""
+        self.statement = statement
+        self.analyze = analyze
+        self.buffers = buffers
+
+
+@compiles(Explain, 'postgresql')
+def _compile_explain(element, compiler, **kwargs):
+    explain_options = ['FORMAT JSON']
+    if element.analyze:
+        explain_options.append('ANALYZE')
+    if element.buffers:
+        explain_options.append('BUFFERS')
+    return 'EXPLAIN ({}) {}'.format(
+        ', '.join(explain_options),
+        compiler.process(element.statement, **kwargs)
+    )
+
+
+def estimate_count(session, query) -> int:
+    """Estimate the number of rows a query returns, without running it.
+
+    Uses the query planner's estimate, which is based on the table
+    statistics (see ANALYZE in the PostgreSQL documentation).
+    """
+    plan = session.execute(Explain(query.statement)).scalar()
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
 def get_model(session, model_cls, model_id, exception=None):
     """Throw an error if session.query.get(model_id) returns None."""
     model = session.query(model_cls).get(model_id)
@@ -373,8 +492,7 @@ def column_search(query, *,
     )
 
 
-def _get_field(model, field_name):
-    model_dict = model._asdict()
+def _get_field(model, model_dict, field_name):
     try:
         return model_dict[field_name]
     except KeyError:
@@ -383,6 +501,48 @@ def _get_field(model, field_name):
 
 def get_fields_subset(model: Base, fields: list) -> OrderedDict:
     """Return the given fields for the model's dictionary representation."""
+    model_dict = model._asdict()
     return OrderedDict(
-        (name, _get_field(model, name)) for name in fields if name
+        (name, _get_field(model, model_dict, name)) for name in fields if name
     )
+
+
+def fields_projection(model_cls, fields: list) -> OrderedDict:
+    """Get the SQL expressions for the given fields of a model class.
+
+    See dokomoforms.models.util.Base._asdict_expressions
+
+    :param model_cls: the model class
+    :param fields: the names of the fields
+    :return: an OrderedDict of field name -> (labeled expression, converter),
+             or None if any of the fields needs the whole model
+    """
+    expressions = model_cls._asdict_expressions()
+    projection = OrderedDict()
+    for name in fields:
+        if not name:
+            continue
+        try:
+            expression = expressions[name]
+        except KeyError:
+            return None
+        converter = None
+        if isinstance(expression, tuple):
+            expression, converter = expression
+        projection[name] = (expression.label(name), converter)
+    return projection
+
+
+def projected_asdict(projection: OrderedDict, row) -> OrderedDict:
+    """Turn a row selected with a fields_projection into a dictionary."""
+    result = OrderedDict()
+    for (name, (_, converter)), value in zip(projection.items(), row):
+        if converter is not None and value is not None:
+            value = converter(value)
+        result[name] = value
+    return result
+
+
+def sorted_dict(dictionary: dict) -> OrderedDict:
+    """Sort a dictionary (e.g., a translations column) by key."""
+    return OrderedDict(sorted(dictionary.items()))
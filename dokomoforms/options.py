@@ -18,6 +18,18 @@ _arg = None
 define('demo', default=False, help='whether to run in demo mode', type=bool)
 define('port', help='run on the given port', type=int)
 
+processes_help = (
+    'the number of server processes to fork. 0 means one per CPU core.'
+    ' Cannot be combined with debug mode.'
+)
+define('processes', default=1, help=processes_help, type=int)
+
+max_restarts_help = (
+    'the number of times crashed server processes get restarted before the'
+    ' whole server exits. Only applies when processes is not 1.'
+)
+define('max_restarts', default=100, help=max_restarts_help, type=int)
+
 log_help = 'whether to write logs to files in logs/'
 define('log_to_file', default=True, help=log_help, type=bool)
 
@@ -42,6 +54,178 @@ revisit_help = (
 )
 define('revisit_url', default=revisit_url, help=revisit_help)
 
+facility_proxy_help = (
+    'whether survey clients get facilities through /api/v0/facilities (which'
+    ' caches responses from revisit_url) instead of from revisit_url itself'
+)
+define('facility_proxy', default=True, help=facility_proxy_help, type=bool)
+
+facility_cache_time_help = (
+    'the number of seconds the facilities proxy serves a cached response'
+    ' before asking revisit_url again'
+)
+define(
+    'facility_cache_time', default=3600, help=facility_cache_time_help,
+    type=int
+)
+
+facility_cache_size_help = (
+    'the number of facility responses (one per bounding box) to keep in'
+    ' memory'
+)
+define(
+    'facility_cache_size', default=64, help=facility_cache_size_help,
+    type=int
+)
+
+compress_help = 'whether to gzip responses for clients that accept it'
+define('compress_response', default=True, help=compress_help, type=bool)
+
+compression_threshold_help = (
+    'the minimum size in bytes of a response body before it gets compressed'
+)
+define(
+    'compression_threshold', default=1024, help=compression_threshold_help,
+    type=int
+)
+
+compression_level_help = 'the gzip compression level, from 1 (fast) to 9'
+define(
+    'compression_level', default=6, help=compression_level_help, type=int
+)
+
+response_cache_help = (
+    'the number of serialized API responses to keep in memory (in both plain'
+    ' and compressed form). 0 disables the cache.'
+)
+define('response_cache_size', default=128, help=response_cache_help, type=int)
+
+query_stats_help = (
+    'whether to count the SQL statements of each request, report them in a'
+    ' Server-Timing header, and add them to the access log'
+)
+define('query_stats', default=True, help=query_stats_help, type=bool)
+
+n_plus_one_help = (
+    'in debug mode, warn when the same SQL statement runs more than this many'
+    ' times in one request'
+)
+define('n_plus_one_threshold', default=10, help=n_plus_one_help, type=int)
+
+slow_query_threshold_help = (
+    'the number of milliseconds after which a SQL statement counts as slow'
+    ' (see /admin/slow-queries and log/slow_queries.log). A negative number'
+    ' turns the slow query log off.'
+)
+define(
+    'slow_query_threshold', default=200, help=slow_query_threshold_help,
+    type=int
+)
+
+slow_query_explain_help = (
+    'whether to capture the plans of slow SELECT statements (once per'
+    ' statement) with EXPLAIN. The plans are estimates: the statements are not'
+    ' run again, so EXPLAIN ANALYZE them by hand for the actual row counts.'
+)
+define(
+    'slow_query_explain', default=True, help=slow_query_explain_help,
+    type=bool
+)
+
+metrics_local_help = (
+    'whether /metrics is open to requests from the loopback interface (it is'
+    ' always open to administrators). Requests forwarded by a proxy (with an'
+    ' X-Real-IP or X-Forwarded-For header) are never treated as local.'
+)
+define('metrics_local', default=False, help=metrics_local_help, type=bool)
+
+ioloop_lag_help = (
+    'how often (in seconds) to measure the IOLoop lag for /metrics. 0 turns'
+    ' the measurement off.'
+)
+define('ioloop_lag_interval', default=1.0, help=ioloop_lag_help, type=float)
+
+profile_dir_help = (
+    'the directory for the .pstats files of profiled requests'
+)
+define('profile_dir', default='profiles', help=profile_dir_help)
+
+profile_sample_rate_help = (
+    'the fraction of requests to profile (in addition to the ones'
+    ' administrators ask for with the X-Profile: 1 header). 0 turns sampling'
+    ' off.'
+)
+define(
+    'profile_sample_rate', default=0.0, help=profile_sample_rate_help,
+    type=float
+)
+
+profile_keep_help = 'the number of request profiles to keep'
+define('profile_keep', default=100, help=profile_keep_help, type=int)
+
+warm_up_help = (
+    'whether to configure the models, open the database connections, and'
+    ' fill the caches before accepting requests'
+)
+define('warm_up', default=True, help=warm_up_help, type=bool)
+
+warm_up_surveys_help = (
+    'the number of most active surveys (by submissions in the last week)'
+    ' whose API responses get cached during warm-up'
+)
+define('warm_up_surveys', default=10, help=warm_up_surveys_help, type=int)
+
+write_behind_ingest_help = (
+    'whether to queue submissions and save them in the background, answering'
+    ' 202 ACCEPTED with a receipt at /api/v0/submissions/receipts/<id>'
+    ' instead of saving them during the request'
+)
+define(
+    'write_behind_ingest', default=False, help=write_behind_ingest_help,
+    type=bool
+)
+
+ingest_workers_help = (
+    'the number of threads per process that save queued submissions (each'
+    ' uses a database connection from the pool)'
+)
+define('ingest_workers', default=2, help=ingest_workers_help, type=int)
+
+ingest_batch_size_help = (
+    'the maximum number of queued submissions to save in one transaction'
+)
+define('ingest_batch_size', default=50, help=ingest_batch_size_help, type=int)
+
+ingest_interval_help = (
+    'how often (in seconds) the workers check for queued submissions'
+)
+define('ingest_interval', default=1.0, help=ingest_interval_help, type=float)
+
+export_batch_size_help = (
+    'the number of rows to fetch and send at a time when streaming an export'
+)
+define(
+    'export_batch_size', default=1000, help=export_batch_size_help, type=int
+)
+
+export_dir_help = (
+    'the directory to write the files of export jobs to'
+    ' (see /api/v0/exports)'
+)
+define('export_dir', default='exports', help=export_dir_help)
+
+define(
+    'export_workers', default=2, help='the number of export job threads',
+    type=int
+)
+
+access_log_sampling_help = (
+    'the fraction of successful requests to log, by route name, e.g.'
+    ' submit_to_survey=0.1,photos=0.5 (routes that are not listed all get'
+    ' logged, and so do errors)'
+)
+define('access_log_sampling', default='', help=access_log_sampling_help)
+
 # Database options
 define('schema', help='database schema name')
 define('db_host', help='database host')
@@ -50,18 +234,49 @@ define('db_database', help='database name')
 define('db_user', help='database user')
 define('db_password', help='database password')
 
+replica_help = (
+    'the host of a read-only replica of the database. If set, the GET'
+    ' requests of the API views in replica_views (the lists and details of'
+    ' surveys, submissions, nodes, users and photos, and survey statistics)'
+    ' and administrator views read from the replica, and can lag behind.'
+    ' Change feeds, exports and submission receipts always read from the'
+    ' primary.'
+)
+define('db_replica_host', default=None, help=replica_help)
+define(
+    'db_replica_port', default=None,
+    help='the port of the database replica (default: db_port)'
+)
+
+read_your_writes_help = (
+    'the number of seconds after a write during which the same client reads'
+    ' from the primary database instead of the replica'
+)
+define(
+    'read_your_writes_window', default=10, help=read_your_writes_help,
+    type=int
+)
+
 pool_help = (
     'the number of database connections to keep in the pool. You can usually'
-    ' leave this unchanged.'
+    ' leave this unchanged. With several processes, this total is split'
+    ' between them.'
 )
 define('pool_size', default=None, help=pool_help, type=int)
 
 max_overflow_help = (
     'the maximum number of database connections open at once. You can usually'
-    ' leave this unchanged.'
+    ' leave this unchanged. With several processes, this total is split'
+    ' between them.'
 )
 define('max_overflow', default=None, help=max_overflow_help, type=int)
 
+migrate_help = (
+    'apply the pending schema migrations (creating the schema if it does not'
+    ' exist) and exit'
+)
+define('migrate', default=False, help=migrate_help, type=bool)
+
 kill_help = 'whether to drop the existing schema before starting'
 define('kill', default=False, help=kill_help, type=bool)
 
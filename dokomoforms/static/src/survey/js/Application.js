@@ -2,6 +2,7 @@
 var React = require('react'),
     $ = require('jquery'),
     moment = require('moment'),
+    uuid = require('node-uuid'),
     PouchDB = require('pouchdb'),
     ps = require('../../common/js/pubsub'),
     cookies = require('../../common/js/cookies');
@@ -797,7 +798,9 @@ var Application = React.createClass({
             answers: answers,
             start_time: survey.start_time || null,
             save_time: new Date().toISOString(),
-            submission_time: '' // For comparisions during submit ajax callback
+            submission_time: '', // For comparisions during submit ajax callback
+            // Retries of this submission return the one already saved
+            idempotency_key: uuid.v4()
         };
 
         console.log('Submission', submission);
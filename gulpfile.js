@@ -19,9 +19,10 @@ var gulp = require('gulp'),
     del = require('del'),
     less = require('gulp-less'),
     // sourcemaps = require('gulp-sourcemaps'),
-    replace = require('gulp-replace'),
     livereload = require('gulp-livereload'),
-    es = require('event-stream');
+    es = require('event-stream'),
+    fs = require('fs'),
+    zlib = require('zlib');
 
 // base paths
 var src_path = 'dokomoforms/static/src',
@@ -76,9 +77,6 @@ var path = {
     ],
     SURVEY_FONT_DIST: survey_dist_path + '/fonts',
 
-    APP_CACHE_SRC: survey_src_path + '/cache.appcache',
-    APP_CACHE_DIST: survey_dist_path + '/',
-
 
     //---------------------
     // ADMIN ASSET PATHS
@@ -126,7 +124,7 @@ var path = {
 
 
 var admin_tasks = ['admin-less', 'admin-js-vendor', 'admin-js-app', 'admin-img', 'admin-fonts'],
-    survey_tasks = ['survey-less', 'survey-js-vendor', 'survey-js-app', 'survey-img', 'survey-fonts', 'survey-app-cache'];
+    survey_tasks = ['survey-less', 'survey-js-vendor', 'survey-js-app', 'survey-img', 'survey-fonts'];
 
 
 process.env.BROWSERIFYSHIM_DIAGNOSTICS = 1;
@@ -143,15 +141,6 @@ gulp.task('clean', function(cb) {
 //---------------------
 // SURVEY TASKS
 
-/**
- * Copies the cache manifest file, incrementing the version #
- */
-gulp.task('survey-app-cache', function() {
-    gulp.src(path.APP_CACHE_SRC)
-        .pipe(replace(/\$date/g, Date.now()))
-        .pipe(gulp.dest(path.APP_CACHE_DIST));
-});
-
 // Concat all vendor dependencies
 gulp.task('survey-js-vendor', function() {
     gulp.src(path.SURVEY_JS_VENDOR_SRC)
@@ -218,8 +207,8 @@ gulp.task('survey-watch',
     survey_tasks,
     function() {
         livereload.listen();
-        gulp.watch([path.SURVEY_LESS_SRC, path.SURVEY_JS_APP_SRC, path.APP_CACHE_SRC, path.COMMON_JS_SRC],
-            ['survey-less', 'survey-js-vendor', 'survey-js-app', 'survey-img', 'survey-fonts', 'survey-app-cache']);
+        gulp.watch([path.SURVEY_LESS_SRC, path.SURVEY_JS_APP_SRC, path.COMMON_JS_SRC],
+            ['survey-less', 'survey-js-vendor', 'survey-js-app', 'survey-img', 'survey-fonts']);
     });
 
 
@@ -321,6 +310,28 @@ gulp.task('survey-build', ['clean'].concat(survey_tasks));
 
 gulp.task('build', ['clean', 'admin-build', 'survey-build']);
 
+/**
+ * Writes a gzipped sibling (e.g. bundle.js.gz) of every compressible file
+ * in dist. The webapp serves these to clients that accept gzip instead of
+ * compressing the files on every request. Run this after build.
+ */
+gulp.task('compress', function() {
+    var compressible = /\.(js|css|html|svg|json|appcache|ttf|eot)$/;
+    (function compressDir(dir) {
+        fs.readdirSync(dir).forEach(function(name) {
+            var file = dir + '/' + name;
+            if (fs.statSync(file).isDirectory()) {
+                compressDir(file);
+            } else if (compressible.test(name)) {
+                fs.writeFileSync(
+                    file + '.gz',
+                    zlib.gzipSync(fs.readFileSync(file), {level: 9})
+                );
+            }
+        });
+    })(dist_path);
+});
+
 //
 // dev
 //
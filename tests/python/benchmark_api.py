@@ -0,0 +1,170 @@
+"""API benchmarks.
+
+Times the hot paths of the API on a survey with NUM_SUBMISSIONS
+submissions: survey detail serialization, submission lists of various
+sizes, CSV export, question stats, the required question check, and
+submission ingest. Not part of the regular test run. Run it with
+
+    python -m unittest tests.python.benchmark_api
+
+and it prints one line of JSON per benchmark. Set BENCHMARK_RESULTS to a
+file name to collect the lines there as well (see
+tests.python.util.record_benchmark).
+"""
+from tornado.escape import json_encode
+
+# tests.python.util sets the test schema, so it has to come first
+from tests.python.util import (
+    DokoHTTPTest, record_benchmark, setUpModule, tearDownModule, time_runs
+)
+import dokomoforms.models as models
+
+utils = (setUpModule, tearDownModule)
+
+
+NUM_SUBMISSIONS = 1000
+LIST_SIZES = (10, 100, 1000)
+NUM_INGESTED = 20
+NUM_RUNS = 5
+
+
+class BenchmarkAPI(DokoHTTPTest):
+    def setUp(self):
+        super().setUp()
+        with self.session.begin():
+            creator = self.session.query(models.Administrator).get(
+                'b7becd02-1a3f-4c1d-a0e1-286ba121aef4'
+            )
+            survey = models.construct_survey(
+                survey_type='public',
+                title={'English': 'benchmark survey'},
+                nodes=[
+                    models.construct_survey_node(
+                        required=True,
+                        node=models.construct_node(
+                            type_constraint='integer',
+                            title={'English': 'integer'},
+                        ),
+                    ),
+                    models.construct_survey_node(
+                        node=models.construct_node(
+                            type_constraint='text',
+                            title={'English': 'text'},
+                        ),
+                    ),
+                ],
+            )
+            creator.surveys.append(survey)
+            integer_node, text_node = survey.nodes
+            self.session.add_all(
+                models.construct_submission(
+                    submission_type='public_submission',
+                    survey=survey,
+                    submitter_name='submitter {}'.format(i),
+                    answers=[
+                        models.construct_answer(
+                            type_constraint='integer',
+                            survey_node=integer_node,
+                            answer=i,
+                        ),
+                        models.construct_answer(
+                            type_constraint='text',
+                            survey_node=text_node,
+                            answer='answer {}'.format(i),
+                        ),
+                    ],
+                ) for i in range(NUM_SUBMISSIONS)
+            )
+        self.survey = survey
+        self.survey_url = self.api_root + '/surveys/' + survey.id
+
+    def _fetch_ok(self, url, **kwargs):
+        response = self.fetch(url, **kwargs)
+        self.assertLess(response.code, 300, msg=response.body)
+        return response
+
+    def test_survey_detail(self):
+        def uncached():
+            self.app.response_cache.clear()
+            self._fetch_ok(self.survey_url)
+
+        self._fetch_ok(self.survey_url)
+        record_benchmark('survey_detail', time_runs(uncached, NUM_RUNS))
+        record_benchmark(
+            'survey_detail_cached',
+            time_runs(lambda: self._fetch_ok(self.survey_url), NUM_RUNS),
+        )
+
+    def test_submission_list(self):
+        for size in LIST_SIZES:
+            url = self.survey_url + '/submissions?limit={}'.format(size)
+            self._fetch_ok(url)
+            record_benchmark(
+                'submission_list',
+                time_runs(lambda: self._fetch_ok(url), NUM_RUNS),
+                limit=size,
+            )
+
+    def test_csv_export(self):
+        url = self.survey_url + '/submissions?format=csv'
+        self._fetch_ok(url)
+        record_benchmark(
+            'csv_export',
+            time_runs(lambda: self._fetch_ok(url), NUM_RUNS),
+            submissions=NUM_SUBMISSIONS,
+        )
+
+    def test_generate_question_stats(self):
+        def stats():
+            return list(models.generate_question_stats(self.survey))
+
+        self.assertEqual(len(stats()), 2)
+        record_benchmark(
+            'generate_question_stats', time_runs(stats, NUM_RUNS),
+            submissions=NUM_SUBMISSIONS,
+        )
+
+    def test_skipped_required(self):
+        submissions = self.survey.submissions
+        for submission in submissions:
+            submission.answers
+
+        def check_all():
+            for submission in submissions:
+                self.assertIsNone(
+                    models.skipped_required(self.survey, submission.answers)
+                )
+
+        record_benchmark(
+            'skipped_required', time_runs(check_all, NUM_RUNS),
+            submissions=NUM_SUBMISSIONS,
+        )
+
+    def test_submission_ingest(self):
+        integer_node, text_node = self.survey.nodes
+        body = json_encode({
+            'submitter_name': 'benchmark',
+            'submission_type': 'public_submission',
+            'answers': [
+                {
+                    'survey_node_id': integer_node.id,
+                    'type_constraint': 'integer',
+                    'response': {'response_type': 'answer', 'response': 3},
+                },
+                {
+                    'survey_node_id': text_node.id,
+                    'type_constraint': 'text',
+                    'response': {'response_type': 'answer', 'response': 'a'},
+                },
+            ],
+        })
+        url = self.survey_url + '/submit'
+
+        def ingest():
+            for _ in range(NUM_INGESTED):
+                self._fetch_ok(url, method='POST', body=body)
+
+        record_benchmark(
+            'submission_ingest', time_runs(ingest, NUM_RUNS),
+            submissions_per_run=NUM_INGESTED,
+        )
@@ -0,0 +1,113 @@
+"""Serialization benchmark.
+
+Compares ModelJSONSerializer with the serialization path it replaced (an
+isinstance chain in ModelJSONEncoder.default and a str.replace over the
+whole output) on a large list of submissions. Not part of the regular
+test run. Run it with
+
+    python -m unittest tests.python.benchmark_serialization
+
+and it prints one JSON object with the timings (see
+tests.python.util.record_benchmark).
+"""
+from collections import OrderedDict
+import datetime
+from decimal import Decimal
+import json
+
+from psycopg2.extras import Range
+
+# tests.python.util sets the test schema, so it has to come first
+from tests.python.util import (
+    DokoTest, record_benchmark, setUpModule, tearDownModule, time_runs
+)
+import dokomoforms.models as models
+from dokomoforms.handlers.api.v0.serializer import ModelJSONSerializer
+
+utils = (setUpModule, tearDownModule)
+
+
+NUM_SUBMISSIONS = 2000
+NUM_ANSWERS = 10
+NUM_RUNS = 5
+
+
+class LegacyModelJSONEncoder(json.JSONEncoder):
+
+    """ModelJSONEncoder as it was before the dispatch table."""
+
+    def default(self, obj):
+        if isinstance(obj, models.Base):
+            return obj._asdict()
+        if isinstance(obj, bytes):
+            return obj.decode()
+        if isinstance(obj, (datetime.date, datetime.time)):
+            return obj.isoformat()
+        if isinstance(obj, Decimal):
+            return float(obj)
+        if isinstance(obj, Range):
+            left, right = obj._bounds
+            return '{}{},{}{}'.format(left, obj.lower, obj.upper, right)
+        return super().default(obj)
+
+
+def legacy_serialize(data):
+    return json.dumps(data, cls=LegacyModelJSONEncoder).replace('</', '<\\/')
+
+
+class BenchmarkSerialization(DokoTest):
+    def setUp(self):
+        super().setUp()
+        with self.session.begin():
+            creator = models.Administrator(name='creator')
+            survey = models.construct_survey(
+                survey_type='public',
+                title={'English': 'survey </script>'},
+                nodes=[
+                    models.construct_survey_node(
+                        node=models.construct_node(
+                            type_constraint='decimal',
+                            title={'English': 'decimal'},
+                        ),
+                    ),
+                ],
+            )
+            creator.surveys = [survey]
+            self.session.add(creator)
+            survey_node = survey.nodes[0]
+            self.session.add_all(
+                models.construct_submission(
+                    submission_type='public_submission',
+                    survey=survey,
+                    submitter_name='submitter {}'.format(i),
+                    answers=[
+                        models.construct_answer(
+                            type_constraint='decimal',
+                            survey_node=survey_node,
+                            answer=Decimal(j) / 3,
+                        ) for j in range(NUM_ANSWERS)
+                    ],
+                ) for i in range(NUM_SUBMISSIONS)
+            )
+        self.submissions = self.session.query(models.Submission).all()
+
+    def test_submission_list(self):
+        data = OrderedDict((
+            ('submissions', self.submissions),
+            ('total_entries', NUM_SUBMISSIONS),
+            ('filtered_entries', NUM_SUBMISSIONS),
+        ))
+        serializer = ModelJSONSerializer()
+
+        # Warm up (this also loads every relationship)
+        self.assertEqual(serializer.serialize(data), legacy_serialize(data))
+
+        legacy = min(time_runs(lambda: legacy_serialize(data), NUM_RUNS))
+        timings = time_runs(lambda: serializer.serialize(data), NUM_RUNS)
+        record_benchmark(
+            'submission_list_serialization', timings,
+            submissions=NUM_SUBMISSIONS,
+            answers_per_submission=NUM_ANSWERS,
+            legacy_min_seconds=legacy,
+            speedup=legacy / min(timings),
+        )
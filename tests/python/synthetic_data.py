@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+"""Generate large amounts of synthetic survey data.
+
+For capacity planning and benchmarking. Creates --num_surveys surveys, each
+with a random mix of every node type (including notes, and nested
+sub-surveys reached through integer, date and multiple choice buckets),
+then --submissions_per_survey submissions with an answer to each question.
+
+The surveys are created through the ORM. The submissions and answers are
+written with COPY, which is what makes millions of rows practical. The same
+--seed always generates the same data (UUIDs included).
+
+    python -m tests.python.synthetic_data --schema=doko_load \\
+        --num_surveys=10 --submissions_per_survey=20000 --seed=1
+
+Add --kill=true to drop the schema first. Sub-survey questions are answered
+in about half of the submissions, regardless of the buckets.
+"""
+from contextlib import closing
+import csv
+from datetime import datetime, timedelta, timezone
+from io import StringIO
+import random
+from time import time
+import uuid
+
+from sqlalchemy.orm import sessionmaker
+
+from tornado.options import define
+
+from dokomoforms.options import options, parse_options
+
+# The options (the schema in particular) have to be parsed before the
+# models are imported.
+if __name__ == '__main__':  # pragma: no cover
+    define('num_surveys', default=1, help='the number of surveys', type=int)
+    define(
+        'submissions_per_survey', default=1000,
+        help='the number of submissions to each survey', type=int
+    )
+    define('seed', default=0, help='the random seed', type=int)
+    define(
+        'batch_size', default=10000,
+        help='the number of submissions per round of COPY', type=int
+    )
+    parse_options()
+
+import dokomoforms.models as models
+from dokomoforms.models.answer import ANSWER_TYPES
+
+
+QUESTION_TYPES = sorted(set(models.NODE_TYPES) - {'note'})
+START = datetime(2015, 1, 1, tzinfo=timezone.utc)
+WORDS = (
+    'water', 'clinic', 'school', 'road', 'market', 'well', 'open', 'closed',
+    'yes', 'no', 'good', 'broken', 'new', 'old', 'many', 'few',
+)
+SECTORS = ('health', 'education', 'water', 'power')
+DONT_KNOW_RATE = 0.05
+SUB_SURVEY_RATE = 0.5
+
+
+def _uuid(rng: random.Random) -> str:
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def _node(rng, type_constraint, title):
+    kwargs = {
+        'id': _uuid(rng),
+        'type_constraint': type_constraint,
+        'title': {'English': title},
+    }
+    if type_constraint == 'multiple_choice':
+        kwargs['choices'] = [
+            models.Choice(
+                id=_uuid(rng), choice_text={'English': 'choice {}'.format(i)}
+            ) for i in range(rng.randint(2, 6))
+        ]
+    elif type_constraint == 'facility':
+        kwargs['logic'] = {'nlat': 85, 'slat': -85, 'wlng': -180, 'elng': 180}
+    return models.construct_node(**kwargs)
+
+
+def _survey_node(rng, type_constraint, title, *, required=False, **kwargs):
+    if type_constraint != 'note':
+        kwargs['allow_dont_know'] = rng.random() < 0.5
+        kwargs['required'] = required
+    return models.construct_survey_node(
+        id=_uuid(rng), node=_node(rng, type_constraint, title), **kwargs
+    )
+
+
+def _sub_survey(rng, bucket_type, bucket, nodes):
+    return models.SubSurvey(
+        id=_uuid(rng),
+        buckets=[
+            models.construct_bucket(
+                id=_uuid(rng), bucket_type=bucket_type, bucket=bucket
+            ),
+        ],
+        nodes=nodes,
+    )
+
+
+def construct_synthetic_survey(rng: random.Random, creator, number: int):
+    """Create a Survey with a random mix of nodes.
+
+    Every question type appears 1 to 3 times, with 1 or 2 notes in between.
+    The first integer question leads to a sub-survey (which has a nested
+    sub-survey of its own) and the first multiple choice question leads to
+    another.
+
+    :param rng: the source of randomness
+    :param creator: the Administrator who creates the survey
+    :param number: used in titles
+    :return: the Survey (not yet added to a session)
+    """
+    types = [
+        type_constraint for type_constraint in QUESTION_TYPES
+        for _ in range(rng.randint(1, 3))
+    ]
+    types.extend(['note'] * rng.randint(1, 2))
+    rng.shuffle(types)
+    survey_nodes = [
+        _survey_node(
+            rng, type_constraint,
+            '{} question {}'.format(type_constraint, node_number),
+            required=type_constraint != 'note' and rng.random() < 0.2,
+        ) for node_number, type_constraint in enumerate(types)
+    ]
+    by_type = {}
+    for survey_node in survey_nodes:
+        by_type.setdefault(survey_node.node.type_constraint, survey_node)
+
+    by_type['integer'].sub_surveys = [
+        _sub_survey(rng, 'integer', '[0, 50)', [
+            _survey_node(rng, 'text', 'text sub question'),
+            _survey_node(
+                rng, 'date', 'date sub question',
+                sub_surveys=[
+                    _sub_survey(
+                        rng, 'date', '[2015-01-01, 2015-07-01)',
+                        [_survey_node(rng, 'decimal', 'decimal sub question')]
+                    ),
+                ],
+            ),
+        ]),
+    ]
+    multiple_choice = by_type['multiple_choice']
+    multiple_choice.sub_surveys = [
+        _sub_survey(
+            rng, 'multiple_choice', multiple_choice.node.choices[0],
+            [_survey_node(rng, 'location', 'location sub question')]
+        ),
+    ]
+
+    return models.construct_survey(
+        id=_uuid(rng),
+        containing_id=_uuid(rng),
+        survey_type='public',
+        creator=creator,
+        title={'English': 'synthetic survey {}'.format(number)},
+        nodes=survey_nodes,
+    )
+
+
+class _Question:
+
+    """The answer columns that come from an AnswerableSurveyNode."""
+
+    def __init__(self, survey_node):
+        self.survey_node_id = survey_node.id
+        self.containing_survey_id = survey_node.the_containing_survey_id
+        self.question_id = survey_node.the_node_id
+        self.type_constraint = survey_node.the_type_constraint
+        self.allow_multiple = survey_node.allow_multiple
+        self.repeatable = survey_node.the_sub_survey_repeatable
+        self.allow_other = survey_node.allow_other
+        self.allow_dont_know = survey_node.allow_dont_know
+        self.in_sub_survey = survey_node.sub_survey_id is not None
+        self.choice_ids = [
+            choice.id for choice in getattr(survey_node.node, 'choices', ())
+        ]
+
+
+def _point(rng) -> str:
+    return 'SRID=4326;POINT({:.6f} {:.6f})'.format(
+        rng.uniform(-180, 180), rng.uniform(-85, 85)
+    )
+
+
+def _main_answer(rng, question, save_time) -> dict:
+    """The type-specific columns of an answer."""
+    type_constraint = question.type_constraint
+    if type_constraint == 'text':
+        value = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 8)))
+    elif type_constraint == 'photo':
+        value = _uuid(rng)
+    elif type_constraint == 'integer':
+        value = rng.randint(0, 100)
+    elif type_constraint == 'decimal':
+        value = '{:.3f}'.format(rng.uniform(0, 1000))
+    elif type_constraint == 'date':
+        value = (START + timedelta(days=rng.randrange(730))).date()
+    elif type_constraint == 'time':
+        value = '{:02d}:{:02d}:00+00'.format(
+            rng.randrange(24), rng.randrange(60)
+        )
+    elif type_constraint == 'timestamp':
+        value = save_time - timedelta(minutes=rng.randrange(60 * 24 * 7))
+    elif type_constraint == 'location':
+        value = _point(rng)
+    elif type_constraint == 'facility':
+        return {
+            'main_answer': _point(rng),
+            'facility_id': '{:024x}'.format(rng.getrandbits(96)),
+            'facility_name': 'facility {}'.format(rng.randrange(10000)),
+            'facility_sector': rng.choice(SECTORS),
+        }
+    else:  # multiple_choice
+        value = rng.choice(question.choice_ids)
+    return {'main_answer': value}
+
+
+class _CopyBuffer:
+
+    """CSV rows waiting to be COPYed into one table."""
+
+    def __init__(self, table, columns):
+        self.statement = 'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+            table.fullname, ', '.join(columns)
+        )
+        self.columns = columns
+        self.num_rows = 0
+        self._reset()
+
+    def _reset(self):
+        self.buffer = StringIO()
+        # QUOTE_NONNUMERIC writes None as an unquoted empty field (NULL)
+        # and '' as "" (an empty string).
+        self.writer = csv.writer(self.buffer, quoting=csv.QUOTE_NONNUMERIC)
+
+    def add(self, row: dict):
+        self.writer.writerow([row.get(column) for column in self.columns])
+        self.num_rows += 1
+
+    def copy(self, cursor):
+        self.buffer.seek(0)
+        cursor.copy_expert(self.statement, self.buffer)
+        self._reset()
+
+
+def _copy_buffers():
+    """One _CopyBuffer per table, in an order that satisfies the FKs."""
+    buffers = [
+        ('submission', _CopyBuffer(models.Submission.__table__, (
+            'id', 'submission_type', 'survey_id', 'survey_containing_id',
+            'survey_type', 'start_time', 'save_time', 'submission_time',
+            'submitter_name', 'submitter_email',
+        ))),
+        ('answer', _CopyBuffer(models.Answer.__table__, (
+            'id', 'answer_number', 'submission_id', 'save_time', 'survey_id',
+            'survey_containing_id', 'survey_node_containing_survey_id',
+            'survey_node_id', 'allow_multiple', 'repeatable', 'allow_other',
+            'allow_dont_know', 'question_id', 'type_constraint',
+            'answer_type', 'answer_metadata',
+        ))),
+    ]
+    for answer_type, answer_class in sorted(ANSWER_TYPES.items()):
+        columns = (
+            'id', 'the_allow_other', 'the_allow_dont_know', 'other',
+            'dont_know', 'main_answer',
+        )
+        if answer_type == 'facility':
+            columns += ('facility_id', 'facility_name', 'facility_sector')
+        elif answer_type == 'multiple_choice':
+            columns += (
+                'the_survey_node_id', 'the_question_id', 'the_submission_id'
+            )
+        buffers.append(
+            (answer_type, _CopyBuffer(answer_class.__table__, columns))
+        )
+    return buffers
+
+
+def _add_submission(rng, buffers, survey, questions, number):
+    save_time = START + timedelta(seconds=rng.randrange(365 * 24 * 60 * 60))
+    submission_id = _uuid(rng)
+    buffers['submission'].add({
+        'id': submission_id,
+        'submission_type': 'public_submission',
+        'survey_id': survey.id,
+        'survey_containing_id': survey.containing_id,
+        'survey_type': survey.survey_type,
+        'start_time': save_time - timedelta(minutes=rng.randint(1, 120)),
+        'save_time': save_time,
+        'submission_time': save_time,
+        'submitter_name': 'submitter {}'.format(number),
+        'submitter_email': '',
+    })
+    answer_sub_surveys = rng.random() < SUB_SURVEY_RATE
+    answer_number = 0
+    for question in questions:
+        if question.in_sub_survey and not answer_sub_surveys:
+            continue
+        answer_id = _uuid(rng)
+        buffers['answer'].add({
+            'id': answer_id,
+            'answer_number': answer_number,
+            'submission_id': submission_id,
+            'save_time': save_time,
+            'survey_id': survey.id,
+            'survey_containing_id': survey.containing_id,
+            'survey_node_containing_survey_id': question.containing_survey_id,
+            'survey_node_id': question.survey_node_id,
+            'allow_multiple': question.allow_multiple,
+            'repeatable': question.repeatable,
+            'allow_other': question.allow_other,
+            'allow_dont_know': question.allow_dont_know,
+            'question_id': question.question_id,
+            'type_constraint': question.type_constraint,
+            'answer_type': question.type_constraint,
+            'answer_metadata': '{}',
+        })
+        if question.allow_dont_know and rng.random() < DONT_KNOW_RATE:
+            row = {'dont_know': "don't know"}
+        else:
+            row = _main_answer(rng, question, save_time)
+        row.update({
+            'id': answer_id,
+            'the_allow_other': question.allow_other,
+            'the_allow_dont_know': question.allow_dont_know,
+            'the_survey_node_id': question.survey_node_id,
+            'the_question_id': question.question_id,
+            'the_submission_id': submission_id,
+        })
+        buffers[question.type_constraint].add(row)
+        answer_number += 1
+
+
+def generate(session, *, num_surveys: int, submissions_per_survey: int,
+             seed: int=0, batch_size: int=10000) -> dict:
+    """Generate surveys, submissions and answers.
+
+    Everything happens on the session's connection (and in its current
+    transaction, if there is one).
+
+    :param session: a SQLAlchemy session with autocommit=True
+    :param num_surveys: the number of surveys
+    :param submissions_per_survey: the number of submissions to each survey
+    :param seed: the random seed
+    :param batch_size: the number of submissions per round of COPY
+    :return: the number of rows written to each table, keyed by
+             'survey', 'submission', 'answer', and the answer types
+    """
+    rng = random.Random(seed)
+    with session.begin():
+        creator = models.Administrator(
+            id=_uuid(rng), name='synthetic data creator'
+        )
+        session.add(creator)
+        surveys = [
+            construct_synthetic_survey(rng, creator, number)
+            for number in range(num_surveys)
+        ]
+        session.add_all(surveys)
+    counts = {'survey': num_surveys}
+
+    buffers = _copy_buffers()
+    by_name = dict(buffers)
+    raw_connection = session.connection().connection
+    with closing(raw_connection.cursor()) as cursor:
+        for survey in surveys:
+            questions = [
+                _Question(survey_node) for survey_node in
+                survey._sequentialize(include_non_answerable=False)
+            ]
+            for number in range(submissions_per_survey):
+                _add_submission(rng, by_name, survey, questions, number)
+                if (number + 1) % batch_size == 0:
+                    for _, buffer in buffers:
+                        buffer.copy(cursor)
+            for _, buffer in buffers:
+                buffer.copy(cursor)
+    counts.update((name, buffer.num_rows) for name, buffer in buffers)
+    return counts
+
+
+def main():  # pragma: no cover
+    """Generate data in the options.schema schema."""
+    from webapp import setup_database
+    engine = models.create_engine()
+    setup_database(engine)
+    start = time()
+    with engine.connect() as connection:
+        with connection.begin():
+            session = sessionmaker()(bind=connection, autocommit=True)
+            counts = generate(
+                session,
+                num_surveys=options.num_surveys,
+                submissions_per_survey=options.submissions_per_survey,
+                seed=options.seed,
+                batch_size=options.batch_size,
+            )
+    print('Generated in {:.1f} seconds:'.format(time() - start))
+    for name, number in sorted(counts.items()):
+        print('  {}: {}'.format(name, number))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
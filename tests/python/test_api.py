@@ -4,9 +4,14 @@ from collections import OrderedDict
 from contextlib import closing
 from csv import DictReader
 from datetime import datetime, date, timedelta
+import gzip
 from io import StringIO
 import json
 import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
 import uuid
 
 import dateutil.parser
@@ -19,14 +24,18 @@ import sqlalchemy as sa
 from sqlalchemy.dialects import postgresql as pg
 
 from tests.python.util import (
-    DokoFixtureTest, DokoHTTPTest, setUpModule, tearDownModule
+    DokoFixtureTest, DokoHTTPTest, engine, setUpModule, tearDownModule
 )
 
+from dokomoforms.options import options
 from dokomoforms.models import Submission, Survey, Node, Administrator, User
 import dokomoforms.models as models
 from dokomoforms.models.answer import PhotoAnswer
 from dokomoforms.handlers.api.v0.base import BaseResource
 from dokomoforms.handlers.api.v0.nodes import NodeResource
+from dokomoforms.handlers.api.v0.facilities import (
+    BaseFacilityHandler, FacilityIndex
+)
 
 utils = (setUpModule, tearDownModule)
 
@@ -1071,6 +1080,53 @@ class TestSurveyApi(DokoHTTPTest):
         self.assertTrue('last_update_time' in submission_dict)
         self.assertTrue('submission_time' in submission_dict)
         self.assertTrue('survey_id' in submission_dict)
+        self.assertEqual(self.app.metrics.ingested['submission'], 1)
+
+    def _submit_twice(self, body):
+        url = (
+            self.api_root + '/surveys/b0816b52-204f-41d4-aaf0-ac6ae2970923'
+            '/submit'
+        )
+        num_submissions = self.session.query(Submission).count()
+        responses = [
+            self.fetch(url, method='POST', body=json_encode(body))
+            for _ in range(2)
+        ]
+        for response in responses:
+            self.assertEqual(response.code, 201, msg=response.body)
+        bodies = [json_decode(response.body) for response in responses]
+        num_new = self.session.query(Submission).count() - num_submissions
+        return bodies, num_new
+
+    def test_submit_to_survey_retry_with_idempotency_key(self):
+        body = {
+            'submitter_name': 'regular',
+            'submission_type': 'public_submission',
+            'idempotency_key': str(uuid.uuid4()),
+        }
+        (first, retry), new_submissions = self._submit_twice(body)
+        self.assertEqual(first['id'], retry['id'])
+        self.assertEqual(new_submissions, 1)
+        self.assertEqual(self.app.metrics.ingested['submission'], 1)
+
+    def test_submit_to_survey_retry_with_start_time(self):
+        body = {
+            'submitter_name': 'regular',
+            'submission_type': 'public_submission',
+            'start_time': '2015-08-19T14:10:38.139Z',
+        }
+        (first, retry), new_submissions = self._submit_twice(body)
+        self.assertEqual(first['id'], retry['id'])
+        self.assertEqual(new_submissions, 1)
+
+    def test_submit_to_survey_twice_without_key(self):
+        body = {
+            'submitter_name': 'regular',
+            'submission_type': 'public_submission',
+        }
+        (first, second), new_submissions = self._submit_twice(body)
+        self.assertNotEqual(first['id'], second['id'])
+        self.assertEqual(new_submissions, 2)
 
     def test_submit_to_survey_bogus_survey_id(self):
         survey_id = str(uuid.uuid4())
@@ -6315,3 +6371,1339 @@ class TestUserApi(DokoHTTPTest):
         )
 
         self.assertEqual(api_response.code, 401)
+
+
+class TestConditionalGet(DokoHTTPTest):
+    survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
+
+    def _survey_url(self):
+        return self.api_root + '/surveys/' + self.survey_id
+
+    def test_detail_has_etag_and_last_modified(self):
+        response = self.fetch(self._survey_url())
+        self.assertEqual(response.code, 200, msg=response.body)
+        self.assertIn('Etag', response.headers)
+        self.assertIn('Last-Modified', response.headers)
+
+    def test_if_none_match(self):
+        response = self.fetch(self._survey_url())
+        etag = response.headers['Etag']
+
+        cached_response = self.fetch(
+            self._survey_url(), headers={'If-None-Match': etag}
+        )
+        self.assertEqual(cached_response.code, 304)
+        self.assertEqual(cached_response.body, b'')
+
+    def test_if_none_match_does_not_serialize(self):
+        response = self.fetch(self._survey_url())
+        etag = response.headers['Etag']
+
+        with patch.object(Survey, '_asdict') as asdict:
+            cached_response = self.fetch(
+                self._survey_url(), headers={'If-None-Match': etag}
+            )
+        self.assertEqual(cached_response.code, 304)
+        self.assertFalse(asdict.called)
+
+    def test_if_none_match_stale(self):
+        response = self.fetch(
+            self._survey_url(), headers={'If-None-Match': '"stale"'}
+        )
+        self.assertEqual(response.code, 200, msg=response.body)
+
+    def test_etag_changes_with_nested_node(self):
+        response = self.fetch(self._survey_url())
+        etag = response.headers['Etag']
+
+        survey = self.session.query(Survey).get(self.survey_id)
+        with self.session.begin():
+            node = survey.nodes[0].sub_surveys[0].nodes[0].node
+            node.hint = {'English': 'a new hint'}
+
+        changed_response = self.fetch(
+            self._survey_url(), headers={'If-None-Match': etag}
+        )
+        self.assertEqual(changed_response.code, 200)
+        self.assertNotEqual(changed_response.headers['Etag'], etag)
+
+    def test_etag_changes_with_sub_survey(self):
+        response = self.fetch(self._survey_url())
+        etag = response.headers['Etag']
+
+        survey = self.session.query(Survey).get(self.survey_id)
+        with self.session.begin():
+            sub_survey = survey.nodes[0].sub_surveys[0]
+            sub_survey.repeatable = not sub_survey.repeatable
+
+        changed_response = self.fetch(
+            self._survey_url(), headers={'If-None-Match': etag}
+        )
+        self.assertEqual(changed_response.code, 200)
+        self.assertNotEqual(changed_response.headers['Etag'], etag)
+
+    def test_etag_depends_on_fields(self):
+        response = self.fetch(self._survey_url())
+        fields_response = self.fetch(self._survey_url() + '?fields=id')
+        self.assertNotEqual(
+            response.headers['Etag'], fields_response.headers['Etag']
+        )
+
+    def test_if_modified_since(self):
+        response = self.fetch(self._survey_url())
+        last_modified = response.headers['Last-Modified']
+
+        cached_response = self.fetch(
+            self._survey_url(), headers={'If-Modified-Since': last_modified}
+        )
+        self.assertEqual(cached_response.code, 304)
+
+    def test_if_modified_since_old(self):
+        response = self.fetch(
+            self._survey_url(),
+            headers={'If-Modified-Since': 'Sat, 01 Jan 2000 00:00:00 GMT'}
+        )
+        self.assertEqual(response.code, 200)
+
+    def test_submission_csv(self):
+        url = (
+            self.api_root +
+            '/submissions/b0816b52-204f-41d4-aaf0-ac6ae2970924?format=csv'
+        )
+        response = self.fetch(url)
+        self.assertEqual(response.code, 200)
+
+        cached_response = self.fetch(
+            url, headers={'If-None-Match': response.headers['Etag']}
+        )
+        self.assertEqual(cached_response.code, 304)
+
+    def test_user(self):
+        url = self.api_root + '/users/b7becd02-1a3f-4c1d-a0e1-286ba121aef4'
+        response = self.fetch(url)
+        self.assertEqual(response.code, 200)
+
+        cached_response = self.fetch(
+            url, headers={'If-None-Match': response.headers['Etag']}
+        )
+        self.assertEqual(cached_response.code, 304)
+
+    def test_photo_etag_changes_on_delete(self):
+        photo_id = str(uuid.uuid4())
+        with self.session.begin():
+            self.session.add(models.Photo(
+                id=photo_id, image=b'image', mime_type='image/png',
+                last_update_time='2000-01-01T00:00:00+00:00',
+            ))
+        url = self.api_root + '/photos/' + photo_id
+        response = self.fetch(url)
+        self.assertEqual(response.code, 200, msg=response.body)
+        etag = response.headers['Etag']
+
+        self.assertEqual(self.fetch(url, method='DELETE').code, 204)
+
+        changed_response = self.fetch(url, headers={'If-None-Match': etag})
+        self.assertEqual(changed_response.code, 200)
+        self.assertNotEqual(changed_response.headers['Etag'], etag)
+        self.assertTrue(json_decode(changed_response.body)['deleted'])
+
+    def test_not_found(self):
+        response = self.fetch(
+            self.api_root + '/surveys/' + str(uuid.uuid4()),
+            headers={'If-None-Match': '*'}
+        )
+        self.assertEqual(response.code, 404)
+        self.assertNotIn('Etag', response.headers)
+
+    def test_admin_view_not_conditional(self):
+        response = self.fetch('/admin/' + self.survey_id)
+        self.assertEqual(response.code, 200)
+        self.assertNotIn('Last-Modified', response.headers)
+
+
+class TestResponseCache(DokoHTTPTest):
+    survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
+
+    def _survey_url(self):
+        return self.api_root + '/surveys/' + self.survey_id
+
+    def test_detail_gets_cached(self):
+        response = self.fetch(self._survey_url())
+        self.assertEqual(response.code, 200, msg=response.body)
+        self.assertIn(response.headers['Etag'], self.app.response_cache)
+
+    def test_cached_detail_does_not_serialize(self):
+        response = self.fetch(self._survey_url())
+
+        with patch.object(Survey, '_asdict') as asdict:
+            cached_response = self.fetch(self._survey_url())
+        self.assertEqual(cached_response.code, 200)
+        self.assertFalse(asdict.called)
+        self.assertEqual(cached_response.body, response.body)
+
+    def test_cached_detail_gzipped(self):
+        response = self.fetch(self._survey_url())
+
+        cached_response = self.fetch(
+            self._survey_url(),
+            headers={'Accept-Encoding': 'gzip'},
+            decompress_response=False,
+        )
+        self.assertEqual(cached_response.code, 200)
+        self.assertEqual(cached_response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(cached_response.body), response.body)
+
+    def test_cache_follows_version(self):
+        response = self.fetch(self._survey_url())
+        etag = response.headers['Etag']
+
+        survey = self.session.query(Survey).get(self.survey_id)
+        with self.session.begin():
+            survey.title = {'English': 'a new title'}
+
+        changed_response = self.fetch(self._survey_url())
+        self.assertNotEqual(changed_response.headers['Etag'], etag)
+        self.assertIn(
+            'a new title', json_decode(changed_response.body)['title'].values()
+        )
+
+    def test_error_not_cached(self):
+        with self.session.begin():
+            survey = self.session.query(Survey).get(self.survey_id)
+            survey.survey_type = 'enumerator_only'
+        response = self.fetch(self._survey_url(), _logged_in_user=None)
+        self.assertEqual(response.code, 401)
+        self.assertEqual(len(self.app.response_cache), 0)
+
+    def test_submission_csv(self):
+        url = (
+            self.api_root +
+            '/submissions/b0816b52-204f-41d4-aaf0-ac6ae2970924?format=csv'
+        )
+        response = self.fetch(url)
+        cached_response = self.fetch(url)
+        self.assertEqual(cached_response.code, 200)
+        self.assertEqual(cached_response.body, response.body)
+        self.assertIn(
+            'text/csv', cached_response.headers['Content-Type']
+        )
+
+
+class TestResponseCompression(DokoHTTPTest):
+    def test_large_json_gzipped(self):
+        response = self.fetch(
+            self.api_root + '/surveys',
+            headers={'Accept-Encoding': 'gzip'},
+            decompress_response=False,
+        )
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('objects', json_decode(gzip.decompress(response.body)))
+
+    def test_small_json_not_gzipped(self):
+        response = self.fetch(
+            self.api_root + '/surveys?limit=0',
+            headers={'Accept-Encoding': 'gzip'},
+            decompress_response=False,
+        )
+        self.assertEqual(response.code, 200)
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_csv_gzipped(self):
+        response = self.fetch(
+            self.api_root + '/submissions?format=csv',
+            headers={'Accept-Encoding': 'gzip'},
+            decompress_response=False,
+        )
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+
+    def test_not_gzipped_if_not_accepted(self):
+        response = self.fetch(
+            self.api_root + '/surveys', decompress_response=False,
+        )
+        self.assertEqual(response.code, 200)
+        self.assertNotIn('Content-Encoding', response.headers)
+
+
+class TestFieldsProjection(DokoHTTPTest):
+    survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
+
+    def test_list_surveys_does_not_load_models(self):
+        url = self.api_root + '/surveys?fields=id,title,creator_name'
+        with patch.object(Survey, '_asdict') as asdict:
+            response = self.fetch(url)
+        self.assertEqual(response.code, 200, msg=response.body)
+        self.assertFalse(asdict.called)
+        surveys = json_decode(response.body)['surveys']
+        self.assertEqual(
+            set(surveys[0]), {'id', 'title', 'creator_name'}
+        )
+
+    def test_list_surveys_projection_matches_asdict(self):
+        fields = 'title,creator_name,metadata,num_submissions'
+        projected = json_decode(
+            self.fetch(self.api_root + '/surveys?fields=' + fields).body
+        )
+        # 'nodes' needs the whole model
+        loaded = json_decode(
+            self.fetch(
+                self.api_root + '/surveys?fields=nodes,' + fields
+            ).body
+        )
+        for survey in loaded['surveys']:
+            del survey['nodes']
+        self.assertEqual(projected['surveys'], loaded['surveys'])
+        self.assertEqual(
+            projected['total_entries'], loaded['total_entries']
+        )
+        self.assertEqual(
+            projected['filtered_entries'], loaded['filtered_entries']
+        )
+
+    def test_survey_detail_does_not_load_model(self):
+        url = self.api_root + '/surveys/' + self.survey_id + '?fields=id'
+        with patch.object(Survey, '_asdict') as asdict:
+            response = self.fetch(url)
+        self.assertEqual(response.code, 200, msg=response.body)
+        self.assertFalse(asdict.called)
+        self.assertEqual(json_decode(response.body), {'id': self.survey_id})
+
+    def test_survey_detail_not_found(self):
+        url = self.api_root + '/surveys/' + str(uuid.uuid4()) + '?fields=id'
+        response = self.fetch(url)
+        self.assertEqual(response.code, 404)
+
+    def test_list_submissions_projection(self):
+        url = self.api_root + '/submissions?fields=id,survey_title'
+        with patch.object(Submission, '_default_asdict') as asdict:
+            response = self.fetch(url)
+        self.assertEqual(response.code, 200, msg=response.body)
+        self.assertFalse(asdict.called)
+        submission = json_decode(response.body)['submissions'][0]
+        self.assertEqual(set(submission), {'id', 'survey_title'})
+
+    def test_list_nodes_fields_fallback(self):
+        response = self.fetch(self.api_root + '/nodes?fields=id,title')
+        self.assertEqual(response.code, 200, msg=response.body)
+        node = json_decode(response.body)['nodes'][0]
+        self.assertEqual(set(node), {'id', 'title'})
+
+
+class TestListCount(DokoHTTPTest):
+    def test_count_exact(self):
+        response = self.fetch(self.api_root + '/surveys?count=exact&limit=1')
+        self.assertEqual(response.code, 200, msg=response.body)
+        body = json_decode(response.body)
+        self.assertEqual(body['total_entries'], 14)
+        self.assertEqual(body['filtered_entries'], 14)
+        self.assertEqual(len(body['surveys']), 1)
+
+    def test_count_estimate(self):
+        response = self.fetch(self.api_root + '/surveys?count=estimate')
+        self.assertEqual(response.code, 200, msg=response.body)
+        body = json_decode(response.body)
+        self.assertIsInstance(body['total_entries'], int)
+        self.assertIsInstance(body['filtered_entries'], int)
+        self.assertEqual(len(body['surveys']), 14)
+
+    def test_count_none(self):
+        url = self.api_root + '/surveys?count=none&limit=2'
+        with patch('dokomoforms.handlers.api.v0.base.count') as window:
+            response = self.fetch(url)
+        self.assertEqual(response.code, 200, msg=response.body)
+        self.assertFalse(window.called)
+        body = json_decode(response.body)
+        self.assertIsNone(body['total_entries'])
+        self.assertIsNone(body['filtered_entries'])
+        self.assertEqual(len(body['surveys']), 2)
+
+    def test_count_none_with_fields(self):
+        url = self.api_root + '/surveys?count=none&fields=id'
+        response = self.fetch(url)
+        self.assertEqual(response.code, 200, msg=response.body)
+        body = json_decode(response.body)
+        self.assertEqual(len(body['surveys']), 14)
+        self.assertEqual(set(body['surveys'][0]), {'id'})
+
+    def test_count_none_submissions_by_user(self):
+        url = (
+            self.api_root + '/submissions?count=none'
+            '&user_id=b7becd02-1a3f-4c1d-a0e1-286ba121aef4'
+        )
+        response = self.fetch(url)
+        self.assertEqual(response.code, 200, msg=response.body)
+        self.assertIsNone(json_decode(response.body)['total_entries'])
+
+    def test_count_survey_submissions(self):
+        url = (
+            self.api_root +
+            '/surveys/b0816b52-204f-41d4-aaf0-ac6ae2970923/submissions'
+        )
+        exact = json_decode(self.fetch(url + '?count=exact').body)
+        self.assertEqual(
+            exact['total_entries'],
+            self.session.query(Submission).filter_by(
+                survey_id='b0816b52-204f-41d4-aaf0-ac6ae2970923'
+            ).count()
+        )
+
+        response = self.fetch(url + '?count=none')
+        self.assertEqual(response.code, 200, msg=response.body)
+        body = json_decode(response.body)
+        self.assertIsNone(body['total_entries'])
+        self.assertIsNone(body['filtered_entries'])
+
+        with patch(
+            'dokomoforms.handlers.api.v0.surveys.estimate_count',
+            return_value=42
+        ) as estimate:
+            response = self.fetch(url + '?count=estimate')
+        self.assertTrue(estimate.called)
+        self.assertEqual(json_decode(response.body)['total_entries'], 42)
+
+    def test_count_bogus(self):
+        response = self.fetch(self.api_root + '/surveys?count=sometimes')
+        self.assertEqual(response.code, 400)
+
+
+class TestSurveyChanges(DokoHTTPTest):
+    survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
+
+    def _changes(self, since=None, **kwargs):
+        url = self.api_root + '/surveys/' + self.survey_id + '/changes'
+        if since is not None:
+            url += '?since=' + since
+        return self.fetch(url, **kwargs)
+
+    def _touch(self, model, **values):
+        with self.session.begin():
+            for key, value in values.items():
+                setattr(model, key, value)
+            model.last_update_time = '2999-01-01T00:00:00+00:00'
+
+    def test_changes_without_since(self):
+        response = self._changes()
+        self.assertEqual(response.code, 200, msg=response.body)
+        changes = json_decode(response.body)
+        self.assertEqual(changes['survey_id'], self.survey_id)
+        self.assertIsNone(changes['since'])
+        self.assertIsNotNone(changes['until'])
+        self.assertEqual(changes['survey']['id'], self.survey_id)
+        survey = self.session.query(Survey).get(self.survey_id)
+        # ... including the nodes of the sub-surveys
+        self.assertLessEqual(
+            {survey_node.id for survey_node in survey.nodes},
+            {survey_node['id'] for survey_node in changes['survey_nodes']}
+        )
+        self.assertEqual(
+            {node['id'] for node in changes['nodes']},
+            {
+                survey_node['node_id']
+                for survey_node in changes['survey_nodes']
+            }
+        )
+        self.assertGreater(len(changes['sub_surveys']), 0)
+        self.assertGreater(len(changes['buckets']), 0)
+        self.assertEqual(
+            changes['deleted'],
+            {
+                'survey_nodes': [], 'nodes': [], 'choices': [],
+                'sub_surveys': [], 'buckets': [],
+            }
+        )
+
+    def test_until_is_before_open_transactions(self):
+        with engine.connect() as other:
+            with other.begin() as transaction:
+                started = other.execute('SELECT now()').scalar()
+                changes = json_decode(self._changes().body)
+                transaction.rollback()
+        # An edit in the other transaction would have this last_update_time
+        self.assertLessEqual(
+            dateutil.parser.parse(changes['until']), started
+        )
+
+    def test_changes_at_since(self):
+        survey = self.session.query(Survey).get(self.survey_id)
+        survey_node = survey.nodes[0]
+        self._touch(survey_node)
+        response = self._changes(since='2999-01-01T00:00:00Z')
+        changes = json_decode(response.body)
+        self.assertEqual(
+            [node['id'] for node in changes['survey_nodes']],
+            [survey_node.id]
+        )
+
+    def test_changes_since_later(self):
+        response = self._changes(since='2998-01-01T00:00:00Z')
+        self.assertEqual(response.code, 200, msg=response.body)
+        changes = json_decode(response.body)
+        self.assertIsNone(changes['survey'])
+        for kind in ('survey_nodes', 'nodes', 'choices', 'sub_surveys',
+                     'buckets'):
+            self.assertEqual(changes[kind], [], msg=kind)
+            self.assertEqual(changes['deleted'][kind], [], msg=kind)
+
+    def test_changed_node(self):
+        survey = self.session.query(Survey).get(self.survey_id)
+        node = survey.nodes[0].node
+        self._touch(node, hint={'English': 'changed'})
+        response = self._changes(since='2998-01-01T00:00:00Z')
+        self.assertEqual(response.code, 200, msg=response.body)
+        changes = json_decode(response.body)
+        self.assertEqual(len(changes['nodes']), 1)
+        self.assertEqual(changes['nodes'][0]['id'], node.id)
+        self.assertEqual(changes['nodes'][0]['hint'], {'English': 'changed'})
+        self.assertEqual(changes['survey_nodes'], [])
+
+    def test_deleted_node(self):
+        survey = self.session.query(Survey).get(self.survey_id)
+        node = survey.nodes[0].node
+        self._touch(node, deleted=True)
+        response = self._changes(since='2998-01-01T00:00:00Z')
+        self.assertEqual(response.code, 200, msg=response.body)
+        changes = json_decode(response.body)
+        self.assertEqual(changes['nodes'], [])
+        self.assertEqual(changes['deleted']['nodes'], [node.id])
+
+    def test_enumerator_only_survey_needs_login(self):
+        self.survey_id = 'c0816b52-204f-41d4-aaf0-ac6ae2970925'
+        response = self._changes(_logged_in_user=None)
+        self.assertEqual(response.code, 401)
+
+    def test_bogus_since(self):
+        response = self._changes(since='yesterday-ish')
+        self.assertEqual(response.code, 400)
+
+
+class TestSubmissionChanges(DokoHTTPTest):
+    def _changes(self, **params):
+        url = self.api_root + '/submissions/changes'
+        if params:
+            url = self.append_query_params(url, params)
+        response = self.fetch(url)
+        self.assertEqual(response.code, 200, msg=response.body)
+        return json_decode(response.body)
+
+    def _read_all(self, **params):
+        """Follow the feed until it catches up. Return the changes."""
+        submissions = []
+        page = self._changes(**params)
+        submissions.extend(page['submissions'])
+        while page['more']:
+            page = self._changes(cursor=page['next_cursor'], **params)
+            submissions.extend(page['submissions'])
+        return submissions, page['next_cursor']
+
+    def test_pages_cover_every_submission(self):
+        submissions, _ = self._read_all(limit=25)
+        ids = [submission['id'] for submission in submissions]
+        self.assertEqual(len(ids), TOTAL_SUBMISSIONS)
+        self.assertEqual(len(set(ids)), TOTAL_SUBMISSIONS)
+        positions = [
+            (dateutil.parser.parse(submission['last_update_time']), sub_id)
+            for submission, sub_id in zip(submissions, ids)
+        ]
+        self.assertEqual(positions, sorted(positions))
+
+    def test_caught_up(self):
+        _, cursor = self._read_all()
+        page = self._changes(cursor=cursor)
+        self.assertEqual(page['submissions'], [])
+        self.assertFalse(page['more'])
+        self.assertEqual(page['next_cursor'], cursor)
+
+    def test_deleted_submission_is_a_tombstone(self):
+        _, cursor = self._read_all()
+        submission_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970924'
+        response = self.fetch(
+            self.api_root + '/submissions/' + submission_id, method='DELETE'
+        )
+        self.assertEqual(response.code, 204)
+
+        page = self._changes(cursor=cursor)
+        self.assertEqual(len(page['submissions']), 1)
+        tombstone = page['submissions'][0]
+        self.assertEqual(
+            list(tombstone),
+            ['id', 'deleted', 'survey_id', 'last_update_time']
+        )
+        self.assertEqual(tombstone['id'], submission_id)
+        self.assertTrue(tombstone['deleted'])
+        self.assertNotEqual(page['next_cursor'], cursor)
+
+    def test_new_submission(self):
+        _, cursor = self._read_all()
+        survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
+        with self.session.begin():
+            survey = self.session.query(Survey).get(survey_id)
+            survey.submissions.append(models.construct_submission(
+                submission_type='public_submission', submitter_name='new',
+            ))
+
+        page = self._changes(cursor=cursor)
+        self.assertEqual(len(page['submissions']), 1)
+        self.assertEqual(page['submissions'][0]['submitter_name'], 'new')
+        self.assertEqual(page['submissions'][0]['answers'], [])
+
+    def test_survey_id(self):
+        survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
+        submissions, _ = self._read_all(survey_id=survey_id)
+        self.assertEqual(
+            len(submissions),
+            self.session.query(Submission).filter_by(survey_id=survey_id)
+            .count()
+        )
+        self.assertTrue(all(
+            submission['survey_id'] == survey_id for submission in submissions
+        ))
+
+    def test_bogus_cursor(self):
+        response = self.fetch(
+            self.api_root + '/submissions/changes?cursor=bogus'
+        )
+        self.assertEqual(response.code, 400)
+
+    def test_bad_limit(self):
+        response = self.fetch(self.api_root + '/submissions/changes?limit=0')
+        self.assertEqual(response.code, 400)
+
+    def test_requires_an_administrator(self):
+        response = self.fetch(
+            self.api_root + '/submissions/changes', _logged_in_user=None
+        )
+        self.assertEqual(response.code, 401)
+
+
+class TestWideExport(DokoHTTPTest):
+    def _export(self, survey_id):
+        response = self.fetch(
+            self.api_root + '/surveys/' + survey_id +
+            '/submissions?format=csv&layout=wide'
+        )
+        self.assertEqual(response.code, 200, msg=response.body)
+        self.assertEqual(
+            response.headers['Content-Type'], 'text/csv; charset=UTF-8'
+        )
+        with closing(StringIO(response.body.decode())) as csv_data:
+            return list(DictReader(csv_data))
+
+    def test_one_row_per_submission(self):
+        survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
+        rows = self._export(survey_id)
+        self.assertEqual(len(rows), 101)
+        survey = self.session.query(Survey).get(survey_id)
+        title = survey.nodes[0].node.title['English']
+        answered = next(
+            row for row in rows
+            if row['submission_id'] == 'b0816b52-204f-41d4-aaf0-ac6ae2970924'
+        )
+        self.assertEqual(answered['submitter_name'], 'regular_singular')
+        self.assertEqual(answered[title], '3')
+        self.assertTrue(all(
+            row[title] == '' for row in rows if row is not answered
+        ))
+
+    def test_columns_in_survey_order(self):
+        survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
+        response = self.fetch(
+            self.api_root + '/surveys/' + survey_id +
+            '/submissions?format=csv&layout=wide&dialect=unix'
+        )
+        header = response.body.decode().splitlines()[0]
+        survey = self.session.query(Survey).get(survey_id)
+        titles = [
+            '"{}"'.format(survey_node.node.title['English'])
+            for survey_node in survey._sequentialize(
+                include_non_answerable=False
+            )
+        ]
+        self.assertEqual(
+            header.split(',')[:8],
+            [
+                '"submission_id"', '"submission_type"', '"start_time"',
+                '"save_time"', '"submission_time"', '"submitter_name"',
+                '"submitter_email"', titles[0],
+            ]
+        )
+
+    def test_multiple_answers(self):
+        survey = {
+            'survey_type': 'public',
+            'title': {'English': 'wide'},
+            'nodes': [
+                {
+                    'node': {
+                        'title': {'English': 'numbers'},
+                        'type_constraint': 'integer',
+                        'allow_multiple': True,
+                    },
+                },
+                {
+                    'node': {
+                        'title': {'English': 'word'},
+                        'type_constraint': 'text',
+                    },
+                    'allow_dont_know': True,
+                },
+            ],
+        }
+        response = self.fetch(
+            self.api_root + '/surveys', method='POST',
+            body=json_encode(survey)
+        )
+        self.assertEqual(response.code, 201, msg=response.body)
+        survey = json_decode(response.body)
+        numbers, word = survey['nodes']
+
+        def answer(survey_node, response_type, response):
+            return {
+                'survey_node_id': survey_node['id'],
+                'type_constraint': survey_node['type_constraint'],
+                'response': {
+                    'response_type': response_type, 'response': response,
+                },
+            }
+
+        submission = {
+            'submitter_name': 'wide',
+            'submission_type': 'public_submission',
+            'answers': [
+                answer(numbers, 'answer', 1),
+                answer(numbers, 'answer', 2),
+                answer(word, 'dont_know', 'no idea'),
+            ],
+        }
+        response = self.fetch(
+            self.api_root + '/surveys/' + survey['id'] + '/submit',
+            method='POST', body=json_encode(submission)
+        )
+        self.assertEqual(response.code, 201, msg=response.body)
+
+        rows = self._export(survey['id'])
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['numbers_1'], '1')
+        self.assertEqual(rows[0]['numbers_2'], '2')
+        self.assertEqual(rows[0]['word'], 'no idea')
+        self.assertNotIn('numbers', rows[0])
+
+
+class TestWriteBehindIngest(DokoHTTPTest):
+    survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
+
+    def setUp(self):
+        super().setUp()
+        options.write_behind_ingest = True
+
+    def tearDown(self):
+        options.write_behind_ingest = False
+        super().tearDown()
+
+    def _submit(self, response):
+        body = {
+            'submitter_name': 'regular',
+            'submission_type': 'public_submission',
+            'answers': [
+                {
+                    'survey_node_id': '60e56824-910c-47aa-b5c0-71493277b43f',
+                    'type_constraint': 'integer',
+                    'response': {
+                        'response_type': 'answer',
+                        'response': response,
+                    },
+                },
+            ],
+        }
+        return self.fetch(
+            self.api_root + '/surveys/' + self.survey_id + '/submit',
+            method='POST', body=json_encode(body)
+        )
+
+    def test_submit_returns_receipt(self):
+        num_submissions = self.session.query(Submission).count()
+        response = self._submit(3)
+        self.assertEqual(response.code, 202, msg=response.body)
+        receipt = json_decode(response.body)
+        self.assertEqual(receipt['status'], 'queued')
+        self.assertIsNone(receipt['submission_id'])
+        self.assertEqual(
+            response.headers['Location'],
+            self.api_root + '/submissions/receipts/' + receipt['id']
+        )
+        self.assertEqual(
+            self.session.query(Submission).count(), num_submissions
+        )
+        self.assertEqual(self.app.metrics.ingested['submission'], 0)
+
+    def test_drain_accepts(self):
+        receipt = json_decode(self._submit(3).body)
+        self.assertEqual(self.app.ingest_queue.drain(), 1)
+        self.assertEqual(self.app.ingest_queue.drain(), 0)
+
+        response = self.fetch(
+            self.api_root + '/submissions/receipts/' + receipt['id'],
+            _logged_in_user=None
+        )
+        self.assertEqual(response.code, 200, msg=response.body)
+        receipt = json_decode(response.body)
+        self.assertEqual(receipt['status'], 'accepted')
+        self.assertIsNotNone(receipt['processed_time'])
+        submission = self.session.query(Submission).get(
+            receipt['submission_id']
+        )
+        self.assertEqual(submission.answers[0].response['response'], 3)
+        self.assertEqual(self.app.metrics.ingested['submission'], 1)
+
+    def test_drain_rejects_without_losing_the_batch(self):
+        bad = json_decode(self._submit('three').body)
+        good = json_decode(self._submit(3).body)
+        self.assertEqual(self.app.ingest_queue.drain(), 2)
+
+        self.session.expire_all()
+        bad = self.session.query(models.PendingSubmission).get(bad['id'])
+        good = self.session.query(models.PendingSubmission).get(good['id'])
+        self.assertEqual(bad.status, 'rejected')
+        self.assertIsNotNone(bad.error)
+        self.assertIsNone(bad.submission_id)
+        self.assertEqual(good.status, 'accepted')
+        self.assertIsNotNone(good.submission_id)
+
+    def test_drain_retry(self):
+        body = {
+            'submitter_name': 'regular',
+            'submission_type': 'public_submission',
+            'idempotency_key': 'retried',
+        }
+        url = self.api_root + '/surveys/' + self.survey_id + '/submit'
+        receipts = [
+            json_decode(
+                self.fetch(url, method='POST', body=json_encode(body)).body
+            ) for _ in range(2)
+        ]
+        self.assertEqual(self.app.ingest_queue.drain(), 2)
+
+        self.session.expire_all()
+        pending = [
+            self.session.query(models.PendingSubmission).get(receipt['id'])
+            for receipt in receipts
+        ]
+        self.assertEqual([p.status for p in pending], ['accepted'] * 2)
+        self.assertEqual(pending[0].submission_id, pending[1].submission_id)
+        self.assertEqual(self.app.metrics.ingested['submission'], 1)
+
+    def test_bogus_survey_node_is_rejected_right_away(self):
+        body = {
+            'submitter_name': 'regular',
+            'submission_type': 'public_submission',
+            'answers': [{
+                'survey_node_id': str(uuid.uuid4()),
+                'type_constraint': 'integer',
+                'response': {'response_type': 'answer', 'response': 3},
+            }],
+        }
+        response = self.fetch(
+            self.api_root + '/surveys/' + self.survey_id + '/submit',
+            method='POST', body=json_encode(body)
+        )
+        self.assertEqual(response.code, 400, msg=response.body)
+        self.assertEqual(
+            self.session.query(models.PendingSubmission).count(), 0
+        )
+
+    def test_unknown_receipt(self):
+        response = self.fetch(
+            self.api_root + '/submissions/receipts/' + str(uuid.uuid4())
+        )
+        self.assertEqual(response.code, 404)
+
+
+class TestExportJobs(DokoHTTPTest):
+    survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
+
+    def setUp(self):
+        super().setUp()
+        self.export_dir = options.export_dir
+        options.export_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(options.export_dir)
+        options.export_dir = self.export_dir
+        super().tearDown()
+
+    def _start(self, **body):
+        body.setdefault('survey_id', self.survey_id)
+        return self.fetch(
+            self.api_root + '/exports', method='POST', body=json_encode(body)
+        )
+
+    def _job(self, job_id):
+        response = self.fetch(self.api_root + '/exports/' + job_id)
+        self.assertEqual(response.code, 200, msg=response.body)
+        return json_decode(response.body)
+
+    def test_start_queues_a_job(self):
+        response = self._start()
+        self.assertEqual(response.code, 202, msg=response.body)
+        job = json_decode(response.body)
+        self.assertEqual(job['status'], 'queued')
+        self.assertEqual(job['layout'], 'long')
+        self.assertEqual(
+            response.headers['Location'],
+            self.api_root + '/exports/' + job['id']
+        )
+        self.assertEqual(os.listdir(options.export_dir), [])
+
+    def test_run_and_download(self):
+        job = json_decode(self._start().body)
+        self.app.export_jobs.run(job['id'])
+
+        job = self._job(job['id'])
+        self.assertEqual(job['status'], 'done', msg=job['error'])
+        self.assertIsNotNone(job['finished_time'])
+        self.assertEqual(job['rows_written'], job['rows_total'])
+        self.assertGreater(job['rows_written'], 0)
+
+        response = self.fetch(
+            self.api_root + '/exports/' + job['id'] + '/download'
+        )
+        self.assertEqual(response.code, 200, msg=response.body)
+        self.assertEqual(
+            response.headers['Content-Type'], 'text/csv; charset=UTF-8'
+        )
+        self.assertIn('_long_', response.headers['Content-Disposition'])
+        with closing(StringIO(response.body.decode())) as csv_data:
+            rows = list(DictReader(csv_data))
+        self.assertEqual(len(rows), job['rows_written'])
+        self.assertEqual(
+            {row['survey_id'] for row in rows}, {self.survey_id}
+        )
+
+    def test_wide_layout(self):
+        job = json_decode(self._start(layout='wide').body)
+        self.app.export_jobs.run(job['id'])
+
+        response = self.fetch(
+            self.api_root + '/exports/' + job['id'] + '/download'
+        )
+        self.assertEqual(response.code, 200, msg=response.body)
+        with closing(StringIO(response.body.decode())) as csv_data:
+            rows = list(DictReader(csv_data))
+        self.assertEqual(len(rows), 101)
+        self.assertEqual(self._job(job['id'])['rows_written'], 101)
+
+    def test_unchanged_data_reuses_the_file(self):
+        first = json_decode(self._start().body)
+        self.app.export_jobs.run(first['id'])
+
+        response = self._start()
+        self.assertEqual(response.code, 202, msg=response.body)
+        second = json_decode(response.body)
+        self.assertEqual(second['id'], first['id'])
+        self.assertEqual(second['status'], 'done')
+        self.assertEqual(len(os.listdir(options.export_dir)), 1)
+
+    def test_same_export_while_queued(self):
+        first = json_decode(self._start().body)
+        second = json_decode(self._start().body)
+        self.assertEqual(second['id'], first['id'])
+        other = json_decode(self._start(dialect='excel-tab').body)
+        self.assertNotEqual(other['id'], first['id'])
+
+    def test_changed_answer_changes_the_artifact_key(self):
+        survey = self.session.query(Survey).get(self.survey_id)
+        key = models.artifact_key(self.session, survey, 'long', 'excel')
+        answer = (
+            self.session
+            .query(models.Answer)
+            .filter_by(survey_id=self.survey_id)
+            .first()
+        )
+        submission = answer.submission_id
+        submission_time = (
+            self.session.query(Submission).get(submission).last_update_time
+        )
+        with self.session.begin():
+            # e.g., a photo uploaded for a PhotoAnswer
+            answer.last_update_time = '2999-01-01T00:00:00+00:00'
+        self.assertEqual(
+            self.session.query(Submission).get(submission).last_update_time,
+            submission_time
+        )
+        self.assertNotEqual(
+            models.artifact_key(self.session, survey, 'long', 'excel'), key
+        )
+
+    def test_new_submission_replaces_the_file(self):
+        first = json_decode(self._start().body)
+        self.app.export_jobs.run(first['id'])
+        with self.session.begin():
+            survey = self.session.query(Survey).get(self.survey_id)
+            survey.submissions.append(models.construct_submission(
+                submission_type='public_submission',
+                submitter_name='new',
+            ))
+
+        second = json_decode(self._start().body)
+        self.assertNotEqual(second['id'], first['id'])
+        self.assertEqual(second['status'], 'queued')
+        self.app.export_jobs.run(second['id'])
+        self.assertEqual(len(os.listdir(options.export_dir)), 1)
+        self.assertEqual(
+            self._job(second['id'])['rows_written'],
+            self._job(first['id'])['rows_written']
+        )
+
+    def test_bad_layout(self):
+        response = self._start(layout='tall')
+        self.assertEqual(response.code, 400, msg=response.body)
+
+    def test_bad_dialect(self):
+        response = self._start(dialect='bogus')
+        self.assertEqual(response.code, 400, msg=response.body)
+
+    def test_unknown_survey(self):
+        response = self._start(survey_id=str(uuid.uuid4()))
+        self.assertEqual(response.code, 400, msg=response.body)
+
+    def test_download_before_done(self):
+        job = json_decode(self._start().body)
+        response = self.fetch(
+            self.api_root + '/exports/' + job['id'] + '/download'
+        )
+        self.assertEqual(response.code, 404, msg=response.body)
+
+
+class TestFacilityProxy(DokoHTTPTest):
+    def setUp(self):
+        super().setUp()
+        self.revisit_url = options.revisit_url
+        options.revisit_url = self.get_url('/debug/facilities')
+
+    def tearDown(self):
+        try:
+            options.revisit_url = self.revisit_url
+            self.fetch('/debug/toggle_facilities?state=true')
+        finally:
+            super().tearDown()
+
+    def _facilities_url(self, query='compressed=true'):
+        return self.api_root + '/facilities?' + query
+
+    def test_get(self):
+        revisit_response = self.fetch('/debug/facilities')
+        response = self.fetch(self._facilities_url())
+        self.assertEqual(response.code, 200, msg=response.body)
+        self.assertEqual(response.body, revisit_response.body)
+        self.assertIn('X-Facilities-As-Of', response.headers)
+        self.assertEqual(len(self.app.facility_cache), 1)
+
+    def test_get_gzipped(self):
+        response = self.fetch(
+            self._facilities_url(),
+            headers={'Accept-Encoding': 'gzip'},
+            decompress_response=False,
+        )
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(
+            gzip.decompress(response.body),
+            self.fetch('/debug/facilities').body
+        )
+
+    def test_vary_without_response_compression(self):
+        options.compress_response = False
+        self.app.transforms = []
+        try:
+            response = self.fetch(
+                self._facilities_url(), decompress_response=False
+            )
+        finally:
+            options.compress_response = True
+        self.assertEqual(response.code, 200, msg=response.body)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+
+    def test_cached_per_bounding_box(self):
+        self.fetch(self._facilities_url('within=1,2,3,4'))
+        self.fetch(self._facilities_url('within=1,2,3,4'))
+        self.assertEqual(len(self.app.facility_cache), 1)
+        self.fetch(self._facilities_url('within=5,6,7,8'))
+        self.assertEqual(len(self.app.facility_cache), 2)
+
+    def test_revisit_offline_serves_cache(self):
+        response = self.fetch(self._facilities_url())
+        self.fetch('/debug/toggle_facilities?state=false')
+        for cached in self.app.facility_cache.values():
+            cached.expire()
+
+        stale_response = self.fetch(self._facilities_url())
+        self.assertEqual(stale_response.code, 200)
+        self.assertEqual(stale_response.body, response.body)
+
+    def test_revisit_offline_nothing_cached(self):
+        self.fetch('/debug/toggle_facilities?state=false')
+        response = self.fetch(self._facilities_url())
+        self.assertEqual(response.code, 502)
+
+    def test_delta_nothing_changed(self):
+        response = self.fetch(self._facilities_url())
+        as_of = response.headers['X-Facilities-As-Of']
+
+        delta_response = self.fetch(
+            self._facilities_url('compressed=true&updatedAt=' + as_of)
+        )
+        self.assertEqual(delta_response.code, 200, msg=delta_response.body)
+        delta = json_decode(delta_response.body)
+        self.assertEqual(delta['facilities'], [])
+        self.assertEqual(delta['count'], 0)
+        self.assertEqual(delta['removed'], [])
+        self.assertEqual(delta['updatedAt'], as_of)
+
+    def test_delta_everything_is_new(self):
+        delta_response = self.fetch(
+            self._facilities_url('compressed=true&updatedAt=')
+        )
+        delta = json_decode(delta_response.body)
+        self.assertEqual(delta['count'], 198)
+
+    def test_post_then_delta(self):
+        response = self.fetch(self._facilities_url())
+        as_of = response.headers['X-Facilities-As-Of']
+
+        facility = {
+            'uuid': str(uuid.uuid4()),
+            'name': 'new facility',
+            'coordinates': [0, 0],
+            'properties': {'sector': 'health'},
+        }
+        post_response = self.fetch(
+            self.api_root + '/facilities', method='POST',
+            body=json_encode(facility),
+        )
+        self.assertEqual(post_response.code, 201, msg=post_response.body)
+
+        delta_response = self.fetch(
+            self._facilities_url('compressed=true&updatedAt=' + as_of)
+        )
+        delta = json_decode(delta_response.body)
+        self.assertEqual(delta['count'], 1)
+        self.assertEqual(delta['facilities'][0]['uuid'], facility['uuid'])
+        self.assertGreater(delta['updatedAt'], as_of)
+
+    def test_delta_full(self):
+        delta_response = self.fetch(self._facilities_url(
+            'compressed=true&updatedAt=2000-01-01T00:00:00.000Z'
+        ))
+        delta = json_decode(delta_response.body)
+        self.assertTrue(delta['full'])
+        self.assertEqual(delta['count'], 198)
+        self.assertEqual(delta['removed'], [])
+
+    def test_delta_after_eviction_is_full(self):
+        response = self.fetch(self._facilities_url())
+        as_of = response.headers['X-Facilities-As-Of']
+        self.assertFalse(json_decode(self.fetch(
+            self._facilities_url('compressed=true&updatedAt=' + as_of)
+        ).body)['full'])
+
+        # e.g., a restart, or another process
+        self.app.facility_cache.clear()
+        later = '2999-01-01T00:00:00.000Z'
+        with patch(
+            'dokomoforms.handlers.api.v0.facilities._iso_now',
+            return_value=later
+        ):
+            delta_response = self.fetch(
+                self._facilities_url('compressed=true&updatedAt=' + as_of)
+            )
+        delta = json_decode(delta_response.body)
+        self.assertTrue(delta['full'])
+        self.assertEqual(delta['count'], 198)
+        self.assertEqual(delta['updatedAt'], later)
+
+    def test_concurrent_misses_share_a_fetch(self):
+        fetch_facilities = BaseFacilityHandler._fetch_facilities
+        calls = []
+
+        def counting(handler, *args):
+            calls.append(args)
+            return fetch_facilities(handler, *args)
+
+        responses = []
+
+        def done(response):
+            responses.append(response)
+            if len(responses) == 3:
+                self.stop()
+
+        with patch.object(
+            BaseFacilityHandler, '_fetch_facilities', autospec=True,
+            side_effect=counting
+        ):
+            for _ in range(3):
+                self.http_client.fetch(
+                    self.get_url(self._facilities_url()), done
+                )
+            self.wait()
+        self.assertEqual([r.code for r in responses], [200] * 3)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.app.facility_fetches, {})
+
+    def test_post_revisit_offline(self):
+        self.fetch('/debug/toggle_facilities?state=false')
+        response = self.fetch(
+            self.api_root + '/facilities', method='POST', body='{}'
+        )
+        self.assertEqual(response.code, 502)
+
+
+class TestFacilityIndex(unittest.TestCase):
+    def _facility(self, uuid, lat, lng):
+        return {'uuid': uuid, 'coordinates': [lng, lat]}
+
+    def setUp(self):
+        self.index = FacilityIndex(
+            self._facility('{}_{}'.format(lat, lng), lat, lng)
+            for lat in range(-80, 81, 10) for lng in range(-180, 180, 10)
+        )
+
+    def test_nearest(self):
+        found = self.index.nearest(1, 1, k=1)
+        self.assertEqual(len(found), 1)
+        distance, facility = found[0]
+        self.assertEqual(facility['uuid'], '0_0')
+        # About 157 km
+        self.assertAlmostEqual(distance / 1000, 157.2, delta=0.5)
+
+    def test_nearest_k(self):
+        found = self.index.nearest(0, 5, k=2)
+        self.assertEqual(
+            {facility['uuid'] for _, facility in found}, {'0_0', '0_10'}
+        )
+        self.assertLessEqual(found[0][0], found[1][0])
+
+    def test_nearest_across_antimeridian(self):
+        distance, facility = self.index.nearest(0, 179, k=1)[0]
+        self.assertEqual(facility['uuid'], '0_-180')
+
+    def test_within(self):
+        found = self.index.within(0, 0, 1200000)
+        self.assertEqual(
+            {facility['uuid'] for _, facility in found},
+            {'0_0', '10_0', '-10_0', '0_10', '0_-10'}
+        )
+
+    def test_within_zero_radius(self):
+        found = self.index.within(0, 0, 0)
+        self.assertEqual([facility['uuid'] for _, facility in found], ['0_0'])
+
+    def test_add(self):
+        self.index.add(self._facility('new', 1, 1))
+        self.assertIn('new', self.index)
+        self.assertEqual(self.index.nearest(1, 1)[0][1]['uuid'], 'new')
+
+    def test_add_moves_facility(self):
+        self.index.add(self._facility('0_0', 45, 45))
+        self.assertEqual(self.index.nearest(0, 0)[0][1]['uuid'], '10_0')
+        self.assertEqual(self.index.nearest(45, 45)[0][1]['uuid'], '0_0')
+
+    def test_remove(self):
+        self.index.remove('0_0')
+        self.assertNotIn('0_0', self.index)
+        self.assertNotEqual(self.index.nearest(0, 0)[0][1]['uuid'], '0_0')
+
+    def test_rebuild_after_many_changes(self):
+        num_facilities = len(self.index)
+        for i in range(100):
+            self.index.add(self._facility('new_{}'.format(i), 85, i))
+        self.assertEqual(len(self.index), num_facilities + 100)
+        self.assertLessEqual(
+            len(self.index._pending), FacilityIndex.min_pending
+        )
+        self.assertEqual(
+            self.index.nearest(85, 50.2)[0][1]['uuid'], 'new_50'
+        )
+
+    def test_ignores_facility_without_coordinates(self):
+        num_facilities = len(self.index)
+        self.index.add({'uuid': 'nowhere'})
+        self.assertEqual(len(self.index), num_facilities)
+
+
+class TestFacilitySearch(DokoHTTPTest):
+    def setUp(self):
+        super().setUp()
+        self.revisit_url = options.revisit_url
+        options.revisit_url = self.get_url('/debug/facilities')
+
+    def tearDown(self):
+        try:
+            options.revisit_url = self.revisit_url
+        finally:
+            super().tearDown()
+
+    def test_nearest(self):
+        response = self.fetch(
+            self.api_root +
+            '/facilities/nearest?lat=40.6&lng=-74.15&k=3&compressed=true'
+            '&within=41,-75,40,-74'
+        )
+        self.assertEqual(response.code, 200, msg=response.body)
+        body = json_decode(response.body)
+        self.assertEqual(body['count'], 3)
+        distances = [facility['distance'] for facility in body['facilities']]
+        self.assertEqual(distances, sorted(distances))
+        self.assertEqual(len(self.app.facility_index), 198)
+
+    def test_nearest_includes_posted_facility(self):
+        self.fetch(self.api_root + '/facilities?compressed=true')
+        facility = {
+            'uuid': str(uuid.uuid4()),
+            'name': 'new facility',
+            'coordinates': [10, 10],
+            'properties': {},
+        }
+        self.fetch(
+            self.api_root + '/facilities', method='POST',
+            body=json_encode(facility),
+        )
+        self.assertIn(facility['uuid'], self.app.facility_index)
+
+    def test_nearest_bad_k(self):
+        response = self.fetch(
+            self.api_root + '/facilities/nearest?lat=0&lng=0&k=0'
+        )
+        self.assertEqual(response.code, 400)
+
+    def test_nearest_missing_lat(self):
+        response = self.fetch(self.api_root + '/facilities/nearest?lng=0')
+        self.assertEqual(response.code, 400)
+
+    def test_within(self):
+        response = self.fetch(
+            self.api_root +
+            '/facilities/within?lat=40.6&lng=-74.15&radius=1000'
+            '&compressed=true&within=41,-75,40,-74'
+        )
+        self.assertEqual(response.code, 200, msg=response.body)
+        body = json_decode(response.body)
+        self.assertEqual(body['count'], len(body['facilities']))
+        for facility in body['facilities']:
+            self.assertLessEqual(facility['distance'], 1000)
+
+    def test_search_requires_within(self):
+        for search in ('nearest?lat=0&lng=0', 'within?lat=0&lng=0&radius=1'):
+            response = self.fetch(self.api_root + '/facilities/' + search)
+            self.assertEqual(response.code, 400)
+            response = self.fetch(
+                self.api_root + '/facilities/' + search + '&within=north'
+            )
+            self.assertEqual(response.code, 400)
+        self.assertEqual(len(self.app.facility_cache), 0)
+
+    def test_within_bad_radius(self):
+        response = self.fetch(
+            self.api_root + '/facilities/within?lat=0&lng=0&radius=far'
+        )
+        self.assertEqual(response.code, 400)
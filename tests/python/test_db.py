@@ -1,13 +1,132 @@
 """Database interaction tests."""
 from tests.python.util import (
-    DokoTest, setUpModule, tearDownModule
+    DokoTest, engine, setUpModule, tearDownModule
 )
 utils = (setUpModule, tearDownModule)
 
+import random
+import unittest
+
+import sqlalchemy as sa
+from sqlalchemy.sql.functions import count
+
+from dokomoforms.exc import SchemaVersionError
 from dokomoforms.models import Base
+import dokomoforms.models as models
+from dokomoforms.models.migrations import (
+    MIGRATIONS, current_version, schema_version, _create_index_concurrently
+)
+from tests.python.synthetic_data import construct_synthetic_survey, generate
 
 
 class TestSchema(DokoTest):
     def test_schema_set_properly(self):
         """It took a lot of effort to make Tornado use a testing schema."""
         self.assertEqual(Base.metadata.schema, 'doko_test')
+
+
+class TestMigrations(unittest.TestCase):
+    def tearDown(self):
+        engine.execute(schema_version.delete())
+        super().tearDown()
+
+    def test_existing_schema(self):
+        # The test schema comes from create_all, with no recorded versions
+        with engine.connect() as connection:
+            self.assertEqual(current_version(connection), 0)
+        self.assertRaises(
+            SchemaVersionError, models.check_schema_version, engine
+        )
+
+        applied = models.migrate(engine)
+        self.assertEqual(
+            applied, [migration.version for migration in MIGRATIONS]
+        )
+        self.assertEqual(
+            models.check_schema_version(engine), models.LATEST_VERSION
+        )
+        self.assertEqual(models.migrate(engine), [])
+
+    def test_newer_schema(self):
+        models.migrate(engine)
+        engine.execute(schema_version.insert().values(
+            version=models.LATEST_VERSION + 1, description='from the future'
+        ))
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(
+                models.check_schema_version(engine), models.LATEST_VERSION + 1
+            )
+
+    def test_invalid_index_gets_rebuilt(self):
+        index_valid = (
+            'SELECT indisvalid FROM pg_index'
+            " WHERE indexrelid = 'doko_test.ix_scratch_value'::regclass"
+        )
+        with engine.connect() as connection:
+            connection = connection.execution_options(
+                isolation_level='AUTOCOMMIT'
+            )
+            connection.execute('CREATE TABLE doko_test.scratch (value INT)')
+            try:
+                connection.execute(
+                    'INSERT INTO doko_test.scratch VALUES (1), (1)'
+                )
+                # The duplicates leave an INVALID index behind
+                with self.assertRaises(sa.exc.IntegrityError):
+                    _create_index_concurrently(
+                        connection, 'ix_scratch_value', 'scratch', ['value'],
+                        unique=True,
+                    )
+                self.assertFalse(connection.execute(index_valid).scalar())
+
+                connection.execute('DELETE FROM doko_test.scratch')
+                with self.assertLogs(level='WARNING'):
+                    _create_index_concurrently(
+                        connection, 'ix_scratch_value', 'scratch', ['value'],
+                        unique=True,
+                    )
+                self.assertTrue(connection.execute(index_valid).scalar())
+            finally:
+                connection.execute('DROP TABLE doko_test.scratch')
+
+
+class TestSyntheticData(DokoTest):
+    def test_construct_survey_is_deterministic(self):
+        def node_ids(seed):
+            survey = construct_synthetic_survey(
+                random.Random(seed), models.Administrator(name='a'), 0
+            )
+            return [survey.id] + [
+                survey_node.node.id for survey_node in survey.nodes
+            ]
+
+        self.assertEqual(node_ids(1), node_ids(1))
+        self.assertNotEqual(node_ids(1), node_ids(2))
+
+    def test_construct_survey_has_every_node_type(self):
+        survey = construct_synthetic_survey(
+            random.Random(1), models.Administrator(name='a'), 0
+        )
+        self.assertEqual(
+            {survey_node.node.type_constraint for survey_node in survey.nodes},
+            set(models.NODE_TYPES)
+        )
+
+    def test_generate(self):
+        counts = generate(
+            self.session, num_surveys=2, submissions_per_survey=7, seed=1,
+            batch_size=3,
+        )
+        self.assertEqual(counts['submission'], 14)
+        self.assertEqual(
+            self.session.query(count(models.Submission.id)).scalar(), 14
+        )
+        self.assertEqual(
+            self.session.query(count(models.Answer.id)).scalar(),
+            counts['answer']
+        )
+        # The ORM can read back every answer
+        for submission in self.session.query(models.Submission):
+            self.assertTrue(submission.answers)
+            for answer in submission.answers:
+                self.assertIsNotNone(answer.response)
@@ -1,4 +1,12 @@
 """Handler tests"""
+import gzip
+import os
+import pstats
+import shutil
+import tempfile
+from time import time
+from types import SimpleNamespace
+import unittest
 from unittest.mock import patch
 import uuid
 
@@ -13,17 +21,25 @@ from sqlalchemy.dialects import postgresql as pg
 from tornado.escape import json_decode, json_encode, url_escape
 import tornado.gen
 import tornado.httpclient
+import tornado.httputil
 import tornado.testing
 
 from tests.python.util import (
-    DokoHTTPTest, setUpModule, tearDownModule
+    DokoHTTPTest, Session, engine, setUpModule, tearDownModule
 )
 
 utils = (setUpModule, tearDownModule)
 
+from dokomoforms.options import options
+from webapp import Application, warm_up
+
 import dokomoforms.handlers as handlers
+import dokomoforms.handlers.api.v0 as api_v0
 import dokomoforms.handlers.auth
-from dokomoforms.handlers.util import BaseHandler, BaseAPIHandler
+from dokomoforms.handlers.metrics import Histogram
+from dokomoforms.handlers.util import (
+    BaseHandler, BaseAPIHandler, LRUCache, accepted_encodings
+)
 import dokomoforms.models as models
 
 
@@ -206,6 +222,481 @@ class TestHeaders(DokoHTTPTest):
         self.assertIn('Content-Security-Policy', response.headers)
 
 
+class TestQueryStats(DokoHTTPTest):
+    def test_server_timing_header(self):
+        response = self.fetch(self.api_root + '/surveys', method='GET')
+        self.assertEqual(response.code, 200, msg=response.body)
+        server_timing = response.headers['Server-Timing']
+        self.assertTrue(server_timing.startswith('db;dur='), msg=server_timing)
+        self.assertNotIn('desc="0 queries', server_timing)
+
+    def test_access_log(self):
+        survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
+        with self.assertLogs('tornado.access') as logs:
+            response = self.fetch(
+                self.api_root + '/surveys/' + survey_id, method='GET',
+                headers={'X-Request-Id': 'abc123'},
+            )
+        self.assertEqual(response.headers['X-Request-Id'], 'abc123')
+        record = json_decode(logs.records[-1].getMessage())
+        self.assertEqual(record['request_id'], 'abc123')
+        self.assertEqual(record['route'], 'survey')
+        self.assertEqual(record['method'], 'GET')
+        self.assertEqual(record['status'], 200)
+        self.assertGreater(record['queries'], 0)
+        self.assertIn('db_ms', record)
+        self.assertNotIn('sample_rate', record)
+
+    def test_access_log_request_id(self):
+        response = self.fetch('/')
+        self.assertEqual(len(response.headers['X-Request-Id']), 32)
+
+    def test_access_log_sampling(self):
+        self.app.access_log_sampling = {'index': 0.0, 'NotFound': 0.0}
+        with self.assertLogs('tornado.access') as logs:
+            self.fetch('/')
+            # Errors always get logged
+            self.fetch('/nope')
+            self.app.access_log_sampling['index'] = 1.0
+            self.fetch('/')
+        records = [
+            json_decode(record.getMessage()) for record in logs.records
+        ]
+        self.assertEqual(
+            [(record['route'], record['status']) for record in records],
+            [('NotFound', 404), ('index', 200)]
+        )
+        self.assertNotIn('sample_rate', records[0])
+        self.assertEqual(records[1]['sample_rate'], 1.0)
+
+    def test_n_plus_one_warning(self):
+        stats = models.QueryStats('survey', n_plus_one_threshold=2)
+        with self.assertLogs(level='WARNING') as logs:
+            for _ in range(5):
+                stats.record('SELECT 1', 0.001, 1)
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn('survey', logs.records[0].getMessage())
+        self.assertEqual(stats.queries, 5)
+        self.assertEqual(stats.rows, 5)
+
+    def test_counts_statements(self):
+        stats = models.QueryStats()
+        models.activate_query_stats(stats)
+        try:
+            self.session.execute('SELECT 1')
+        finally:
+            models.activate_query_stats(None)
+        self.assertEqual(stats.queries, 1)
+        self.assertEqual(stats.statements['SELECT 1'], 1)
+
+
+class TestSlowQueries(DokoHTTPTest):
+    def setUp(self):
+        super().setUp()
+        models.slow_queries.clear()
+        options.slow_query_threshold = 0
+
+    def tearDown(self):
+        options.slow_query_threshold = 200
+        models.slow_queries.clear()
+        super().tearDown()
+
+    def test_slow_query_log(self):
+        survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
+        with self.assertLogs('dokomoforms.slow_queries', level='WARNING'):
+            self.fetch(self.api_root + '/surveys/' + survey_id, method='GET')
+        models.slow_queries.wait_for_plans()
+
+        slow = self.fetch('/admin/slow-queries', method='GET')
+        self.assertEqual(slow.code, 200, msg=slow.body)
+        slow_queries = json_decode(slow.body)['slow_queries']
+        self.assertGreater(len(slow_queries), 0)
+        survey_queries = [
+            query for query in slow_queries if 'survey' in query['routes']
+        ]
+        self.assertGreater(len(survey_queries), 0)
+        explained = [
+            query for query in survey_queries if query['plan'] is not None
+        ]
+        self.assertGreater(len(explained), 0)
+        self.assertIn('Plan', explained[0]['plan'][0])
+        self.assertIn('Total Cost', explained[0]['plan'][0]['Plan'])
+        self.assertNotIn('Actual Rows', explained[0]['plan'][0]['Plan'])
+
+    def test_explain_does_not_run_the_statement(self):
+        lock_key = 409031
+        statement = 'SELECT pg_advisory_lock(%(key)s)'
+        with self.assertLogs('dokomoforms.slow_queries', level='WARNING'):
+            slow_query = models.slow_queries.record(
+                engine, statement, {'key': lock_key}, 1.0
+            )
+        models.slow_queries.wait_for_plans()
+        self.assertIsNotNone(slow_query.plan)
+        held = self.session.execute(
+            "SELECT count(*) FROM pg_locks WHERE locktype = 'advisory'"
+            ' AND objid = :key',
+            {'key': lock_key},
+        ).scalar()
+        self.assertEqual(held, 0)
+
+    def test_aggregates_by_shape(self):
+        for ids in (['a'], ['a', 'b', 'c']):
+            self.session.execute(
+                sa.select([sa.literal(1)]).where(sa.literal('a').in_(ids))
+            )
+        shapes = [
+            query for query in models.slow_queries.worst()
+            if 'IN (%(...)s)' in query.shape
+        ]
+        self.assertEqual(len(shapes), 1)
+        self.assertEqual(shapes[0].count, 2)
+
+    def test_slow_queries_requires_administrator(self):
+        response = self.fetch(
+            '/admin/slow-queries', method='GET', follow_redirects=False,
+            _logged_in_user=None,
+        )
+        self.assertEqual(response.code, 302)
+
+
+class TestWarmUp(DokoHTTPTest):
+    def test_warm_up(self):
+        self.app.response_cache.clear()
+        seconds = warm_up(self.app, num_surveys=2)
+        self.assertGreater(seconds, 0)
+        warm_up_requests = sum(
+            count for (route, _), count in self.app.metrics.responses.items()
+            if route == 'survey'
+        )
+        self.assertEqual(warm_up_requests, 2)
+        # The most active survey is public, so its response got cached
+        self.assertGreaterEqual(len(self.app.response_cache), 1)
+
+    def test_warm_up_no_surveys(self):
+        self.app.response_cache.clear()
+        warm_up(self.app, num_surveys=0)
+        self.assertEqual(len(self.app.response_cache), 0)
+
+
+class TestMetrics(DokoHTTPTest):
+    def setUp(self):
+        super().setUp()
+        options.metrics_local = True
+
+    def tearDown(self):
+        options.metrics_local = False
+        super().tearDown()
+
+    def test_histogram(self):
+        histogram = Histogram((0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+        self.assertEqual(
+            list(histogram.cumulative()), [(0.1, 2), (1.0, 3), ('+Inf', 4)]
+        )
+        self.assertEqual(histogram.count, 4)
+        self.assertAlmostEqual(histogram.sum, 2.65)
+
+    def test_metrics(self):
+        self.fetch('/', method='GET', _logged_in_user=None)
+        self.fetch(self.api_root + '/surveys', method='GET')
+        response = self.fetch('/metrics', method='GET', _logged_in_user=None)
+        self.assertEqual(response.code, 200, msg=response.body)
+        self.assertTrue(
+            response.headers['Content-Type'].startswith('text/plain')
+        )
+        text = response.body.decode()
+        self.assertIn(
+            'dokomoforms_request_duration_seconds_count{route="index"} 1',
+            text
+        )
+        self.assertIn(
+            'dokomoforms_responses_total{route="surveys",status="200"} 1',
+            text
+        )
+        self.assertIn('dokomoforms_ingested_total{kind="submission"} 0', text)
+        self.assertIn('dokomoforms_cache_hit_ratio{cache="response"}', text)
+
+    def test_metrics_not_local(self):
+        options.metrics_local = False
+        response = self.fetch('/metrics', method='GET', _logged_in_user=None)
+        self.assertEqual(response.code, 403)
+        response = self.fetch('/metrics', method='GET')
+        self.assertEqual(response.code, 200)
+
+    def test_metrics_proxied(self):
+        for header in ('X-Real-IP', 'X-Forwarded-For'):
+            response = self.fetch(
+                '/metrics', method='GET', _logged_in_user=None,
+                headers={header: '203.0.113.7'}
+            )
+            self.assertEqual(response.code, 403, msg=header)
+        response = self.fetch(
+            '/metrics', method='GET', headers={'X-Real-IP': '203.0.113.7'}
+        )
+        self.assertEqual(response.code, 200)
+
+    def test_ioloop_lag(self):
+        self.app.metrics.monitor_ioloop(0.01, self.io_loop)
+        self.io_loop.call_later(0.05, self.stop)
+        self.wait()
+        self.assertGreater(self.app.metrics.ioloop_lag.count, 0)
+        response = self.fetch('/metrics', method='GET')
+        self.assertIn(
+            'dokomoforms_ioloop_lag_seconds_count', response.body.decode()
+        )
+
+
+class TestProfiling(DokoHTTPTest):
+    def setUp(self):
+        super().setUp()
+        self.profile_dir = tempfile.mkdtemp()
+        options.profile_dir = self.profile_dir
+
+    def tearDown(self):
+        shutil.rmtree(self.profile_dir)
+        options.profile_dir = 'profiles'
+        options.profile_sample_rate = 0.0
+        options.profile_keep = 100
+        super().tearDown()
+
+    def test_profile_request(self):
+        response = self.fetch(
+            self.api_root + '/surveys', method='GET',
+            headers={'X-Profile': '1'},
+        )
+        self.assertEqual(response.code, 200, msg=response.body)
+        profile_url = response.headers['X-Profile']
+        self.assertTrue(profile_url.startswith('/admin/profiles/'))
+        self.assertTrue(profile_url.endswith('.pstats'))
+
+        listing = json_decode(self.fetch('/admin/profiles').body)
+        self.assertEqual(
+            listing['profiles'], [profile_url.rsplit('/', 1)[-1]]
+        )
+
+        profile_response = self.fetch(profile_url, method='GET')
+        self.assertEqual(profile_response.code, 200)
+        profile_file = os.path.join(self.profile_dir, 'downloaded.pstats')
+        with open(profile_file, 'wb') as downloaded:
+            downloaded.write(profile_response.body)
+        stats = pstats.Stats(profile_file)
+        self.assertGreater(stats.total_calls, 0)
+
+    def test_profile_query_argument(self):
+        response = self.fetch(
+            self.api_root + '/surveys?profile=true', method='GET'
+        )
+        self.assertIn('X-Profile', response.headers)
+
+    def test_profile_requires_administrator(self):
+        response = self.fetch(
+            '/', method='GET', headers={'X-Profile': '1'},
+            _logged_in_user=None,
+        )
+        self.assertEqual(response.code, 200)
+        self.assertNotIn('X-Profile', response.headers)
+        response = self.fetch(
+            '/admin/profiles', method='GET', follow_redirects=False,
+            _logged_in_user=None,
+        )
+        self.assertEqual(response.code, 302)
+
+    def test_profile_not_found(self):
+        response = self.fetch('/admin/profiles/nope.pstats', method='GET')
+        self.assertEqual(response.code, 404)
+
+    def test_sampled_profiles(self):
+        options.profile_sample_rate = 1.0
+        options.profile_keep = 2
+        for _ in range(3):
+            response = self.fetch('/', method='GET', _logged_in_user=None)
+            self.assertIn('X-Profile', response.headers)
+        self.assertEqual(len(os.listdir(self.profile_dir)), 2)
+
+
+class TestCompression(unittest.TestCase):
+    def _request(self, accept_encoding):
+        return tornado.httputil.HTTPServerRequest(
+            uri='/', headers=tornado.httputil.HTTPHeaders(
+                {'Accept-Encoding': accept_encoding}
+            )
+        )
+
+    def test_accepted_encodings(self):
+        request = self._request('gzip, deflate;q=0.5, BR')
+        self.assertEqual(
+            accepted_encodings(request), {'gzip', 'deflate', 'br'}
+        )
+
+    def test_accepted_encodings_q_zero(self):
+        request = self._request('gzip;q=0, br;q=1.0')
+        self.assertEqual(accepted_encodings(request), {'br'})
+
+    def test_accepted_encodings_none(self):
+        request = self._request('')
+        self.assertEqual(accepted_encodings(request), set())
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache.get('a'), 1)
+        cache['c'] = 3
+        self.assertEqual(len(cache), 2)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(cache.hit_ratio, 0.5)
+
+    def test_lru_cache_disabled(self):
+        cache = LRUCache(0)
+        cache['a'] = 1
+        self.assertEqual(len(cache), 0)
+
+
+class TestPrecompressedStaticFiles(DokoHTTPTest):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp(
+            dir=self.app.settings['static_path']
+        )
+        self.url = '/static/{}/test.js'.format(
+            os.path.basename(self.directory)
+        )
+        self.content = b'var x = 1;' * 200
+        with open(os.path.join(self.directory, 'test.js'), 'wb') as f:
+            f.write(self.content)
+        with open(os.path.join(self.directory, 'test.js.gz'), 'wb') as f:
+            f.write(gzip.compress(self.content))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super().tearDown()
+
+    def test_gzip_sibling(self):
+        response = self.fetch(
+            self.url, headers={'Accept-Encoding': 'gzip'},
+            decompress_response=False,
+        )
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('javascript', response.headers['Content-Type'])
+        self.assertEqual(gzip.decompress(response.body), self.content)
+
+    def test_brotli_sibling_preferred(self):
+        with open(os.path.join(self.directory, 'test.js.br'), 'wb') as f:
+            f.write(b'not really brotli')
+        response = self.fetch(
+            self.url, headers={'Accept-Encoding': 'gzip, br'},
+            decompress_response=False,
+        )
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'br')
+        self.assertEqual(response.body, b'not really brotli')
+
+    def test_no_accept_encoding(self):
+        response = self.fetch(self.url, decompress_response=False)
+        self.assertEqual(response.code, 200)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.body, self.content)
+
+    def test_vary(self):
+        response = self.fetch(
+            self.url, headers={'Accept-Encoding': 'gzip'},
+            decompress_response=False,
+        )
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+
+
+class TestOfflineManifest(unittest.TestCase):
+    def setUp(self):
+        self.static_path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.static_path, 'src', 'survey'))
+        with open(self._path('src', 'survey', 'cache.appcache'), 'w') as f:
+            f.write(
+                'CACHE MANIFEST\n# Version $version\n\n'
+                '/static/dist/survey/js/a.js\n'
+                '/static/dist/survey/js/b.js\n\n'
+                'NETWORK:\n*\n'
+            )
+        os.makedirs(self._path('dist', 'survey', 'js'))
+        self._write('a.js', b'var a = 1;')
+        self._write('b.js', b'var b = 1;')
+
+    def tearDown(self):
+        shutil.rmtree(self.static_path)
+
+    def _path(self, *parts):
+        return os.path.join(self.static_path, *parts)
+
+    def _write(self, name, content):
+        with open(self._path('dist', 'survey', 'js', name), 'wb') as f:
+            f.write(content)
+
+    def test_index(self):
+        self._write('a.js.gz', gzip.compress(b'var a = 1;'))
+        hashes = handlers.OfflineManifest.index(self.static_path)
+        self.assertEqual(
+            set(hashes),
+            {'/static/dist/survey/js/a.js', '/static/dist/survey/js/b.js'}
+        )
+
+    def test_render(self):
+        manifest = handlers.OfflineManifest(self.static_path)
+        lines = manifest.text.splitlines()
+        self.assertEqual(lines[0], 'CACHE MANIFEST')
+        self.assertEqual(lines[1], '# Version ' + manifest.version)
+        a_hash = manifest.hashes['/static/dist/survey/js/a.js']
+        self.assertEqual(
+            lines[3:5], ['# ' + a_hash, '/static/dist/survey/js/a.js']
+        )
+        self.assertEqual(lines[-2:], ['NETWORK:', '*'])
+
+    def test_unchanged_assets(self):
+        before = handlers.OfflineManifest(self.static_path)
+        after = handlers.OfflineManifest(self.static_path)
+        self.assertEqual(before.text, after.text)
+
+    def test_changed_asset(self):
+        before = handlers.OfflineManifest(self.static_path)
+        self._write('b.js', b'var b = 2;')
+        after = handlers.OfflineManifest(self.static_path)
+        self.assertNotEqual(before.version, after.version)
+        a_url, b_url = (
+            '/static/dist/survey/js/a.js', '/static/dist/survey/js/b.js'
+        )
+        self.assertEqual(before.hashes[a_url], after.hashes[a_url])
+        self.assertNotEqual(before.hashes[b_url], after.hashes[b_url])
+
+    def test_missing_asset(self):
+        os.remove(self._path('dist', 'survey', 'js', 'b.js'))
+        manifest = handlers.OfflineManifest(self.static_path)
+        self.assertIn('# missing\n/static/dist/survey/js/b.js', manifest.text)
+
+
+class TestOfflineManifestHandler(DokoHTTPTest):
+    def test_get(self):
+        response = self.fetch('/offline.appcache', _logged_in_user=None)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(
+            response.headers['Content-Type'], 'text/cache-manifest'
+        )
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+        self.assertEqual(
+            response.body.decode(), self.app.offline_manifest.text
+        )
+
+    def test_not_modified(self):
+        response = self.fetch('/offline.appcache', _logged_in_user=None)
+        response = self.fetch(
+            '/offline.appcache', _logged_in_user=None,
+            headers={'If-None-Match': response.headers['Etag']},
+        )
+        self.assertEqual(response.code, 304)
+
+
 class TestAuth(DokoHTTPTest):
     @tornado.testing.gen_test
     def test_async_post(self):
@@ -296,6 +787,8 @@ class TestBaseHandler(DokoHTTPTest):
         dummy_close_callback = lambda _: None
         dummy_connection.set_close_callback = dummy_close_callback
         dummy_request.connection = dummy_connection
+        dummy_request.headers = {}
+        dummy_request.query_arguments = {}
         with patch.object(BaseHandler, '_current_user_cookie') as p:
             p.return_value = 'not a UUID'
             handler = BaseHandler(self.app, dummy_request)
@@ -310,6 +803,8 @@ class TestBaseAPIHandler(DokoHTTPTest):
         dummy_close_callback = lambda _: None
         dummy_connection.set_close_callback = dummy_close_callback
         dummy_request.connection = dummy_connection
+        dummy_request.headers = {}
+        dummy_request.query_arguments = {}
         handler = BaseAPIHandler(self.app, dummy_request)
         self.assertEqual(handler.api_version, 'v0')
 
@@ -319,10 +814,129 @@ class TestBaseAPIHandler(DokoHTTPTest):
         dummy_close_callback = lambda _: None
         dummy_connection.set_close_callback = dummy_close_callback
         dummy_request.connection = dummy_connection
+        dummy_request.headers = {}
+        dummy_request.query_arguments = {}
         handler = BaseAPIHandler(self.app, dummy_request)
         self.assertEqual(handler.api_root_path, '/api/v0')
 
 
+class TestReadReplicaRouting(DokoHTTPTest):
+    def get_app(self):
+        options.debug = True
+        options.demo = False
+        self.replica_session = Session(bind=self.connection, autocommit=True)
+        self.app = Application(
+            self.session, options=options,
+            replica_session=self.replica_session,
+        )
+        return self.app
+
+    def _handler(self, handler_cls, method, cookies=None):
+        dummy_connection = SimpleNamespace(
+            set_close_callback=lambda _: None
+        )
+        dummy_request = SimpleNamespace(
+            method=method, cookies=cookies or {}, connection=dummy_connection
+        )
+        return handler_cls(self.app, dummy_request)
+
+    def _window_cookie(self, until):
+        return {'read_primary_until': SimpleNamespace(value=str(until))}
+
+    def test_has_replica(self):
+        self.assertTrue(self.app.has_replica)
+
+    def test_api_get_reads_from_replica(self):
+        for handler_cls in (
+                api_v0.SurveyResource.as_list(),
+                api_v0.SurveyResource.as_detail(),
+                api_v0.SubmissionResource.as_detail(),
+                api_v0.NodeResource.as_list(),
+                api_v0.UserResource.as_detail(),
+                api_v0.PhotoResource.as_detail()):
+            handler = self._handler(handler_cls, 'GET')
+            self.assertIs(handler.session, self.replica_session)
+
+    def test_api_get_uses_primary_unless_opted_in(self):
+        for handler_cls in (
+                BaseAPIHandler,
+                api_v0.SurveyResource.as_view('changes'),
+                api_v0.SubmissionResource.as_view('changes'),
+                api_v0.ExportResource.as_detail(),
+                api_v0.ExportResource.as_view('download'),
+                api_v0.ReceiptResource.as_detail()):
+            handler = self._handler(handler_cls, 'GET')
+            self.assertIs(handler.session, self.session)
+
+    def test_api_post_uses_primary(self):
+        handler = self._handler(api_v0.SurveyResource.as_list(), 'POST')
+        self.assertIs(handler.session, self.session)
+
+    def test_admin_view_reads_from_replica(self):
+        handler = self._handler(handlers.ViewSurveyDataHandler, 'GET')
+        self.assertIs(handler.session, self.replica_session)
+
+    def test_other_get_uses_primary(self):
+        handler = self._handler(BaseHandler, 'GET')
+        self.assertIs(handler.session, self.session)
+
+    def test_read_your_writes_window(self):
+        handler = self._handler(
+            api_v0.SurveyResource.as_detail(), 'GET',
+            self._window_cookie(time() + 60)
+        )
+        self.assertIs(handler.session, self.session)
+
+    def test_read_your_writes_window_expired(self):
+        handler = self._handler(
+            api_v0.SurveyResource.as_detail(), 'GET',
+            self._window_cookie(time() - 60)
+        )
+        self.assertIs(handler.session, self.replica_session)
+
+    def _fetch_without_replica(self, url):
+        replica_error = AssertionError('read from the replica')
+        with patch.object(
+                self.replica_session, 'query', side_effect=replica_error), \
+                patch.object(
+                    self.replica_session, 'execute',
+                    side_effect=replica_error):
+            return self.fetch(url)
+
+    def test_submission_changes_never_read_replica(self):
+        response = self._fetch_without_replica(
+            self.api_root + '/submissions/changes'
+        )
+        self.assertEqual(response.code, 200, msg=response.body)
+        self.assertGreater(
+            len(json_decode(response.body)['submissions']), 0
+        )
+
+    def test_survey_changes_never_read_replica(self):
+        survey_id = 'b0816b52-204f-41d4-aaf0-ac6ae2970923'
+        response = self._fetch_without_replica(
+            self.api_root + '/surveys/' + survey_id + '/changes'
+        )
+        self.assertEqual(response.code, 200, msg=response.body)
+        self.assertIn('until', json_decode(response.body))
+
+    def test_write_starts_read_your_writes_window(self):
+        response = self.fetch(
+            '/user/logout', method='POST', body='', _logged_in_user=None
+        )
+        self.assertEqual(response.code, 200, msg=response.body)
+        self.assertIn(
+            'read_primary_until', response.headers.get('Set-Cookie', '')
+        )
+
+    def test_read_does_not_start_window(self):
+        response = self.fetch(self.api_root + '/surveys')
+        self.assertEqual(response.code, 200, msg=response.body)
+        self.assertNotIn(
+            'read_primary_until', response.headers.get('Set-Cookie', '')
+        )
+
+
 class TestEnumerate(DokoHTTPTest):
     def survey_from_script(self, script):
         return script.text.rsplit(',', 1)[0][13:]
@@ -57,6 +57,29 @@ class TestBase(unittest.TestCase):
             TypeError, models.ModelJSONEncoder().default, object()
         )
 
+    def test_model_json_encoder_types(self):
+        self.assertEqual(
+            json.dumps(
+                [
+                    datetime.datetime(2015, 1, 1), datetime.time(12),
+                    Decimal('2.5'), b'a', NumericRange(1, 3),
+                ],
+                cls=models.ModelJSONEncoder
+            ),
+            '["2015-01-01T00:00:00", "12:00:00", 2.5, "a", "[1,3)"]'
+        )
+
+    def test_model_json_encoder_escapes_closing_tags(self):
+        self.assertEqual(
+            json.dumps(
+                {'</script>': '</script>'}, cls=models.ModelJSONEncoder
+            ),
+            '{"<\\/script>": "<\\/script>"}'
+        )
+        self.assertEqual(
+            json.dumps('</b>', cls=models.ModelJSONEncoder), '"<\\/b>"'
+        )
+
     def test_create_engine(self):
         engine1 = models.create_engine()
         self.assertEqual(engine1.echo, None)
@@ -61,6 +61,15 @@ def create_fake_engine():
     return FakeEngine()
 
 
+def fake_migrate(engine):
+    engine.migrated = True
+    return []
+
+
+def fake_check_schema_version(engine):
+    return webapp.LATEST_VERSION
+
+
 class TestFunctions(unittest.TestCase):
     def test_modify_text(self):
         self.assertEqual(
@@ -103,8 +112,80 @@ class TestFunctions(unittest.TestCase):
             webapp.ensure_that_user_wants_to_drop_schema
         )
 
+    def test_worker_pool_size(self):
+        self.assertEqual(webapp.worker_pool_size(20, 4), 5)
+
+    def test_worker_pool_size_rounds_up(self):
+        self.assertEqual(webapp.worker_pool_size(10, 4), 3)
+
+    def test_worker_pool_size_minimum(self):
+        self.assertEqual(webapp.worker_pool_size(0, 4, minimum=1), 1)
+
+    def test_worker_pool_size_default(self):
+        self.assertIsNone(webapp.worker_pool_size(None, 4))
+
+    def test_worker_pool_size_unlimited(self):
+        self.assertEqual(webapp.worker_pool_size(-1, 4), -1)
+
+    def test_parse_sampling_rates(self):
+        self.assertDictEqual(
+            webapp.parse_sampling_rates(' submit_to_survey=0.1, photos=1,'),
+            {'submit_to_survey': 0.1, 'photos': 1.0}
+        )
+
+    def test_parse_sampling_rates_empty(self):
+        self.assertDictEqual(webapp.parse_sampling_rates(''), {})
+
+    def test_parse_sampling_rates_out_of_range(self):
+        self.assertRaises(
+            ValueError, webapp.parse_sampling_rates, 'submit_to_survey=2'
+        )
+
+
+class TestSetupDatabase(unittest.TestCase):
+    def setUp(self):
+        webapp.migrate = fake_migrate
+        webapp.check_schema_version = fake_check_schema_version
+        webapp.logging.info = lambda text: None
+        webapp.options.kill = False
+        webapp.options.migrate = False
+
+    def tearDown(self):
+        webapp.options.kill = False
+        webapp.options.migrate = False
+
+    def test_only_checks_version(self):
+        engine = FakeEngine()
+        engine.execute = None  # Would fail if called
+        webapp.setup_database(engine)
+        self.assertFalse(hasattr(engine, 'migrated'))
+
+    def test_version_mismatch(self):
+        def behind(engine):
+            raise webapp.SchemaVersionError()
+        webapp.check_schema_version = behind
+        self.assertRaises(
+            webapp.SchemaVersionError, webapp.setup_database, FakeEngine()
+        )
+
+    def test_migrate(self):
+        webapp.options.migrate = True
+        engine = FakeEngine()
+        webapp.setup_database(engine)
+        self.assertTrue(engine.migrated)
+
+    def test_kill_migrates(self):
+        webapp.options.kill = True
+        engine = FakeEngine()
+        webapp.setup_database(engine)
+        self.assertTrue(engine.migrated)
+
 
 class TestApplication(unittest.TestCase):
+    def setUp(self):
+        webapp.migrate = fake_migrate
+        webapp.check_schema_version = fake_check_schema_version
+
     def test_init(self):
         webapp.options.debug = False
         webapp.options.kill = True
@@ -140,3 +221,13 @@ class TestApplication(unittest.TestCase):
         app = webapp.Application()
         self.assertIsNotNone(app.session)
         self.assertIn('debug', app.handlers[0][1][-1].regex.pattern)
+
+    def test_init_no_schema_setup(self):
+        webapp.options.debug = False
+        webapp.options.demo = False
+        webapp.options.kill = True
+        engine = FakeEngine()
+        engine.execute = None  # Would fail if called
+        webapp.create_engine = lambda: engine
+        app = webapp.Application(setup_schema=False)
+        self.assertIsNotNone(app.session)
@@ -4,7 +4,13 @@ Defines setup and teardown functions for test modules.
 Also injects the --schema=doko_test option.
 """
 from contextlib import contextmanager
+from datetime import datetime
 from functools import wraps
+import json
+import os
+import platform
+from statistics import median
+from timeit import default_timer
 import unittest
 from unittest.mock import patch
 from urllib.parse import urlencode
@@ -193,3 +199,49 @@ def dont_run_in_a_transaction(doko_test):
             unload_fixtures(engine, 'doko_test')
             self.session.close()
     return wrapper
+
+
+def time_runs(function, runs: int) -> list:
+    """Call the function several times and return the durations.
+
+    :param function: a function taking no arguments
+    :param runs: the number of times to call it
+    :return: a list of durations in seconds
+    """
+    timings = []
+    for _ in range(runs):
+        start = default_timer()
+        function()
+        timings.append(default_timer() - start)
+    return timings
+
+
+def record_benchmark(name: str, timings: list, **details) -> dict:
+    """Report the result of a benchmark as one line of JSON.
+
+    The line gets printed and, if the BENCHMARK_RESULTS environment variable
+    is set, appended to the file it names (so that runs on different
+    commits can be compared).
+
+    :param name: the name of the benchmark
+    :param timings: the durations of the runs in seconds
+    :param details: anything else worth recording (sizes, etc.)
+    :return: the recorded result
+    """
+    result = {
+        'benchmark': name,
+        'runs': len(timings),
+        'min_seconds': min(timings),
+        'median_seconds': median(timings),
+        'max_seconds': max(timings),
+        'python': platform.python_version(),
+        'recorded_at': datetime.utcnow().isoformat(),
+    }
+    result.update(details)
+    line = json.dumps(result, sort_keys=True)
+    print(line)
+    results_file = os.environ.get('BENCHMARK_RESULTS')
+    if results_file:
+        with open(results_file, 'a') as out:
+            out.write(line + '\n')
+    return result
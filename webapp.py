@@ -2,28 +2,41 @@
 """Main Dokomo Forms entry point.
 
 Execute this script to start the Tornado server and WSGI container. It will
-ensure that the proper tables and extensions exist in the specified schema
-of the PostgreSQL database.
+check that the specified schema of the PostgreSQL database is at the version
+the code expects. Run it with --migrate to create or update the schema.
 
 The application looks for gettext translation files like
 locale/{locale}/LC_MESSAGES/dokomoforms.mo
 """
+import atexit
+import copy
+import datetime
+import json
 import os
+import queue
+from random import random
 import textwrap
 import signal
 import subprocess
 import sys
 from time import sleep
+from timeit import default_timer
 import logging
+import logging.handlers
 import mimetypes
 
+import sqlalchemy as sa
 from sqlalchemy import DDL
 
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import configure_mappers, sessionmaker
+from sqlalchemy.pool import QueuePool
 
 from tornado.web import url
 import tornado.log
 import tornado.httpserver
+import tornado.httputil
+import tornado.netutil
+import tornado.process
 import tornado.web
 
 from dokomoforms.options import options
@@ -34,10 +47,18 @@ if __name__ == '__main__':  # pragma: no cover
     parse_options()
 
 import dokomoforms.handlers as handlers
-from dokomoforms.models import create_engine, Base, UUID_REGEX
+from dokomoforms.handlers.metrics import Metrics
+from dokomoforms.handlers.util import GZipContentEncoding, LRUCache
+from dokomoforms.exc import SchemaVersionError
+from dokomoforms.models import (
+    create_engine, create_replica_engine, Base, UUID_REGEX,
+    LATEST_VERSION, migrate, check_schema_version, most_active_survey_ids
+)
 from dokomoforms.handlers.api.v0 import (
     SurveyResource, SubmissionResource, PhotoResource, NodeResource,
-    UserResource
+    UserResource, FacilityIndex, FacilityProxyHandler,
+    NearestFacilitiesHandler, FacilitiesWithinHandler,
+    IngestQueue, ReceiptResource, ExportJobs, ExportResource
 )
 
 
@@ -123,16 +144,86 @@ def api_url(path, *args, **kwargs):
     )
 
 
+def setup_database(engine, options=options):
+    """Drop the schema (if the user selected that option) and check it.
+
+    After dropping the schema, or if options.migrate is set, applies the
+    schema migrations (see dokomoforms.models.migrations). Otherwise this
+    only checks the schema version.
+
+    :param engine: the SQLAlchemy engine to use
+    :param options: the application options
+    :raise dokomoforms.exc.SchemaVersionError: if the schema is not up to date
+    """
+    if options.kill:
+        logging.info('Dropping schema {}.'.format(options.schema))
+        engine.execute(DDL(
+            'DROP SCHEMA IF EXISTS {} CASCADE'.format(options.schema)
+        ))
+    if options.kill or options.migrate:
+        migrate(engine)
+    check_schema_version(engine)
+
+
+def parse_sampling_rates(spec: str) -> dict:
+    """Parse options.access_log_sampling into {route name: fraction}.
+
+    :param spec: e.g. 'submit_to_survey=0.1,photos=0.5'
+    :raise ValueError: if a rate is not a number between 0 and 1
+    """
+    rates = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        route, _, rate = item.partition('=')
+        rate = float(rate)
+        if not 0 <= rate <= 1:
+            raise ValueError(
+                'The sampling rate for {} must be between 0 and 1'.format(
+                    route.strip()
+                )
+            )
+        rates[route.strip()] = rate
+    return rates
+
+
+def worker_pool_size(total: int, num_processes: int, minimum: int=0) -> int:
+    """Split a database connection budget between server processes.
+
+    Each forked process creates its own engine (and therefore its own
+    connection pool), so the configured pool_size and max_overflow are
+    treated as totals for the whole server.
+
+    :param total: the configured total, or None to use SQLAlchemy's default
+    :param num_processes: the number of server processes
+    :param minimum: the smallest value to give each process
+    :return: the per-process value, or total if it is None or negative (i.e.
+             no limit)
+    """
+    if total is None or total < 0:
+        return total
+    return max(minimum, -(-total // num_processes))
+
+
 class Application(tornado.web.Application):
 
     """The tornado.web.Application for Dokomo Forms."""
 
-    def __init__(self, session=None, options=options):
+    def __init__(self, session=None, options=options, setup_schema=True,
+                 replica_session=None):
         """Set up the application with handlers and a db connection.
 
         Defines the URLs (with associated handlers) and settings for the
         application, drops the database schema (if the user selected that
-        option), then prepares the database and creates a session.
+        option), then checks the schema version (see setup_database) and
+        creates a session.
+
+        Forked server processes pass setup_schema=False since the parent
+        process has already checked the database.
+
+        If options.db_replica_host is set, there is also a replica_session
+        for read-only requests. Otherwise (or if a session is given without a
+        replica_session) replica_session is the same object as session.
         """
         self._api_version = API_VERSION
         self._api_root_path = API_ROOT_PATH
@@ -178,8 +269,29 @@ class Application(tornado.web.Application):
                 handlers.ViewUserAdminHandler,
                 name='admin_user_view',
             ),
+            url(
+                r'/admin/profiles/?',
+                handlers.ProfileListHandler,
+                name='admin_profiles',
+            ),
+            url(
+                r'/admin/profiles/([\w-]+\.pstats)',
+                handlers.ProfileHandler,
+                name='admin_profile',
+            ),
+            url(
+                r'/admin/slow-queries/?',
+                handlers.SlowQueriesHandler,
+                name='admin_slow_queries',
+            ),
+            url(r'/metrics/?', handlers.MetricsHandler, name='metrics'),
 
             # * Enumerate views
+            url(
+                r'/offline\.appcache',
+                handlers.OfflineManifestHandler,
+                name='offline_manifest'
+            ),
             url(
                 r'/enumerate/?',
                 handlers.EnumerateHomepageHandler,
@@ -215,6 +327,10 @@ class Application(tornado.web.Application):
                 '/surveys/({uuid})/activity/?', sur.as_view('activity'),
                 name='survey_activity'
             ),
+            api_url(
+                '/surveys/({uuid})/changes/?', sur.as_view('changes'),
+                name='survey_changes'
+            ),
             api_url(
                 '/surveys/activity/?', sur.as_view('activity_all'),
                 name='activity_all'
@@ -225,10 +341,33 @@ class Application(tornado.web.Application):
                 '/submissions/?', SubmissionResource.as_list(),
                 name='submissions'
             ),
+            api_url(
+                '/submissions/changes/?',
+                SubmissionResource.as_view('changes'),
+                name='submission_changes'
+            ),
             api_url(
                 '/submissions/({uuid})/?', SubmissionResource.as_detail(),
                 name='submission'
             ),
+            api_url(
+                '/submissions/receipts/({uuid})/?',
+                ReceiptResource.as_detail(),
+                name='submission_receipt'
+            ),
+
+            # * Exports
+            api_url('/exports/?', ExportResource.as_list(), name='exports'),
+            api_url(
+                '/exports/({uuid})/?', ExportResource.as_detail(),
+                name='export'
+            ),
+            api_url(
+                '/exports/({uuid})/download/?',
+                ExportResource.as_view('download'),
+                name='export_download'
+            ),
+
             # * * Photos
             api_url('/photos/?', PhotoResource.as_list(), name='photos'),
             api_url(
@@ -250,11 +389,25 @@ class Application(tornado.web.Application):
                 '/users/generate-api-token/?', handlers.GenerateToken,
                 name='generate_token'
             ),
+
+            # * Facilities
+            api_url(
+                '/facilities/?', FacilityProxyHandler, name='facilities'
+            ),
+            api_url(
+                '/facilities/nearest/?', NearestFacilitiesHandler,
+                name='nearest_facilities'
+            ),
+            api_url(
+                '/facilities/within/?', FacilitiesWithinHandler,
+                name='facilities_within'
+            ),
         ]
 
         settings = {
             'template_path': os.path.join(_pwd, 'dokomoforms/templates'),
             'static_path': os.path.join(_pwd, 'dokomoforms/static'),
+            'static_handler_class': handlers.PrecompressedStaticFileHandler,
             'default_handler_class': handlers.NotFound,
             'xsrf_cookies': True,
             'cookie_secret': get_cookie_secret(),
@@ -287,21 +440,257 @@ class Application(tornado.web.Application):
             ]
             options.organization = 'Demo Mode'
 
-        super().__init__(urls, **settings)
+        # The names of the URLs, for logs and metrics
+        self.route_names = {
+            spec.handler_class: spec.name for spec in urls
+            if spec.name is not None
+        }
+
+        transforms = []
+        if options.compress_response:
+            transforms.append(GZipContentEncoding)
+        super().__init__(urls, transforms=transforms, **settings)
+
+        # Serialized API responses, keyed by ETag
+        self.response_cache = LRUCache(options.response_cache_size)
+        # Responses from options.revisit_url, keyed by query arguments
+        self.facility_cache = LRUCache(options.facility_cache_size)
+        # The fetches from options.revisit_url in progress, by query arguments
+        self.facility_fetches = {}
+        # Every facility in those responses, for spatial queries
+        self.facility_index = FacilityIndex()
+        # Request latency, status codes, etc. for /metrics
+        self.metrics = Metrics()
+        # The appcache manifest of the survey app, by content hash
+        self.offline_manifest = handlers.OfflineManifest(
+            self.settings['static_path']
+        )
+        # The fraction of successful requests to log, by route name
+        self.access_log_sampling = parse_sampling_rates(
+            options.access_log_sampling
+        )
 
         # Database setup
         if session is None:
             engine = create_engine()
-            if options.kill:
-                logging.info('Dropping schema {}.'.format(options.schema))
-                engine.execute(DDL(
-                    'DROP SCHEMA IF EXISTS {} CASCADE'.format(options.schema)
-                ))
-            Base.metadata.create_all(engine)
+            if setup_schema:
+                setup_database(engine, options)
             Session = sessionmaker(bind=engine, autocommit=True)
             self.session = Session()
+            replica_engine = create_replica_engine()
+            if replica_engine is not None:
+                ReplicaSession = sessionmaker(
+                    bind=replica_engine, autocommit=True
+                )
+                replica_session = ReplicaSession()
         else:
             self.session = session
+        if replica_session is None:
+            replica_session = self.session
+        self.replica_session = replica_session
+        # Submissions saved later (see options.write_behind_ingest)
+        self.ingest_queue = IngestQueue(
+            self.session.bind, metrics=self.metrics
+        )
+        # Exports written to files (see /api/v0/exports)
+        self.export_jobs = ExportJobs(self.session.bind)
+
+    @property
+    def has_replica(self) -> bool:
+        """Whether read-only requests can go to a replica database."""
+        return self.replica_session is not self.session
+
+    def route_name(self, handler_class) -> str:
+        """The name of the URL a handler class serves (or the class name)."""
+        return self.route_names.get(handler_class, handler_class.__name__)
+
+    def log_request(self, handler):
+        """Record the request in the metrics, and log it as a line of JSON.
+
+        Successful requests to the routes in self.access_log_sampling only
+        get logged that fraction of the time (the line says the sample_rate).
+        """
+        route = self.route_name(type(handler))
+        status = handler.get_status()
+        request_time = handler.request.request_time()
+        self.metrics.observe_request(route, status, request_time)
+
+        if status < 400:
+            level = logging.INFO
+        elif status < 500:
+            level = logging.WARNING
+        else:
+            level = logging.ERROR
+        access_log = tornado.log.access_log
+        if not access_log.isEnabledFor(level):
+            return
+        entry = {
+            'time': datetime.datetime.utcnow().isoformat() + 'Z',
+            'request_id': getattr(handler, 'request_id', None),
+            'user_id': getattr(handler, 'cookie_user_id', None),
+            'route': route,
+            'method': handler.request.method,
+            'path': handler.request.path,
+            'status': status,
+            'ms': round(request_time * 1000, 3),
+            'remote_ip': handler.request.remote_ip,
+        }
+        sample_rate = self.access_log_sampling.get(route)
+        if status < 400 and sample_rate is not None:
+            if random() >= sample_rate:
+                return
+            entry['sample_rate'] = sample_rate
+        query_stats = getattr(handler, 'query_stats', None)
+        if query_stats is not None:
+            entry['db_ms'] = round(query_stats.milliseconds, 3)
+            entry['queries'] = query_stats.queries
+            entry['rows'] = query_stats.rows
+        access_log.log(level, json.dumps(entry, sort_keys=True))
+
+
+class _WarmUpConnection:
+
+    """Stands in for the HTTP connection of a warm-up request."""
+
+    def __init__(self):
+        self.status = None
+
+    def set_close_callback(self, callback):
+        pass
+
+    def write_headers(self, start_line, headers, chunk=None, callback=None):
+        self.status = start_line.code
+        if callback is not None:
+            callback()
+
+    def write(self, chunk, callback=None):
+        if callback is not None:
+            callback()
+
+    def finish(self):
+        pass
+
+
+def _warm_up_request(application, uri: str) -> int:
+    """Run a GET request through the application without a server.
+
+    :return: the status code of the response
+    """
+    connection = _WarmUpConnection()
+    application(tornado.httputil.HTTPServerRequest(
+        method='GET', uri=uri, connection=connection
+    ))
+    return connection.status
+
+
+def _mapped_classes(cls):
+    for subclass in cls.__subclasses__():
+        if sa.inspect(subclass, raiseerr=False) is not None:
+            yield subclass
+        yield from _mapped_classes(subclass)
+
+
+def _open_pool_connections(engine):
+    """Open as many connections as the engine's pool keeps."""
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        return
+    connections = []
+    try:
+        for _ in range(pool.size()):
+            connections.append(engine.connect())
+    finally:
+        for connection in connections:
+            connection.close()
+
+
+def warm_up(application, num_surveys: int=None) -> float:
+    """Do the slow first-time work before the server accepts requests.
+
+    Configures the SQLAlchemy mappers, opens the connections of the pools,
+    and queries every model once (which builds the loaders and compiles the
+    column properties). Then it requests the API detail of the num_surveys
+    (default: options.warm_up_surveys) surveys with the most submissions in
+    the last week, which fills the response cache. The requests are
+    anonymous, so only public surveys get cached.
+
+    :param application: the Application
+    :param num_surveys: the number of surveys to request
+    :return: the number of seconds it took
+    """
+    start = default_timer()
+    configure_mappers()
+    sessions = [application.session]
+    if application.has_replica:
+        sessions.append(application.replica_session)
+    for session in sessions:
+        _open_pool_connections(session.bind.engine)
+        for model_cls in set(_mapped_classes(Base)):
+            session.query(model_cls).limit(0).all()
+    if num_surveys is None:
+        num_surveys = options.warm_up_surveys
+    if num_surveys > 0:
+        since = (
+            datetime.datetime.now(datetime.timezone.utc) -
+            datetime.timedelta(days=7)
+        )
+        survey_ids = most_active_survey_ids(
+            application.replica_session, since, num_surveys
+        )
+        for survey_id in survey_ids:
+            _warm_up_request(
+                application, API_ROOT_PATH + '/surveys/' + survey_id
+            )
+    return default_timer() - start
+
+
+def prepare_application(**kwargs) -> Application:  # pragma: no cover
+    """Create the Application and get it ready to accept requests.
+
+    Warms up (if options.warm_up is set), starts measuring the IOLoop lag,
+    starts the export job workers, and starts the write-behind ingest
+    workers (if options.write_behind_ingest is set).
+
+    :param kwargs: the keyword arguments to pass to Application
+    """
+    application = Application(**kwargs)
+    if options.warm_up:
+        logging.info('Warmed up in {:.2f} seconds.'.format(
+            warm_up(application)
+        ))
+    application.metrics.monitor_ioloop(options.ioloop_lag_interval)
+    application.export_jobs.start()
+    if options.write_behind_ingest:
+        application.ingest_queue.start()
+    return application
+
+
+def _offer_to_kill_process_using_port(port):  # pragma: no cover
+    """Ask whether to kill the process using the port. Return the answer."""
+    pid = (
+        subprocess
+        .check_output(['lsof', '-t', '-i:{}'.format(options.port)])
+        .decode()
+        .strip()
+    )
+    cmd = (
+        subprocess
+        .check_output(['ps', '-o', 'cmd', '-fp', pid, '--no-header'])
+        .decode()
+        .strip()
+    )
+    msg = (
+        'A process (ID: {} CMD: {})'
+        ' is currently using port {}'.format(pid, cmd, port)
+    )
+    print(msg)
+    replace = input('Do you want to kill it? y/n (default n) ')
+    if replace.lower().startswith('y'):
+        os.killpg(int(pid), signal.SIGTERM)
+        sleep(1)
+        print('Killed process {}'.format(pid))
+        return True
+    return False
 
 
 def start_http_server(http_server, port):  # pragma: no cover
@@ -309,58 +698,182 @@ def start_http_server(http_server, port):  # pragma: no cover
     try:
         http_server.listen(options.port)
     except OSError:
-        pid = (
-            subprocess
-            .check_output(['lsof', '-t', '-i:{}'.format(options.port)])
-            .decode()
-            .strip()
-        )
-        cmd = (
-            subprocess
-            .check_output(['ps', '-o', 'cmd', '-fp', pid, '--no-header'])
-            .decode()
-            .strip()
-        )
-        msg = (
-            'A process (ID: {} CMD: {})'
-            ' is currently using port {}'.format(pid, cmd, port)
-        )
-        print(msg)
-        replace = input('Do you want to kill it? y/n (default n) ')
-        if replace.lower().startswith('y'):
-            os.killpg(int(pid), signal.SIGTERM)
-            sleep(1)
-            print('Killed process {}'.format(pid))
+        if _offer_to_kill_process_using_port(port):
             http_server.listen(options.port)
         else:
             raise
 
 
+def bind_sockets(port):  # pragma: no cover
+    """Bind the listening sockets before forking server processes.
+
+    Like start_http_server, offers to kill anything using the port.
+    """
+    try:
+        return tornado.netutil.bind_sockets(port)
+    except OSError:
+        if _offer_to_kill_process_using_port(port):
+            return tornado.netutil.bind_sockets(port)
+        raise
+
+
+def start_server_processes(num_processes):  # pragma: no cover
+    """Pre-fork the server processes and start serving in each of them.
+
+    The database schema is checked once in the parent process. Each child
+    process then creates its own engine after the fork (connection pools
+    must not be shared between processes) with its share of pool_size and
+    max_overflow, and warms up (see warm_up) before it starts accepting
+    connections. tornado.process.fork_processes restarts any child that
+    crashes, up to options.max_restarts times.
+
+    :param num_processes: the number of processes to fork. 0 means one per
+                          CPU core.
+    :return: the ID of this process (between 0 and the number of processes)
+    """
+    sockets = bind_sockets(options.port)
+    setup_engine = create_engine(pool_size=1)
+    setup_database(setup_engine)
+    setup_engine.dispose()
+
+    if num_processes <= 0:
+        num_processes = tornado.process.cpu_count()
+    options.pool_size = worker_pool_size(
+        options.pool_size, num_processes, minimum=1
+    )
+    options.max_overflow = worker_pool_size(
+        options.max_overflow, num_processes
+    )
+
+    task_id = tornado.process.fork_processes(
+        num_processes, max_restarts=options.max_restarts
+    )
+    start_log_listener()
+    http_server = tornado.httpserver.HTTPServer(
+        prepare_application(setup_schema=False)
+    )
+    http_server.add_sockets(sockets)
+    return task_id
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+
+    """Puts records on the queue, addressed to one of the log files."""
+
+    def __init__(self, destination: str, level=logging.NOTSET):
+        # See start_log_listener for the queue
+        super().__init__(None)
+        self.destination = destination
+        self.setLevel(level)
+
+    def prepare(self, record):
+        # The same record can go to several files (e.g., by propagating to
+        # the root logger), so each file gets a copy
+        record = super().prepare(copy.copy(record))
+        record.destination = self.destination
+        return record
+
+
+# Set up by setup_file_loggers
+_queue_handlers = []
+_file_handlers = []
+_log_listener = None
+
+
+class _DestinationFilter(logging.Filter):
+
+    """Lets through the records addressed to one log file."""
+
+    def __init__(self, destination: str):
+        super().__init__()
+        self.destination = destination
+
+    def filter(self, record):
+        return getattr(record, 'destination', None) == self.destination
+
+
+def start_log_listener():  # pragma: no cover
+    """Start the thread that writes the log files, on a new queue.
+
+    Threads do not survive a fork, so each server process calls this after
+    tornado.process.fork_processes.
+    """
+    global _log_listener
+    if not _file_handlers:
+        return
+    log_queue = queue.Queue()
+    for handler in _queue_handlers:
+        handler.queue = log_queue
+    for handler in _file_handlers:
+        # The lock might have been held by the writer thread of the parent
+        handler.createLock()
+    _log_listener = logging.handlers.QueueListener(log_queue, *_file_handlers)
+    _log_listener.start()
+
+
+def _stop_log_listener():  # pragma: no cover
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+
 def setup_file_loggers(log_level: str):  # pragma: no cover
-    """Handles application, Tornado, and SQLAlchemy logging configuration."""
+    """Handles application, Tornado, and SQLAlchemy logging configuration.
+
+    Logging a message only puts it on a queue. A QueueListener thread formats
+    the messages and writes them to the files in log/, so that a slow disk
+    does not block the IOLoop.
+    """
     os.makedirs('log', exist_ok=True)
-    timed_handler = logging.handlers.TimedRotatingFileHandler
+
+    def log_to_file(logger, file_name, log_format, level=logging.NOTSET):
+        destination = 'log/{}'.format(file_name)
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            destination, when='D'
+        )
+        file_handler.setFormatter(log_format)
+        file_handler.addFilter(_DestinationFilter(destination))
+        _file_handlers.append(file_handler)
+        queue_handler = _QueueHandler(destination, level)
+        _queue_handlers.append(queue_handler)
+        logger.addHandler(queue_handler)
+
     root_logger = logging.getLogger()
-    root_logger.removeHandler(root_logger.handlers[0])
-    logging.basicConfig(
-        format='%(asctime)s %(levelname)s %(message)s',
-        handlers=[timed_handler('log/dokomoforms.log', when='D')]
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    log_to_file(
+        root_logger, 'dokomoforms.log',
+        logging.Formatter('%(asctime)s %(levelname)s %(message)s'),
+    )
+    # The access log lines are JSON
+    log_to_file(
+        logging.getLogger('tornado.access'), 'tornado.access.log',
+        logging.Formatter('%(message)s'),
     )
-    for log in ('access', 'application', 'general'):
-        logger = logging.getLogger('tornado.{}'.format(log))
-        handler = timed_handler('log/tornado.{}.log'.format(log), when='D')
-        formatter = tornado.log.LogFormatter(color=False, datefmt=None)
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
+    for log in ('application', 'general'):
+        log_to_file(
+            logging.getLogger('tornado.{}'.format(log)),
+            'tornado.{}.log'.format(log),
+            tornado.log.LogFormatter(color=False, datefmt=None),
+        )
     sql_logger = logging.getLogger('sqlalchemy')
     sql_logger.propagate = False
     sql_logger.setLevel(log_level)
-    sql_handler = timed_handler('log/sqlalchemy.log', when='D')
-    sql_handler.setLevel(log_level)
-    sql_handler.setFormatter(logging.Formatter(
-        '%(asctime)s %(levelname)s %(name)s %(message)s'
-    ))
-    sql_logger.addHandler(sql_handler)
+    log_to_file(
+        sql_logger, 'sqlalchemy.log',
+        logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s'),
+        log_level,
+    )
+    slow_query_logger = logging.getLogger('dokomoforms.slow_queries')
+    slow_query_logger.propagate = False
+    log_to_file(
+        slow_query_logger, 'slow_queries.log',
+        logging.Formatter('%(asctime)s %(levelname)s %(message)s'),
+    )
+    start_log_listener()
+    # Write whatever is still on the queue on the way out
+    atexit.register(_stop_log_listener)
 
 
 def main(msg=None):  # pragma: no cover
@@ -375,22 +888,46 @@ def main(msg=None):  # pragma: no cover
         logging.getLogger('sqlalchemy').setLevel(log_level)
     if options.kill:
         ensure_that_user_wants_to_drop_schema()
-    http_server = tornado.httpserver.HTTPServer(Application())
+    if options.processes != 1 and options.debug:
+        print('{error} debug mode only supports a single process.'.format(
+            error=modify_text('Error:', bold)
+        ))
+        sys.exit(1)
+    if options.migrate:
+        engine = create_engine(pool_size=1)
+        setup_database(engine)
+        engine.dispose()
+        print('Schema {} is at version {}.'.format(
+            options.schema, LATEST_VERSION
+        ))
+        return
     tornado.locale.load_gettext_translations(
         os.path.join(_pwd, 'locale'), 'dokomoforms'
     )
-    start_http_server(http_server, options.port)
-    print(
-        '{dokomo}{starting}'.format(
-            dokomo=modify_text(
-                'Dokomo Forms for {}: '.format(options.organization), bold
-            ),
-            starting=modify_text(
-                'starting server on port {}'.format(options.port), green
-            ),
+    try:
+        if options.processes == 1:
+            http_server = tornado.httpserver.HTTPServer(prepare_application())
+            start_http_server(http_server, options.port)
+            task_id = None
+        else:
+            task_id = start_server_processes(options.processes)
+    except SchemaVersionError as error:
+        print('{error} {message}'.format(
+            error=modify_text('Error:', bold), message=error
+        ))
+        sys.exit(1)
+    if not task_id:
+        print(
+            '{dokomo}{starting}'.format(
+                dokomo=modify_text(
+                    'Dokomo Forms for {}: '.format(options.organization), bold
+                ),
+                starting=modify_text(
+                    'starting server on port {}'.format(options.port), green
+                ),
+            )
         )
-    )
-    logging.info('Application started.')
+    logging.info('Application started (process {}).'.format(os.getpid()))
     if msg is not None:
         print(msg)
     tornado.ioloop.IOLoop.current().start()